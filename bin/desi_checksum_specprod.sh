@@ -12,7 +12,7 @@ source ${DESIDA}/bin/desida_library.sh
 function usage() {
     local execName=$(basename $0)
     (
-    echo "${execName} [-h] [-j JOBS] [-s DIR] [-V] [-z VERSION] SPECPROD"
+    echo "${execName} [-h] [-j JOBS] [-n N] [-s DIR] [-V] [-z VERSION] SPECPROD"
     echo ""
     echo "Checksum an entire spectroscopic reduction (SPECPROD) in preparation"
     echo "for tape backup."
@@ -22,6 +22,8 @@ function usage() {
     echo ""
     echo "    -h         = Print this message and exit."
     echo "    -j JOBS    = Use JOBS directory to write batch files (default ${DESI_ROOT}/users/${USER}/jobs)."
+    echo "    -n N       = Pack all checksum files into at most N size-balanced jobs,"
+    echo "                 instead of writing one job per directory."
     echo "    -s DIR     = Use DIR for temporary files (default ${SCRATCH})."
     echo "    -V         = Version. Print a version string and exit."
     echo "    -z VERSION = Version of zcatalog (default 'v1')."
@@ -73,10 +75,12 @@ EOT
 jobs=${DESI_ROOT}/users/${USER}/jobs
 scratch=${SCRATCH}
 zcat_version=v1
-while getopts hj:s:V argname; do
+n_jobs=''
+while getopts hj:n:s:Vz: argname; do
     case ${argname} in
         h) usage; exit 0 ;;
         j) jobs=${OPTARG} ;;
+        n) n_jobs=${OPTARG} ;;
         s) scratch=${OPTARG} ;;
         V) version; exit 0 ;;
         z) zcat_version=${OPTARG} ;;
@@ -95,6 +99,13 @@ if [[ ! -d ${DESI_SPECTRO_REDUX}/${SPECPROD} ]]; then
     exit 1
 fi
 #
+# Size-balanced jobs.
+#
+if [[ -n "${n_jobs}" ]]; then
+    desi_checksum_jobs plan --jobs ${jobs} --n-jobs ${n_jobs} --scratch ${scratch} --zcat-version ${zcat_version} ${SPECPROD}
+    exit $?
+fi
+#
 # Top-level files
 #
 home=${DESI_SPECTRO_REDUX}/${SPECPROD}
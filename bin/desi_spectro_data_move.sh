@@ -54,7 +54,17 @@ if [[ -z "${DESI_SPECTRO_DATA}" ]]; then
     exit 1
 fi
 #
-# Set up moves on HPSS.
+# Journal of moves, so that an interrupted run can be resumed, kept in a
+# directory that is not purged.  Nights are recorded as finished in the
+# journal once their HPSS files have been moved.
+#
+journal_dir=${DESI_ROOT}/users/${USER}
+journal=${journal_dir}/desi_spectro_data_move_${release}.db
+${verbose} && echo "DEBUG: mkdir -p ${journal_dir}"
+${test}    || mkdir -p ${journal_dir}
+#
+# Set up moves on HPSS.  These are listed afresh from the journal
+# on every run.
 #
 hpss_moves=${SCRATCH}/desi_spectro_data_move_hpss.txt
 hpss_desi=/nersc/projects/desi
@@ -69,6 +79,14 @@ ${test}    || touch ${hpss_moves}
 #
 release_data=${DESI_ROOT}/public/${release}/spectro/data
 relative_data="../../public/${release}/spectro/data"
+#
+# Complete any moves left over from a previous run first, since nights
+# that were moved but not linked no longer appear in DESI_SPECTRO_DATA.
+#
+if [[ -f ${journal} ]]; then
+    ${verbose} && echo "DEBUG: desi_move_and_link -j ${journal}"
+    ${test}    || desi_move_and_link -j ${journal} || exit 1
+fi
 for n in ${DESI_SPECTRO_DATA}/20*; do
     night=$(basename ${n})
     if [[ -L ${n} ]]; then
@@ -77,16 +95,27 @@ for n in ${DESI_SPECTRO_DATA}/20*; do
         if is_night_in_release ${release} ${night}; then
             ${verbose} && echo "DEBUG: chmod -v u+w ${DESI_SPECTRO_DATA}/${night}"
             ${test}    || chmod -v u+w ${DESI_SPECTRO_DATA}/${night}
-            ${verbose} && echo "DEBUG: mv -v ${DESI_SPECTRO_DATA}/${night} ${release_data}"
-            ${test}    || mv -v ${DESI_SPECTRO_DATA}/${night} ${release_data}
-            ${verbose} && echo "DEBUG: chmod -v u-w ${release_data}/${night}"
-            ${test}    || chmod -v u-w ${release_data}/${night}
-            ${verbose} && echo "DEBUG: (cd ${DESI_SPECTRO_DATA} && ln -s -v ${relative_data}/${night})"
-            ${test}    || (cd ${DESI_SPECTRO_DATA} && ln -s -v ${relative_data}/${night})
-            ${verbose} && echo "DEBUG: echo mv ${hpss_desi}/spectro/data/desi_spectro_data_${night}.tar ${hpss_desi}/spectro/data/desi_spectro_data_${night}.tar.idx ${hpss_desi}/public/${release}/spectro/data >> ${hpss_moves}"
-            ${test}    || echo "mv ${hpss_desi}/spectro/data/desi_spectro_data_${night}.tar ${hpss_desi}/spectro/data/desi_spectro_data_${night}.tar.idx ${hpss_desi}/public/${release}/spectro/data" >> ${hpss_moves}
+            ${verbose} && echo "DEBUG: desi_move_and_link -j ${journal} ${DESI_SPECTRO_DATA}/${night} ${release_data} ${relative_data}/${night}"
+            ${test}    || desi_move_and_link -j ${journal} ${DESI_SPECTRO_DATA}/${night} ${release_data} ${relative_data}/${night} || exit 1
         fi
     fi
 done
-${verbose} && echo "DEBUG: hsi in ${hpss_moves}"
-${test}    || hsi in ${hpss_moves}
+#
+# Make every night that has been moved and linked, but not finished,
+# read-only and move its HPSS files, including nights completed by
+# resuming an interrupted run.
+#
+unfinished=${SCRATCH}/desi_spectro_data_move_unfinished.txt
+${verbose} && echo "DEBUG: desi_move_and_link -j ${journal} -u ${unfinished}"
+${test}    || desi_move_and_link -j ${journal} -u ${unfinished} || exit 1
+if [[ -f ${unfinished} ]]; then
+    for n in $(<${unfinished}); do
+        night=$(basename ${n})
+        ${verbose} && echo "DEBUG: chmod -v u-w ${release_data}/${night}"
+        ${test}    || chmod -v u-w ${release_data}/${night}
+        ${verbose} && echo "DEBUG: echo mv ${hpss_desi}/spectro/data/desi_spectro_data_${night}.tar ${hpss_desi}/spectro/data/desi_spectro_data_${night}.tar.idx ${hpss_desi}/public/${release}/spectro/data >> ${hpss_moves}"
+        ${test}    || echo "mv ${hpss_desi}/spectro/data/desi_spectro_data_${night}.tar ${hpss_desi}/spectro/data/desi_spectro_data_${night}.tar.idx ${hpss_desi}/public/${release}/spectro/data" >> ${hpss_moves}
+    done
+fi
+${verbose} && echo "DEBUG: hsi in ${hpss_moves} && desi_move_and_link -j ${journal} -f"
+${test}    || (hsi in ${hpss_moves} && desi_move_and_link -j ${journal} -f)
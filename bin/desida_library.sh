@@ -47,16 +47,15 @@ function is_empty() {
     [[ -z "$(/bin/ls -A ${directory})" ]]
 }
 #
-# Validate checksums.
+# Validate checksums. Every mismatched, missing or extra file is reported.
+# If a second argument is present, look for extra files in subdirectories.
+# Returns 17 if files are missing or extra, 1 if any checksum does not match.
 #
 function validate() {
     local checksum=$1
-    local depth='-maxdepth 1'
-    [[ -n "$2" ]] && depth=''
-    local n_files=$(find . ${depth} -not -type d | wc -l)
-    local n_lines=$(cat ${checksum} | wc -l)
-    (( n_files == n_lines + 1 )) || return 17
-    sha256sum --status --check ${checksum}
+    local recursive=''
+    [[ -n "$2" ]] && recursive='--recursive'
+    desi_verify_checksums ${recursive} ${checksum}
 }
 #
 # Raw data nights in each release.
@@ -7,17 +7,33 @@ desida.archive_fiberassign
 Tools for working with *intermediate* fiberassign files, *i.e.* ``${DESI_ROOT}/survey/fiberassign``.
 """
 import os
+import re
 import sys
-import glob
+import time
 import shutil
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 from astropy.io import fits
 from desiutil.log import get_logger, DEBUG
+from .transaction import MoveJournal
 
 
 log = None
 
 
+#: Default number of threads used to move and link files.
+DEFAULT_WORKERS = 8
+
+
+#: Columns of the TILE_COMPLETENESS table used to select tiles.
+TILE_COLUMNS = ('TILEID', 'SURVEY', 'PROGRAM')
+
+
+#: Every six-digit window of a filename, including overlapping windows.
+_six_digits = re.compile(r'(?=(\d{6}))')
+
+
 def _options():
     """Parse command-line options.
 
@@ -28,8 +44,14 @@ def _options():
     """
     prsr = ArgumentParser(prog=os.path.basename(sys.argv[0]),
                           description='Move and link intermediate desi/survey/fiberassign files for tiles in a data release.')
+    prsr.add_argument('-c', '--cache-dir', metavar='DIR',
+                      help='Cache the tile list in DIR.')
+    prsr.add_argument('-j', '--journal', metavar='FILE',
+                      help='Record moves and finished tiles in FILE, complete any moves left pending in FILE by an interrupted run, and skip finished tiles.')
     prsr.add_argument('-l', '--limit', type=int, metavar='N',
                       help='Limit moves to N tiles. Default is all tiles.')
+    prsr.add_argument('-p', '--program', metavar='PROGRAM',
+                      help='Work with tiles from this program, or comma-separated programs, e.g. dark,bright.')
     prsr.add_argument('-r', '--release', default='dr1', metavar='RELEASE',
                       help='Data release (default %(default)s).')
     prsr.add_argument('-s', '--specprod', default='iron', metavar='SPECPROD',
@@ -38,13 +60,17 @@ def _options():
                       help='Work with tiles from this survey (default %(default)s).')
     prsr.add_argument('-t', '--test', action='store_true',
                       help="Test mode. Do not make any changes.")
+    prsr.add_argument('-T', '--tiles', metavar='RANGES',
+                      help='Work with tiles in these comma-separated IDs or ranges, e.g. 1000-1999,5000.')
     prsr.add_argument('-v', '--verbose', action='store_true',
                       help="Turn on debug-level logging.")
+    prsr.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS, metavar='N',
+                      help='Use N threads to move and link files (default %(default)s).')
     return prsr.parse_args()
 
 
-def tiles(release, specprod, survey):
-    """Obtain the list of tiles from `survey` to be processed.
+def load_tiles(release, specprod, cache_dir=None):
+    """Read the columns of the tiles file needed to select tiles.
 
     Parameters
     ----------
@@ -52,61 +78,264 @@ def tiles(release, specprod, survey):
         Data release, *e.g.* 'dr1'.
     specprod : :class:`str`
         Specprod name, *e.g.* 'iron'.
-    survey : :class:`str`
-        Return tiles from this survey.
+    cache_dir : :class:`str`, optional
+        Cache the columns in this directory, and reuse them as long as the
+        tiles file has not changed.
 
     Returns
     -------
-    :class:`list`
-        The list of tiles from `survey`.
+    :class:`dict`
+        Mapping of each column in :data:`TILE_COLUMNS` to an array.
     """
     tiles_file = os.path.join(os.environ['DESI_ROOT'], 'public', release,
                               'spectro', 'redux',
                               specprod, f'tiles-{specprod}.fits')
     log.debug("tiles_file = '%s'", tiles_file)
-    with fits.open(tiles_file, mode='readonly') as hdulist:
+    mtime_ns = os.stat(tiles_file).st_mtime_ns
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = os.path.join(cache_dir, f'tiles-{release}-{specprod}.npz')
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as cached:
+                if int(cached['MTIME_NS']) == mtime_ns:
+                    log.debug("Reading tiles from cache '%s'", cache_file)
+                    return {c: cached[c] for c in TILE_COLUMNS}
+    with fits.open(tiles_file, mode='readonly', memmap=True) as hdulist:
         data = hdulist['TILE_COMPLETENESS'].data
-    w = data['SURVEY'] == survey
-    return data['TILEID'][w].tolist()
+        columns = dict()
+        for c in TILE_COLUMNS:
+            column = np.array(data.field(c))
+            if column.dtype.kind in 'SU':
+                column = np.char.strip(column.astype(str))
+            columns[c] = column
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = cache_file + '.tmp.npz'
+        np.savez(tmp_file, MTIME_NS=np.int64(mtime_ns), **columns)
+        os.replace(tmp_file, cache_file)
+    return columns
 
 
-def process_tile(tileid, release, survey, test_mode):
-    """Process intermediate files associated with `tileid`.
+def parse_tile_ranges(ranges):
+    """Parse a list of tile ranges, *e.g.* ``'1000-1999,5000'``.
+
+    Parameters
+    ----------
+    ranges : :class:`str`
+        Comma-separated tile IDs or inclusive ranges of tile IDs.
+
+    Returns
+    -------
+    :class:`list`
+        (first, last) tuples.
+    """
+    parsed = list()
+    for r in ranges.split(','):
+        first, sep, last = r.strip().partition('-')
+        parsed.append((int(first), int(last) if sep else int(first)))
+    return parsed
+
+
+def select_tiles(columns, survey=None, program=None, ranges=None, exclude=None, limit=None):
+    """Select tiles with vectorized filters.
+
+    Parameters
+    ----------
+    columns : :class:`dict`
+        Tile columns, as returned by :func:`load_tiles`.
+    survey : :class:`str` or :class:`list`, optional
+        Select tiles from these surveys.
+    program : :class:`str` or :class:`list`, optional
+        Select tiles from these programs.
+    ranges : :class:`list`, optional
+        Select tiles in these inclusive (first, last) ranges.
+    exclude : iterable, optional
+        Do not select these tiles, *e.g.* tiles that are already finished.
+    limit : :class:`int`, optional
+        Select at most this many tiles.
+
+    Returns
+    -------
+    :class:`list`
+        The selected tile IDs, in the order of the tiles file.
+    """
+    tileid = columns['TILEID']
+    w = np.ones(len(tileid), dtype=bool)
+    if survey is not None:
+        w &= np.isin(columns['SURVEY'], np.atleast_1d(survey))
+    if program is not None:
+        w &= np.isin(columns['PROGRAM'], np.atleast_1d(program))
+    if ranges:
+        in_range = np.zeros(len(tileid), dtype=bool)
+        for first, last in ranges:
+            in_range |= (tileid >= first) & (tileid <= last)
+        w &= in_range
+    if exclude:
+        w &= ~np.isin(tileid, np.fromiter(exclude, dtype=tileid.dtype))
+    return tileid[w][:limit].tolist()
+
+
+def tiles(release, specprod, survey):
+    """Obtain the list of tiles from `survey` to be processed.
 
     Parameters
     ----------
-    tileid : class`int`
-        The unique tile number.
     release : :class:`str`
         Data release, *e.g.* 'dr1'.
+    specprod : :class:`str`
+        Specprod name, *e.g.* 'iron'.
     survey : :class:`str`
         Return tiles from this survey.
-    test_mode : :class:`bool`
-        If ``True``, do not make any changes.
+
+    Returns
+    -------
+    :class:`list`
+        The list of tiles from `survey`.
+    """
+    return select_tiles(load_tiles(release, specprod), survey=survey)
+
+
+def _tile_unit_prefix(survey):
+    """Common prefix of the names of the journal entries of finished tiles in `survey`.
+    """
+    return f"fiberassign/{survey}/"
+
+
+def _tile_unit(survey, tileid):
+    """Name of the journal entry that records that `tileid` is finished.
+    """
+    return f"{_tile_unit_prefix(survey)}{tileid:06d}"
+
+
+def tilegroup_index(src, tileids=None):
+    """Map tiles to the files in a tilegroup directory, with a single directory scan.
+
+    A file belongs to every tile whose zero-padded, six-digit ID appears
+    anywhere in its name, the same files that ``glob.glob('*{tileid:06d}*')``
+    would match.
+
+    Parameters
+    ----------
+    src : :class:`str`
+        A tilegroup directory, *e.g.* ``${DESI_ROOT}/survey/fiberassign/main/012``.
+    tileids : iterable, optional
+        Only index these tiles.
+
+    Returns
+    -------
+    :class:`dict`
+        Mapping of tile ID to a :class:`list` of (name, is_symlink) tuples.
+    """
+    wanted = None if tileids is None else set(tileids)
+    index = dict()
+    with os.scandir(src) as it:
+        for entry in it:
+            if entry.name.startswith('.'):
+                continue
+            tids = {int(m.group(1)) for m in _six_digits.finditer(entry.name)}
+            for tid in tids:
+                if wanted is None or tid in wanted:
+                    index.setdefault(tid, list()).append((entry.name, entry.is_symlink()))
+    return index
+
+
+def _move_and_link(src_file, dst, link_target, test_mode):
+    """Move `src_file` to directory `dst` and replace it with a symlink to `link_target`.
+    """
+    log.debug("shutil.move('%s', '%s')", src_file, dst)
+    log.debug("os.symlink('%s', '%s')", link_target, src_file)
+    if not test_mode:
+        shutil.move(src_file, dst)
+        os.symlink(link_target, src_file)
+
+
+def _tilegroup_paths(tilegroup, release, survey):
+    """Source and destination directories of `tilegroup`.
     """
-    tilegroup = tileid//1000
     tilegroup_string = f"{tilegroup:03d}"
-    tileid_string = f"{tileid:06d}"
     src = os.path.join(os.environ['DESI_ROOT'], 'survey', 'fiberassign', survey, tilegroup_string)
     dst = os.path.join(os.environ['DESI_ROOT'], 'public', release, 'survey', 'fiberassign', survey, tilegroup_string)
+    return src, dst
+
+
+def process_tilegroup(tilegroup, tileids, release, survey, test_mode, workers=DEFAULT_WORKERS, journal=None):
+    """Process intermediate files associated with several tiles in the same tilegroup.
+
+    Parameters
+    ----------
+    tilegroup : :class:`int`
+        The tilegroup, *i.e.* ``tileid//1000``.
+    tileids : :class:`list`
+        Tiles in `tilegroup`.
+    release : :class:`str`
+        Data release, *e.g.* 'dr1'.
+    survey : :class:`str`
+        Return tiles from this survey.
+    test_mode : :class:`bool`
+        If ``True``, do not make any changes.
+    workers : :class:`int`, optional
+        Number of threads used to move and link files.
+    journal : :class:`~desida.transaction.MoveJournal`, optional
+        If set, record each move and link in this journal, so that an
+        interrupted run can be resumed.  Only the moves of this tile group
+        are carried out, and the tiles are recorded as finished if none of
+        them fail.
+
+    Returns
+    -------
+    :class:`int`
+        The number of files moved.
+    """
+    src, dst = _tilegroup_paths(tilegroup, release, survey)
     assert os.path.isdir(src)
     if not os.path.isdir(dst):
         log.debug("os.makedirs('%s')", dst)
         if not test_mode:
-            os.makedirs(dst)
-    log.debug("glob.glob(os.path.join('%s', '*%s*'))", src, tileid_string)
-    tileid_files = glob.glob(os.path.join(src, f"*{tileid_string}*"))
-    for tileid_file in tileid_files:
-        if os.path.islink(tileid_file):
-            log.warning("%s is already a symlink, skipping.", tileid_file)
+            os.makedirs(dst, exist_ok=True)
+    log.debug("tilegroup_index('%s')", src)
+    index = tilegroup_index(src, tileids)
+    rel_dst = dst.replace(os.environ['DESI_ROOT'], '../../../..')
+    moves = dict()
+    for tileid in tileids:
+        for tf, is_symlink in index.get(tileid, []):
+            if tf in moves:
+                continue
+            tileid_file = os.path.join(src, tf)
+            if is_symlink:
+                log.warning("%s is already a symlink, skipping.", tileid_file)
+                continue
+            moves[tf] = (tileid_file, dst, os.path.join(rel_dst, tf), test_mode)
+    if journal is not None and not test_mode:
+        for tileid_file, dst, link_target, test_mode in moves.values():
+            journal.plan(tileid_file, os.path.join(dst, os.path.basename(tileid_file)), link_target)
+        counts = journal.run(workers=workers, sources=[m[0] for m in moves.values()])
+        if counts['failed'] > 0:
+            log.error("Failed to move %d files in tile group %03d.", counts['failed'], tilegroup)
         else:
-            rel_dst = dst.replace(os.environ['DESI_ROOT'], '../../../..')
-            tf = os.path.basename(tileid_file)
-            log.debug("shutil.move('%s', '%s')", tileid_file, dst)
-            log.debug("os.symlink('%s', '%s')", os.path.join(rel_dst, tf), tileid_file)
-            if not test_mode:
-                shutil.move(tileid_file, dst)
-                os.symlink(os.path.join(rel_dst, tf), tileid_file)
+            for tileid in tileids:
+                journal.complete(_tile_unit(survey, tileid))
+        return counts['linked']
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for future in [executor.submit(_move_and_link, *m) for m in moves.values()]:
+            future.result()
+    return len(moves)
+
+
+def process_tile(tileid, release, survey, test_mode):
+    """Process intermediate files associated with `tileid`.
+
+    Parameters
+    ----------
+    tileid : class`int`
+        The unique tile number.
+    release : :class:`str`
+        Data release, *e.g.* 'dr1'.
+    survey : :class:`str`
+        Return tiles from this survey.
+    test_mode : :class:`bool`
+        If ``True``, do not make any changes.
+    """
+    process_tilegroup(tileid//1000, [tileid], release, survey, test_mode, workers=1)
     return
 
 
@@ -124,14 +353,43 @@ def main():
         log = get_logger(DEBUG)
     else:
         log = get_logger()
-    tileids = tiles(options.release, options.specprod, options.survey)
+    journal = None
+    finished = set()
+    if options.journal is not None and not options.test:
+        journal = MoveJournal(options.journal)
+        retried = journal.retry()
+        if retried > 0:
+            log.info("Retrying %d moves that failed in a previous run.", retried)
+        counts = journal.run(workers=options.workers)
+        if counts['linked'] + counts['failed'] > 0:
+            log.info("Completed %d moves pending from a previous run, %d failed.",
+                     counts['linked'], counts['failed'])
+        prefix = _tile_unit_prefix(options.survey)
+        finished = {int(u[len(prefix):]) for u in journal.completed() if u.startswith(prefix)}
+        log.debug("len(finished) == %d", len(finished))
+    columns = load_tiles(options.release, options.specprod, cache_dir=options.cache_dir)
+    tileids = select_tiles(columns, survey=options.survey,
+                           program=options.program.split(',') if options.program else None,
+                           ranges=parse_tile_ranges(options.tiles) if options.tiles else None,
+                           exclude=finished, limit=options.limit)
     log.debug("len(tileids) == %d", len(tileids))
-    if options.limit is None:
-        limit = len(tileids)
-    else:
-        limit = options.limit
-    for tileid in tileids[:limit]:
-        process_tile(tileid, options.release, options.survey, options.test)
+    groups = dict()
+    for tileid in tileids:
+        groups.setdefault(tileid//1000, list()).append(tileid)
+    t0 = time.time()
+    n_files = 0
+    for k, tilegroup in enumerate(sorted(groups)):
+        t1 = time.time()
+        n = process_tilegroup(tilegroup, groups[tilegroup], options.release, options.survey,
+                              options.test, workers=options.workers, journal=journal)
+        n_files += n
+        log.info("Tile group %03d (%d/%d): %d files for %d tiles in %.1f s.",
+                 tilegroup, k + 1, len(groups), n, len(groups[tilegroup]), time.time() - t1)
+    elapsed = time.time() - t0
+    log.info("Moved %d files for %d tiles in %.1f s (%.1f files/s).",
+             n_files, len(tileids), elapsed, n_files / elapsed if elapsed > 0 else 0.0)
+    if journal is not None:
+        journal.close()
     return 0
 
 
@@ -0,0 +1,169 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst.
+"""
+============
+desida.audit
+============
+
+Audit a spectroscopic production with a single pass over its directory tree.
+
+One walk of the tree is used to find directories that are missing their
+expected checksum file, files on disk that are not listed in any checksum
+file, entries in checksum files that have no corresponding file on disk,
+and checksum files that are older than the files they describe.
+"""
+import os
+import sys
+import csv
+import json
+from argparse import ArgumentParser
+from desiutil.log import log
+from .walker import walk
+from .checksum import checksum_name
+from .inventory import checksum_accounting, checksum_contents, ChecksumCache
+
+
+def _is_covered(dirpath, covered, top):
+    """Is `dirpath` inside a directory whose checksum file covers its whole tree?
+    """
+    d = os.path.dirname(dirpath)
+    while len(d) >= len(top):
+        if d in covered:
+            return True
+        d = os.path.dirname(d)
+    return False
+
+
+def audit_specprod(specprod, workers=None, cache=None, cext='.sha256sum'):
+    """Audit the checksum files of `specprod`.
+
+    Parameters
+    ----------
+    specprod : :class:`str`
+        The spectroscopic production run, *e.g.* ``iron``.
+    workers : :class:`int`, optional
+        Number of threads used to list directories.
+    cache : :class:`~desida.inventory.ChecksumCache`, optional
+        Use and update this cache of parsed checksum files.
+    cext : :class:`str`, optional
+        Use this filename extension to identify checksum files.
+
+    Returns
+    -------
+    :class:`dict`
+        A report with keys ``missing_checksums``, ``orphan_files``,
+        ``missing_files`` and ``stale_checksums``.
+    """
+    spectro = os.path.join(os.environ['DESI_ROOT'], 'spectro')
+    top = os.path.join(os.environ['DESI_SPECTRO_REDUX'], specprod)
+    directories = dict()
+    mtimes = dict()
+    checksums = dict()
+    missing_checksums = list()
+    covered = set()
+    for listing in walk(top, workers=workers, stat=True):
+        dirpath = listing.dirpath
+        if listing.filenames:
+            directories[dirpath] = listing.filenames
+        mtimes[dirpath] = {f: st.st_mtime_ns for f, st in listing.stats.items()}
+        for f in listing.filenames:
+            if os.path.splitext(f)[1] == cext:
+                ff = os.path.join(dirpath, f)
+                checksums[ff] = checksum_contents(ff, cache=cache)
+        #
+        # A checksum file in run/ covers the entire run/ tree.
+        #
+        if _is_covered(dirpath, covered, top):
+            continue
+        c = checksum_name(dirpath, spectro)
+        is_run = os.path.basename(dirpath) == 'run'
+        if c in listing.filenames:
+            if is_run:
+                covered.add(dirpath)
+        elif is_run or listing.filenames:
+            log.error("%s not found!", c)
+            missing_checksums.append(os.path.join(dirpath, c))
+    orphan_files, missing_files = checksum_accounting(directories, checksums)
+    stale_checksums = list()
+    for c, contents in checksums.items():
+        cd, cf = os.path.split(c)
+        c_mtime = mtimes[cd][cf]
+        newest, newest_mtime = None, c_mtime
+        for f in contents:
+            fd, ff = os.path.split(os.path.normpath(os.path.join(cd, f)))
+            m = mtimes.get(fd, {}).get(ff)
+            if m is not None and m > newest_mtime:
+                newest, newest_mtime = os.path.join(fd, ff), m
+        if newest is not None:
+            log.warning("%s is older than %s.", c, newest)
+            stale_checksums.append({'checksum': c, 'newest_file': newest,
+                                    'seconds': (newest_mtime - c_mtime) / 1e9})
+    return {'specprod': specprod,
+            'missing_checksums': sorted(missing_checksums),
+            'orphan_files': sorted(orphan_files),
+            'missing_files': sorted(missing_files),
+            'stale_checksums': sorted(stale_checksums, key=lambda s: s['checksum'])}
+
+
+def write_report(report, filename):
+    """Write an audit report as JSON or CSV, depending on the extension of `filename`.
+
+    Parameters
+    ----------
+    report : :class:`dict`
+        A report, as returned by :func:`audit_specprod`.
+    filename : :class:`str`
+        Output file.  If it ends with ``.csv``, write one row per problem.
+    """
+    if os.path.splitext(filename)[1] == '.csv':
+        with open(filename, 'w', newline='') as o:
+            writer = csv.writer(o)
+            writer.writerow(['PROBLEM', 'PATH', 'DETAIL'])
+            for key in ('missing_checksums', 'orphan_files', 'missing_files'):
+                for path in report[key]:
+                    writer.writerow([key, path, ''])
+            for s in report['stale_checksums']:
+                writer.writerow(['stale_checksums', s['checksum'], s['newest_file']])
+    else:
+        with open(filename, 'w') as o:
+            json.dump(report, o, indent=1)
+
+
+def _options():
+    """Parse command-line options.
+
+    Returns
+    -------
+    :class:`argparse.Namespace`
+        The parsed options.
+    """
+    prsr = ArgumentParser(prog=os.path.basename(sys.argv[0]),
+                          description='Audit the checksum files of a spectroscopic production in a single pass.')
+    prsr.add_argument('-c', '--cache', metavar='DIR',
+                      help='Cache parsed checksum files in DIR.')
+    prsr.add_argument('-o', '--output', metavar='FILE',
+                      help='Write the report to FILE, as CSV if FILE ends with .csv, otherwise as JSON.')
+    prsr.add_argument('-w', '--workers', type=int, metavar='N',
+                      help='Use N threads to list directories.')
+    prsr.add_argument('specprod', metavar='SPECPROD',
+                      help="Spectroscopic Production run name, e.g. 'iron'.")
+    return prsr.parse_args()
+
+
+def main():
+    """Entry-point for command-line scripts.
+
+    Returns
+    -------
+    :class:`int`
+        An integer suitable for passing to :func:`sys.exit`.
+    """
+    options = _options()
+    cache = ChecksumCache(options.cache) if options.cache else None
+    report = audit_specprod(options.specprod, workers=options.workers, cache=cache)
+    if options.output:
+        write_report(report, options.output)
+    for key in ('missing_checksums', 'orphan_files', 'missing_files', 'stale_checksums'):
+        log.info("%s: %d", key, len(report[key]))
+    n_problems = sum(len(report[key]) for key in ('missing_checksums', 'orphan_files',
+                                                   'missing_files', 'stale_checksums'))
+    return min(n_problems, 255)
@@ -7,16 +7,40 @@ desida.checksum
 Tools for working with checksum files.
 """
 import os
+from argparse import ArgumentParser
 from desiutil.log import log
+from .walker import walk
 
 
-def missing_specprod_checksums(specprod):
+def checksum_name(dirpath, spectro=None):
+    """Name of the checksum file expected in `dirpath`.
+
+    Parameters
+    ----------
+    dirpath : :class:`str`
+        A directory under ``${DESI_ROOT}/spectro``.
+    spectro : :class:`str`, optional
+        Override ``${DESI_ROOT}/spectro``.
+
+    Returns
+    -------
+    :class:`str`
+        The name of the checksum file, *e.g.* ``redux_iron_exposures_20210517_00088888.sha256sum``.
+    """
+    if spectro is None:
+        spectro = os.path.join(os.environ['DESI_ROOT'], 'spectro')
+    return dirpath.replace(spectro + '/', '').replace('/', '_') + '.sha256sum'
+
+
+def missing_specprod_checksums(specprod, workers=None):
     """Find missing checksum files in `specprod`.
 
     Parameters
     ----------
     specprod : :class:`str`
         The spectroscopic production run, *e.g.* ``iron``.
+    workers : :class:`int`, optional
+        Number of threads used to list directories.
 
     Returns
     -------
@@ -26,23 +50,46 @@ def missing_specprod_checksums(specprod):
     n_missing = 0
     spectro = os.path.join(os.environ['DESI_ROOT'], 'spectro')
     top = os.path.join(os.environ['DESI_SPECTRO_REDUX'], specprod)
-    for dirpath, dirnames, filenames in os.walk(top):
-        c = dirpath.replace(spectro + '/', '').replace('/', '_') + '.sha256sum'
-        if os.path.basename(dirpath) == 'run':
-            if os.path.exists(os.path.join(dirpath, c)):
+
+    def prune(listing):
+        #
+        # A checksum file in run/ covers the entire run/ tree.
+        #
+        return (os.path.basename(listing.dirpath) == 'run' and
+                checksum_name(listing.dirpath, spectro) in listing.filenames)
+
+    for listing in walk(top, workers=workers, prune=prune):
+        c = checksum_name(listing.dirpath, spectro)
+        if os.path.basename(listing.dirpath) == 'run':
+            if c in listing.filenames:
                 log.debug("%s exists.", c)
-                dirnames.clear()
             else:
                 log.error("%s not found!", c)
                 n_missing += 1
         else:
-            if filenames:
-                if not os.path.exists(os.path.join(dirpath, c)):
+            if listing.filenames:
+                if c not in listing.filenames:
                     log.error("%s not found!", c)
                     n_missing += 1
     return n_missing
 
 
+def _options():
+    """Parse command-line options.
+
+    Returns
+    -------
+    :class:`argparse.Namespace`
+        The parsed options.
+    """
+    prsr = ArgumentParser(description='Find missing checksum files in a spectroscopic production.')
+    prsr.add_argument('-w', '--workers', type=int, metavar='N',
+                      help='Use N threads to list directories.')
+    prsr.add_argument('specprod', metavar='SPECPROD', nargs='?', default='iron',
+                      help="Spectroscopic Production run name (default '%(default)s').")
+    return prsr.parse_args()
+
+
 def main():
     """Entry-point for command-line scripts.
 
@@ -51,6 +98,6 @@ def main():
     :class:`int`
         An integer suitable for passing to :func:`sys.exit`.
     """
-    specprod = 'iron'
-    n = missing_specprod_checksums(specprod)
+    options = _options()
+    n = missing_specprod_checksums(options.specprod, workers=options.workers)
     return n
@@ -0,0 +1,394 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst.
+"""
+====================
+desida.checksum_jobs
+====================
+
+Plan and run size-balanced checksum jobs for a spectroscopic production.
+
+``desi_checksum_specprod.sh`` writes one batch script per directory that
+needs a checksum file, which for a full production means tens of thousands
+of tiny jobs.  The planner in this module sizes every such directory and
+packs them into a fixed number of jobs with approximately equal numbers of
+bytes to read.  Each job carries a JSON manifest that is processed by a
+single in-job pool of hashing processes.
+"""
+import os
+import sys
+import json
+import stat
+import heapq
+import shutil
+import fnmatch
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from desiutil.log import log
+from .walker import walk, DirectoryListing
+from .verify import DEFAULT_BUFFER_SIZE, _hash_task, verify_manifests
+
+
+_batch_script = """#!/bin/bash
+#SBATCH --account=desi
+#SBATCH --qos=xfer
+#SBATCH --constraint=cron
+#SBATCH --time={time}
+#SBATCH --job-name={job_name}
+#SBATCH --output={jobs}/%x-%j.log
+#SBATCH --licenses=cfs,scratch
+source /global/common/software/desi/desi_environment.sh main
+module load desida desiBackup
+set -o xtrace
+desi_checksum_jobs run --scratch {scratch} {manifest} && mv {jobs}/{job_name}.sh {jobs}/done
+"""
+
+
+def _checksum_rule(parts, specprod, zcat_version='v1'):
+    """Determine which files in a directory are covered by a checksum file.
+
+    This encodes the layout used by ``desi_checksum_specprod.sh``.
+
+    Parameters
+    ----------
+    parts : :class:`tuple`
+        Path components of the directory, relative to the top of the specprod.
+    specprod : :class:`str`
+        The spectroscopic production run, *e.g.* ``iron``.
+    zcat_version : :class:`str`, optional
+        Version of the zcatalog directory.
+
+    Returns
+    -------
+    :class:`list` or ``None``
+        A list of filename patterns, or ``None`` if the directory does not
+        get its own checksum file.
+    """
+    n = len(parts)
+    if n == 0:
+        return [f'exposures-{specprod}.*', f'tiles-{specprod}.*', f'inventory-{specprod}.*']
+    top = parts[0]
+    if parts == ('healpix',):
+        return ['tilepix.*']
+    if top in ('calibnight', 'exposure_tables', 'nightqa') and n == 2:
+        return ['*']
+    if parts == ('processing_tables',):
+        return ['*']
+    if parts in (('zcatalog', zcat_version), ('zcatalog', zcat_version, 'logs')):
+        return ['*']
+    if top in ('exposures', 'preproc') and n == 3:
+        return ['*']
+    if top in ('healpix', 'tiles') and n >= 2:
+        return ['*']
+    return None
+
+
+def _scan_files(dirpath, stat=False, followlinks=False):
+    """List `dirpath` like :func:`desida.walker._scan`, keeping only regular files.
+
+    Symlinks and other special files are left out of the filenames, as
+    ``find -type f`` does in ``desi_checksum_specprod.sh``.
+
+    Parameters
+    ----------
+    dirpath : :class:`str`
+        Directory to list.
+    stat : :class:`bool`, optional
+        If ``True``, also :func:`~os.stat` every file.
+    followlinks : :class:`bool`, optional
+        If ``True``, descend into symlinks to directories.
+
+    Returns
+    -------
+    :class:`tuple`
+        A :class:`~desida.walker.DirectoryListing` and a :class:`list` of
+        subdirectory paths.
+    """
+    dirnames = list()
+    filenames = list()
+    stats = dict() if stat else None
+    descend = list()
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                dirnames.append(entry.name)
+                if followlinks or not entry.is_symlink():
+                    descend.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                filenames.append(entry.name)
+                if stat:
+                    stats[entry.name] = entry.stat(follow_symlinks=False)
+    return DirectoryListing(dirpath, dirnames, filenames, stats), descend
+
+
+def specprod_checksum_tasks(specprod, zcat_version='v1', workers=None):
+    """Find and size every directory in `specprod` that needs a checksum file.
+
+    Parameters
+    ----------
+    specprod : :class:`str`
+        The spectroscopic production run, *e.g.* ``iron``.
+    zcat_version : :class:`str`, optional
+        Version of the zcatalog directory.
+    workers : :class:`int`, optional
+        Number of threads used to list directories.
+
+    Returns
+    -------
+    :class:`list`
+        A list of :class:`dict`, one per checksum file, with keys ``checksum``
+        (full path to the checksum file), ``files`` (paths relative to the
+        directory containing the checksum file) and ``size`` (total bytes).
+
+    Notes
+    -----
+    Only regular files are included, as with ``find -type f``; symlinks are
+    not.  Outside of ``run/``, files whose names start with ``.`` are also
+    excluded, because the shell globs in ``desi_checksum_specprod.sh`` do not
+    match them.
+
+    The list of files is a snapshot taken when the jobs are planned, whereas
+    the batch scripts written by ``desi_checksum_specprod.sh`` expand their
+    globs when each job runs.  Files added to a directory after planning are
+    therefore not included in its checksum file, so the plan should be made
+    after the production is complete.
+    """
+    home = os.path.join(os.environ['DESI_SPECTRO_REDUX'], specprod)
+    run = os.path.join(home, 'run')
+    tasks = dict()
+    run_task = {'checksum': os.path.join(run, f'redux_{specprod}_run.sha256sum'),
+                'files': [], 'size': 0}
+    for listing in walk(home, workers=workers, stat=True, scanner=_scan_files):
+        rel = os.path.relpath(listing.dirpath, home)
+        parts = () if rel == '.' else tuple(rel.split(os.sep))
+        checksum = f'redux_{specprod}' + ''.join('_' + p for p in parts) + '.sha256sum'
+        if parts[:1] == ('run',):
+            #
+            # run/ is covered by a single, recursive checksum file.
+            #
+            for f in listing.filenames:
+                if parts == ('run',) and f == os.path.basename(run_task['checksum']):
+                    continue
+                run_task['files'].append(os.path.join('.', *parts[1:], f))
+                run_task['size'] += listing.stats[f].st_size
+            continue
+        patterns = _checksum_rule(parts, specprod, zcat_version)
+        if patterns is None:
+            continue
+        files = sorted(f for f in listing.filenames
+                       if f != checksum and not f.startswith('.')
+                       and any(fnmatch.fnmatch(f, p) for p in patterns))
+        if not files:
+            if parts[:1] in (('exposures',), ('preproc',)) and len(parts) == 3:
+                log.warning("%s is empty.", rel)
+            continue
+        tasks[listing.dirpath] = {'checksum': os.path.join(listing.dirpath, checksum),
+                                  'files': files,
+                                  'size': sum(listing.stats[f].st_size for f in files)}
+    if run_task['files']:
+        run_task['files'].sort()
+        tasks[run] = run_task
+    return [tasks[d] for d in sorted(tasks)]
+
+
+def pack_tasks(tasks, n_jobs):
+    """Pack checksum tasks into `n_jobs` jobs with approximately equal sizes.
+
+    Tasks are assigned, largest first, to the job with the fewest bytes.
+
+    Parameters
+    ----------
+    tasks : :class:`list`
+        Tasks, as returned by :func:`specprod_checksum_tasks`.
+    n_jobs : :class:`int`
+        Maximum number of jobs.
+
+    Returns
+    -------
+    :class:`list`
+        A list of non-empty lists of tasks.
+    """
+    n_jobs = max(1, min(n_jobs, len(tasks)))
+    jobs = [list() for j in range(n_jobs)]
+    heap = [(0, j) for j in range(n_jobs)]
+    for task in sorted(tasks, key=lambda t: t['size'], reverse=True):
+        size, j = heapq.heappop(heap)
+        jobs[j].append(task)
+        heapq.heappush(heap, (size + task['size'], j))
+    return [job for job in jobs if job]
+
+
+def write_checksum_jobs(jobs, specprod, jobs_dir, scratch, time='12:00:00'):
+    """Write a manifest and a batch script for each job.
+
+    Parameters
+    ----------
+    jobs : :class:`list`
+        Packed tasks, as returned by :func:`pack_tasks`.
+    specprod : :class:`str`
+        The spectroscopic production run, *e.g.* ``iron``.
+    jobs_dir : :class:`str`
+        Directory to write batch scripts and manifests.
+    scratch : :class:`str`
+        Directory for temporary files.
+    time : :class:`str`, optional
+        Time limit for each job.
+
+    Returns
+    -------
+    :class:`list`
+        The batch scripts written.
+    """
+    os.makedirs(os.path.join(jobs_dir, 'done'), exist_ok=True)
+    scripts = list()
+    for j, job in enumerate(jobs):
+        job_name = f'checksum_{specprod}_{j:03d}'
+        manifest = os.path.join(jobs_dir, job_name + '.json')
+        with open(manifest, 'w') as m:
+            json.dump(job, m, indent=1)
+        script = os.path.join(jobs_dir, job_name + '.sh')
+        with open(script, 'w') as s:
+            s.write(_batch_script.format(time=time, job_name=job_name, jobs=jobs_dir,
+                                         scratch=scratch, manifest=manifest))
+        os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR | stat.S_IXGRP)
+        log.info("%s: %d checksum files, %d bytes.", script, len(job), sum(t['size'] for t in job))
+        scripts.append(script)
+    return scripts
+
+
+def unlock_and_move(filename, directory):
+    """Move `filename` into read-only `directory` and make it read-only.
+
+    This is the equivalent of ``unlock_and_move`` in ``desida_library.sh``.
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        File to move.
+    directory : :class:`str`
+        Destination directory.
+    """
+    mode = os.stat(directory).st_mode
+    os.chmod(directory, mode | stat.S_IWUSR)
+    try:
+        dst = os.path.join(directory, os.path.basename(filename))
+        shutil.move(filename, dst)
+        os.chmod(dst, os.stat(dst).st_mode & ~stat.S_IWUSR)
+    finally:
+        os.chmod(directory, mode & ~stat.S_IWUSR)
+
+
+def run_checksum_job(tasks, scratch, processes=None, buffer_size=DEFAULT_BUFFER_SIZE):
+    """Create or validate the checksum files in one job.
+
+    Existing checksum files are validated together.  Otherwise, all files
+    are hashed by one pool of processes, and each checksum file is written
+    to `scratch` and then moved into place.
+
+    Parameters
+    ----------
+    tasks : :class:`list`
+        Tasks, as returned by :func:`specprod_checksum_tasks`.
+    scratch : :class:`str`
+        Directory for temporary files.
+    processes : :class:`int`, optional
+        Number of processes used to compute checksums.
+    buffer_size : :class:`int`, optional
+        Read files in chunks of this many bytes.
+
+    Returns
+    -------
+    :class:`int`
+        The number of checksum files that could not be created or validated.
+    """
+    n_failed = 0
+    existing = [t['checksum'] for t in tasks if os.path.exists(t['checksum'])]
+    if existing:
+        recursive = {c for c in existing if os.path.basename(os.path.dirname(c)) == 'run'}
+        report = verify_manifests(existing, processes=processes,
+                                  buffer_size=buffer_size, recursive=recursive)
+        n_failed += len(report['failed'])
+    new = [t for t in tasks if not os.path.exists(t['checksum'])]
+    hash_tasks = [(os.path.join(os.path.dirname(t['checksum']), f), None, buffer_size)
+                  for t in new for f in t['files']]
+    digests = dict()
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for filename, expected, digest, nbytes, error in executor.map(_hash_task, hash_tasks, chunksize=4):
+            if digest is None:
+                log.error("Could not read %s: %s", filename, error)
+            digests[filename] = digest
+    for t in new:
+        d = os.path.dirname(t['checksum'])
+        lines = list()
+        for f in t['files']:
+            digest = digests[os.path.join(d, f)]
+            if digest is None:
+                break
+            lines.append(f"{digest}  {f}\n")
+        else:
+            tmp = os.path.join(scratch, os.path.basename(t['checksum']))
+            with open(tmp, 'w') as s:
+                s.writelines(lines)
+            unlock_and_move(tmp, d)
+            log.info("Created %s.", t['checksum'])
+            continue
+        log.error("Not creating %s!", t['checksum'])
+        n_failed += 1
+    return n_failed
+
+
+def _options():
+    """Parse command-line options.
+
+    Returns
+    -------
+    :class:`argparse.Namespace`
+        The parsed options.
+    """
+    prsr = ArgumentParser(prog=os.path.basename(sys.argv[0]),
+                          description='Plan and run size-balanced checksum jobs for a spectroscopic production.')
+    subparsers = prsr.add_subparsers(dest='command', required=True)
+    plan = subparsers.add_parser('plan', help='Write batch scripts for SPECPROD.')
+    plan.add_argument('-j', '--jobs', metavar='DIR',
+                      default=os.path.join(os.environ.get('DESI_ROOT', '.'), 'users', os.environ.get('USER', ''), 'jobs'),
+                      help='Write batch files to DIR (default %(default)s).')
+    plan.add_argument('-n', '--n-jobs', type=int, default=20, metavar='N',
+                      help='Pack checksum files into at most N jobs (default %(default)s).')
+    plan.add_argument('-s', '--scratch', metavar='DIR', default=os.environ.get('SCRATCH'),
+                      help='Use DIR for temporary files (default %(default)s).')
+    plan.add_argument('-T', '--time', default='12:00:00', metavar='TIME',
+                      help='Time limit for each job (default %(default)s).')
+    plan.add_argument('-w', '--workers', type=int, metavar='N',
+                      help='Use N threads to list directories.')
+    plan.add_argument('-z', '--zcat-version', default='v1', metavar='VERSION',
+                      help='Version of zcatalog (default %(default)s).')
+    plan.add_argument('specprod', metavar='SPECPROD',
+                      help="Spectroscopic Production run name, e.g. 'iron'.")
+    run = subparsers.add_parser('run', help='Create or validate the checksum files in MANIFEST.')
+    run.add_argument('-p', '--processes', type=int, metavar='N',
+                     help='Use N processes to compute checksums (default is the number of CPUs).')
+    run.add_argument('-s', '--scratch', metavar='DIR', default=os.environ.get('SCRATCH'),
+                     help='Use DIR for temporary files (default %(default)s).')
+    run.add_argument('manifest', metavar='MANIFEST', help='Job manifest written by the plan command.')
+    return prsr.parse_args()
+
+
+def main():
+    """Entry-point for command-line scripts.
+
+    Returns
+    -------
+    :class:`int`
+        An integer suitable for passing to :func:`sys.exit`.
+    """
+    options = _options()
+    if options.command == 'plan':
+        tasks = specprod_checksum_tasks(options.specprod, options.zcat_version, options.workers)
+        jobs = pack_tasks(tasks, options.n_jobs)
+        write_checksum_jobs(jobs, options.specprod, options.jobs, options.scratch, options.time)
+        return 0
+    with open(options.manifest) as m:
+        tasks = json.load(m)
+    return min(run_checksum_job(tasks, options.scratch, options.processes), 255)
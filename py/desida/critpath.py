@@ -0,0 +1,236 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst.
+"""
+===============
+desida.critpath
+===============
+
+Critical path and dependency stalls of a production.
+
+The job dependency DAG is built from the INTID and INT_DEP_IDS columns of
+the proctables, and joined with queue info via LATEST_QID.  For each job the
+wall-clock time is split into:
+
+* stall: SUBMIT to ELIGIBLE, blocked on dependencies;
+* queue wait: ELIGIBLE to START;
+* run: START to END.
+
+The critical path is traced back from the last job to finish, following
+at each step the dependency that finished last.  zpix jobs are included,
+but their dependencies are not recorded in the proctables.
+"""
+
+import os, argparse
+import numpy as np
+from astropy.table import Table
+
+from desiutil.log import get_logger
+
+from desida.prodjobs import load_proctable_jobs, load_qinfo, split_ids, group_codes
+from desida.jobstats import sacct_times
+
+def job_dag(jobs, qinfo):
+    """
+    Join proctable jobs with their queue info
+
+    Args:
+        jobs: Table from prodjobs.load_proctable_jobs
+        qinfo: Table from prodjobs.load_qinfo
+
+    Returns Table with one row per job and columns NIGHT,INTID,JOBDESC,QID,
+    INT_DEP_IDS,CRIT_DEP,STATE,SUBMIT,ELIGIBLE,START,END,STALL_HOURS,QUEUE_HOURS,
+    RUN_HOURS.  CRIT_DEP is the row index of the dependency that finished
+    last, or -1.  zpix jobs have INTID -1.  Hours are 0 when the times are unknown.
+    """
+    log = get_logger()
+
+    #- proctable jobs plus zpix jobs from qinfo
+    zpix = np.asarray(qinfo['JOBDESC']) == 'zpix'
+    nzpix = np.count_nonzero(zpix)
+    dag = Table()
+    dag['NIGHT'] = np.concatenate([np.asarray(jobs['NIGHT'], dtype=np.int32),
+                                   np.asarray(qinfo['NIGHT'], dtype=np.int32)[zpix]
+                                   if 'NIGHT' in qinfo.colnames else np.zeros(nzpix, dtype=np.int32)])
+    dag['INTID'] = np.concatenate([np.asarray(jobs['INTID'], dtype=np.int64),
+                                   np.full(nzpix, -1, dtype=np.int64)])
+    dag['JOBDESC'] = np.concatenate([np.asarray(jobs['JOBDESC'], dtype=str),
+                                     np.asarray(qinfo['JOBDESC'], dtype=str)[zpix]])
+    dag['QID'] = np.concatenate([np.asarray(jobs['LATEST_QID'], dtype=np.int64),
+                                 np.asarray(qinfo['JOBID'], dtype=np.int64)[zpix]])
+    dag['INT_DEP_IDS'] = np.concatenate([np.asarray(jobs['INT_DEP_IDS'], dtype=str),
+                                         np.full(nzpix, '')])
+    n = len(dag)
+
+    #- queue info of each job via its QID; first row if listed more than once
+    qids, first = np.unique(np.asarray(qinfo['JOBID'], dtype=np.int64), return_index=True)
+    qrow = np.full(n, -1, dtype=np.int64)
+    if len(qids) > 0:
+        i = np.searchsorted(qids, dag['QID']).clip(max=len(qids)-1)
+        found = qids[i] == dag['QID']
+        qrow[found] = first[i[found]]
+    known = qrow >= 0
+    log.info(f'Found queue info for {np.count_nonzero(known)} of {n} jobs')
+
+    times = dict()
+    for col in ('STATE', 'SUBMIT', 'ELIGIBLE', 'START', 'END'):
+        values = np.full(n, '', dtype=np.asarray(qinfo[col]).astype(str).dtype if len(qinfo) > 0 else 'U1')
+        values[known] = np.asarray(qinfo[col]).astype(str)[qrow[known]]
+        dag[col] = values
+        if col != 'STATE':
+            times[col] = sacct_times(values)
+
+    def hours(a, b):
+        (ta, oka), (tb, okb) = times[a], times[b]
+        return np.where(oka & okb, np.maximum(tb - ta, 0), 0) / 3600.
+
+    dag['STALL_HOURS'] = hours('SUBMIT', 'ELIGIBLE').round(4)
+    dag['QUEUE_HOURS'] = hours('ELIGIBLE', 'START').round(4)
+    dag['RUN_HOURS'] = hours('START', 'END').round(4)
+
+    #- dependency edges child -> parent, by INTID
+    intids = np.asarray(dag['INTID'])
+    child = list()
+    parent_intid = list()
+    for i, deps in enumerate(dag['INT_DEP_IDS']):
+        for d in split_ids(deps):
+            child.append(i)
+            parent_intid.append(d)
+    child = np.array(child, dtype=np.int64)
+    parent_intid = np.array(parent_intid, dtype=np.int64)
+
+    sorted_intids = np.argsort(intids, kind='stable')
+    parent = np.full(len(child), -1, dtype=np.int64)
+    if len(child) > 0 and n > 0:
+        i = np.searchsorted(intids[sorted_intids], parent_intid).clip(max=n-1)
+        found = intids[sorted_intids][i] == parent_intid
+        parent[found] = sorted_intids[i[found]]
+        if np.count_nonzero(~found) > 0:
+            log.warning(f'{np.count_nonzero(~found)} dependencies are not in the proctables')
+
+    #- critical dependency: the parent that finished last
+    end, end_ok = times['END']
+    ok = (parent >= 0)
+    ok[ok] &= end_ok[parent[ok]]
+    child, parent = child[ok], parent[ok]
+    crit = np.full(n, -1, dtype=np.int64)
+    if len(child) > 0:
+        order = np.lexsort((end[parent], child))
+        child, parent = child[order], parent[order]
+        last = np.append(child[1:] != child[:-1], True)
+        crit[child[last]] = parent[last]
+    dag['CRIT_DEP'] = crit
+
+    return dag
+
+def critical_path(dag):
+    """
+    Return the critical path of a production
+
+    Args:
+        dag: Table from job_dag
+
+    Returns Table of the jobs on the critical path in time order, with the
+    columns of `dag` plus ROW, the row index in `dag`, and GAP_HOURS, the time
+    from the end of the previous job on the path to SUBMIT, e.g. from a
+    manual resubmission.
+    """
+    end, end_ok = sacct_times(dag['END'])
+    if not np.any(end_ok):
+        path = np.zeros(0, dtype=np.int64)
+    else:
+        i = int(np.argmax(np.where(end_ok, end, np.iinfo(np.int64).min)))
+        path = list()
+        seen = set()
+        crit = np.asarray(dag['CRIT_DEP'])
+        while i >= 0 and i not in seen:
+            seen.add(i)
+            path.append(i)
+            i = int(crit[i])
+        path = np.array(path[::-1], dtype=np.int64)
+
+    t = dag[path]
+    t['ROW'] = path
+    submit, submit_ok = sacct_times(t['SUBMIT'])
+    prev_end = np.concatenate([[0,], end[path][:-1]]) if len(path) > 0 else np.zeros(0, dtype=np.int64)
+    prev_ok = np.concatenate([[False,], end_ok[path][:-1]]) if len(path) > 0 else np.zeros(0, dtype=bool)
+    t['GAP_HOURS'] = (np.where(submit_ok & prev_ok, np.maximum(submit - prev_end, 0), 0) / 3600.).round(4)
+    return t
+
+def stage_summary(dag, path):
+    """
+    Return stall, queue wait and run hours per JOBDESC, overall and on the critical path
+
+    Args:
+        dag: Table from job_dag
+        path: Table from critical_path
+
+    Returns Table with columns JOBDESC,NJOBS,STALL_HOURS,QUEUE_HOURS,RUN_HOURS,
+    CRIT_NJOBS,CRIT_GAP_HOURS,CRIT_STALL_HOURS,CRIT_QUEUE_HOURS,CRIT_RUN_HOURS
+    """
+    codes, first = group_codes(dag, ['JOBDESC',])
+    ngroups = len(first)
+    oncrit = np.zeros(len(dag), dtype=bool)
+    oncrit[np.asarray(path['ROW'])] = True
+    gap = np.zeros(len(dag))
+    gap[np.asarray(path['ROW'])] = path['GAP_HOURS']
+
+    t = Table()
+    t['JOBDESC'] = np.asarray(dag['JOBDESC'])[first]
+    t['NJOBS'] = np.bincount(codes, minlength=ngroups)
+    for col in ('STALL_HOURS', 'QUEUE_HOURS', 'RUN_HOURS'):
+        t[col] = np.bincount(codes, weights=np.asarray(dag[col]), minlength=ngroups).round(2)
+    t['CRIT_NJOBS'] = np.bincount(codes[oncrit], minlength=ngroups)
+    t['CRIT_GAP_HOURS'] = np.bincount(codes[oncrit], weights=gap[oncrit], minlength=ngroups).round(2)
+    for col in ('STALL_HOURS', 'QUEUE_HOURS', 'RUN_HOURS'):
+        t['CRIT_'+col] = np.bincount(codes[oncrit], weights=np.asarray(dag[col])[oncrit],
+                                     minlength=ngroups).round(2)
+    return t
+
+def parse(options=None):
+    p = argparse.ArgumentParser(description="Critical path and dependency stalls of a production")
+    p.add_argument('-i', '--input', help="input table of jobs (from desi_eval_prod_jobs --output)")
+    p.add_argument('-o', '--output', help="output table of all jobs with stall, queue and run hours")
+    p.add_argument('--path', help="output table of the jobs on the critical path")
+    p.add_argument('--summary', help="output table of hours per JOBDESC")
+    p.add_argument('-s', '--specprod', help="override $SPECPROD")
+    p.add_argument('--cache-dir', help="cache consolidated proctables and job records in this directory")
+    p.add_argument('--nproc', type=int, default=8, help="number of threads for reading proctables")
+    p.add_argument('--overwrite', action="store_true", help="Overwrite pre-existing output files")
+    args = p.parse_args(options)
+    return args
+
+def main(args=None):
+    if not isinstance(args, argparse.Namespace):
+        args = parse(args)
+
+    specprod = args.specprod if args.specprod is not None else os.environ['SPECPROD']
+    cachefile = None
+    if args.cache_dir is not None:
+        os.makedirs(args.cache_dir, exist_ok=True)
+        cachefile = os.path.join(args.cache_dir, f'proctables-{specprod}.fits')
+    jobs = load_proctable_jobs(specprod, cachefile=cachefile, nproc=args.nproc)
+
+    if args.input is not None:
+        qinfo = Table.read(args.input)
+        #- FITS string columns are read as bytes
+        qinfo.convert_bytestring_to_unicode()
+    else:
+        qinfo = load_qinfo(specprod, cachedir=args.cache_dir, nproc=args.nproc)
+
+    dag = job_dag(jobs, qinfo)
+    path = critical_path(dag)
+    summary = stage_summary(dag, path)
+
+    for filename, t in ((args.output, dag), (args.path, path), (args.summary, summary)):
+        if filename is not None:
+            t.write(filename, overwrite=args.overwrite)
+
+    if len(path) > 0:
+        start, _ = sacct_times(path['SUBMIT'][0:1])
+        end, _ = sacct_times(path['END'][-1:])
+        print(f'Critical path: {len(path)} jobs, {(end[0]-start[0])/3600.:.1f} hours from '
+              f'{path["SUBMIT"][0]} to {path["END"][-1]}')
+    print(summary)
+    return 0
+
+if __name__ == '__main__':
+    main()
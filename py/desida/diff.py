@@ -0,0 +1,211 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst.
+"""
+===========
+desida.diff
+===========
+
+Compare two directory trees using only their checksum files.
+
+For example, compare ``${DESI_SPECTRO_REDUX}/${SPECPROD}`` with
+``${DESI_ROOT}/public/${release}/spectro/redux/${SPECPROD}``, or ``daily``
+with a frozen production.  The entries of all checksum files in each tree
+are merged into a single stream sorted by path, and the two streams are
+merge-joined, so no data files are read and only the checksum files of
+nested directories need to be held in memory at any one time.
+"""
+import os
+import sys
+import csv
+import heapq
+from argparse import ArgumentParser
+from desiutil.log import log
+from .walker import walk
+from .inventory import iter_checksum_contents, ChecksumCache
+
+
+def find_manifests(root, workers=None, cext='.sha256sum'):
+    """Find all checksum files in the tree at `root`.
+
+    Parameters
+    ----------
+    root : :class:`str`
+        The root of the directory tree.
+    workers : :class:`int`, optional
+        Number of threads used to list directories.
+    cext : :class:`str`, optional
+        Use this filename extension to identify checksum files.
+
+    Returns
+    -------
+    :class:`list`
+        Paths to the checksum files, relative to `root`, sorted.
+    """
+    manifests = list()
+    for listing in walk(root, workers=workers):
+        rel = os.path.relpath(listing.dirpath, root)
+        for f in listing.filenames:
+            if os.path.splitext(f)[1] == cext:
+                manifests.append(os.path.normpath(os.path.join(rel, f)))
+    return sorted(manifests, key=lambda m: _dir_prefix(m))
+
+
+def _dir_prefix(manifest):
+    """Lower bound of the relative paths described by `manifest`.
+    """
+    d = os.path.dirname(manifest)
+    return d + '/' if d else ''
+
+
+def _entries(root, manifest, cache=None):
+    """Return the sorted (path, checksum) entries of a single checksum file.
+    """
+    d = os.path.dirname(manifest)
+    filename = os.path.join(root, manifest)
+    if cache is not None:
+        contents = cache.get(filename)
+        if contents is None:
+            contents = dict(iter_checksum_contents(filename))
+            cache.put(filename, contents)
+        contents = contents.items()
+    else:
+        contents = iter_checksum_contents(filename)
+    entries = list()
+    for f, digest in contents:
+        p = os.path.normpath(os.path.join(d, f))
+        if not p.startswith(_dir_prefix(manifest)):
+            log.warning("%s lists %s outside its own directory; it may be reported out of order.",
+                        filename, f)
+        entries.append((p, digest))
+    entries.sort()
+    return entries
+
+
+def iter_tree_checksums(root, manifests=None, workers=None, cache=None):
+    """Iterate over the entries of all checksum files in `root`, sorted by path.
+
+    Checksum files are only read when the merge reaches their directory,
+    so the number of checksum files held in memory is limited by the depth
+    of nesting, not the size of the tree.
+
+    Parameters
+    ----------
+    root : :class:`str`
+        The root of the directory tree.
+    manifests : :class:`list`, optional
+        Checksum files relative to `root`, as returned by :func:`find_manifests`.
+    workers : :class:`int`, optional
+        Number of threads used to list directories.
+    cache : :class:`~desida.inventory.ChecksumCache`, optional
+        Use and update this cache of parsed checksum files.
+
+    Yields
+    ------
+    :class:`tuple`
+        Path relative to `root` and checksum.
+    """
+    if manifests is None:
+        manifests = find_manifests(root, workers=workers)
+    heap = list()
+    m = 0
+    while m < len(manifests) or heap:
+        #
+        # Every entry of a checksum file sorts after its directory prefix,
+        # so a checksum file only needs to be read once the smallest
+        # pending path reaches that prefix.
+        #
+        while m < len(manifests) and (not heap or _dir_prefix(manifests[m]) <= heap[0][0]):
+            it = iter(_entries(root, manifests[m], cache))
+            first = next(it, None)
+            if first is not None:
+                heapq.heappush(heap, (first[0], first[1], m, it))
+            m += 1
+        if not heap:
+            continue
+        path, digest, k, it = heapq.heappop(heap)
+        yield path, digest
+        nxt = next(it, None)
+        if nxt is not None:
+            heapq.heappush(heap, (nxt[0], nxt[1], k, it))
+
+
+def diff_trees(old, new, workers=None, cache=None):
+    """Compare the checksum files of two directory trees.
+
+    Parameters
+    ----------
+    old, new : :class:`str`
+        Roots of the two directory trees.
+    workers : :class:`int`, optional
+        Number of threads used to list directories.
+    cache : :class:`~desida.inventory.ChecksumCache`, optional
+        Use and update this cache of parsed checksum files.
+
+    Yields
+    ------
+    :class:`tuple`
+        Status (``'added'``, ``'removed'`` or ``'changed'``), path relative
+        to the roots, old checksum (or ``None``) and new checksum (or ``None``).
+    """
+    a = iter_tree_checksums(old, workers=workers, cache=cache)
+    b = iter_tree_checksums(new, workers=workers, cache=cache)
+    x = next(a, None)
+    y = next(b, None)
+    while x is not None or y is not None:
+        if y is None or (x is not None and x[0] < y[0]):
+            yield 'removed', x[0], x[1], None
+            x = next(a, None)
+        elif x is None or y[0] < x[0]:
+            yield 'added', y[0], None, y[1]
+            y = next(b, None)
+        else:
+            if x[1] != y[1]:
+                yield 'changed', x[0], x[1], y[1]
+            x = next(a, None)
+            y = next(b, None)
+
+
+def _options():
+    """Parse command-line options.
+
+    Returns
+    -------
+    :class:`argparse.Namespace`
+        The parsed options.
+    """
+    prsr = ArgumentParser(prog=os.path.basename(sys.argv[0]),
+                          description='Compare two directory trees using their checksum files.')
+    prsr.add_argument('-c', '--cache', metavar='DIR',
+                      help='Cache parsed checksum files in DIR.')
+    prsr.add_argument('-o', '--output', metavar='FILE',
+                      help='Write differences to FILE as CSV (default is standard output).')
+    prsr.add_argument('-w', '--workers', type=int, metavar='N',
+                      help='Use N threads to list directories.')
+    prsr.add_argument('old', metavar='OLD', help='Root of the first directory tree.')
+    prsr.add_argument('new', metavar='NEW', help='Root of the second directory tree.')
+    return prsr.parse_args()
+
+
+def main():
+    """Entry-point for command-line scripts.
+
+    Returns
+    -------
+    :class:`int`
+        An integer suitable for passing to :func:`sys.exit`.
+    """
+    options = _options()
+    cache = ChecksumCache(options.cache) if options.cache else None
+    out = open(options.output, 'w', newline='') if options.output else sys.stdout
+    counts = {'added': 0, 'removed': 0, 'changed': 0}
+    try:
+        writer = csv.writer(out)
+        writer.writerow(['STATUS', 'PATH', 'OLD', 'NEW'])
+        for status, path, old, new in diff_trees(options.old, options.new,
+                                                 workers=options.workers, cache=cache):
+            counts[status] += 1
+            writer.writerow([status, path, old or '', new or ''])
+    finally:
+        if options.output:
+            out.close()
+    log.info("%d added, %d removed, %d changed.", counts['added'], counts['removed'], counts['changed'])
+    return 0 if sum(counts.values()) == 0 else 1
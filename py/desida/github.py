@@ -12,15 +12,21 @@ Adapted from code originally written by the LBL CBorg AI coder
 """
 
 import argparse
+import base64
 import csv
+import hashlib
+import json
 import os
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from urllib.parse import urlparse
 import re
 
 import requests
+from requests.structures import CaseInsensitiveDict
 
 # Optional import – only needed for Markdown tables
 try:
@@ -29,7 +35,12 @@ except ImportError:
     tabulate = None
 
 
-GITHUB_API = "https://api.github.com"
+# GITHUB_API_URL can point to GitHub Enterprise or to a local test server
+GITHUB_API = os.getenv("GITHUB_API_URL", "https://api.github.com").rstrip("/")
+GITHUB_GRAPHQL = os.getenv("GITHUB_GRAPHQL_URL", f"{GITHUB_API}/graphql")
+# Number of repos per aliased GraphQL query
+GRAPHQL_BATCH = 25
+DEFAULT_WORKERS = 8
 HEADERS = {
     "Accept": "application/vnd.github.v3+json",
     # Authorization header will be added later if a token is supplied
@@ -109,27 +120,442 @@ def extract_owner_repo(url: str) -> tuple[str, str]:
     return owner, repo
 
 
-def request_with_retry(url: str, headers: dict, params: dict | None = None) -> requests.Response:
+def auth_id(authorization: str | None) -> str:
+    """Return an identifier of an Authorization header that does not reveal it, "" if none"""
+    return hashlib.sha256(authorization.encode()).hexdigest() if authorization else ""
+
+
+class HTTPCache:
+    """Directory of cached HTTP responses, one JSON file per request
+
+    Args:
+        directory (str): cache directory, created if needed
+
+    Options:
+        ttl (float): reuse responses younger than this many seconds without
+            revalidating them; default None always revalidates
+    """
+
+    def __init__(self, directory: str, ttl: float | None = None):
+        self.directory = os.path.expanduser(directory)
+        self.ttl = ttl
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self, request: requests.PreparedRequest) -> str:
+        """Return cache key for a request
+
+        The key depends on the full URL, including query parameters, the
+        Accept header and the identity (not the value) of any Authorization,
+        since different credentials may see different responses.  With a
+        RateLimitScheduler, this is the Authorization given by the caller,
+        before the scheduler picks a token.
+        """
+        parts = [request.method or "GET", request.url or "",
+                 request.headers.get("Accept", ""),
+                 auth_id(request.headers.get("Authorization"))]
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+    def _filename(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".json")
+
+    def load(self, key: str) -> dict | None:
+        """Return cached entry for `key`, or None"""
+        try:
+            with open(self._filename(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def store(self, key: str, url: str, response: requests.Response) -> dict:
+        """Store `response` for `key`, returning the new entry
+
+        The entry records the identity of the Authorization that fetched it,
+        since GitHub ETags depend on it.
+        """
+        entry = {
+            "url": url,
+            "auth": auth_id(response.request.headers.get("Authorization")),
+            "stored": time.time(),
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "headers": dict(response.headers),
+            "body": base64.b64encode(response.content).decode("ascii"),
+        }
+        self._write(key, entry)
+        return entry
+
+    def touch(self, key: str, entry: dict) -> None:
+        """Mark `entry` as revalidated now"""
+        entry["stored"] = time.time()
+        self._write(key, entry)
+
+    def _write(self, key: str, entry: dict) -> None:
+        filename = self._filename(key)
+        tmpfile = f"{filename}.{os.getpid()}.{id(entry)}.tmp"
+        with open(tmpfile, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+        os.replace(tmpfile, filename)
+
+    def is_fresh(self, entry: dict) -> bool:
+        """Can `entry` be used without revalidating it?"""
+        return self.ttl is not None and time.time() - entry["stored"] < self.ttl
+
+    @staticmethod
+    def conditional_headers(entry: dict) -> dict:
+        """Return headers to revalidate `entry`"""
+        hdrs = {}
+        if entry.get("etag"):
+            hdrs["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            hdrs["If-Modified-Since"] = entry["last_modified"]
+        return hdrs
+
+    @staticmethod
+    def response(entry: dict, request: requests.PreparedRequest) -> requests.Response:
+        """Rebuild a 200 response from `entry`"""
+        resp = requests.Response()
+        resp.status_code = 200
+        resp.reason = "OK"
+        resp.url = entry["url"]
+        resp.request = request
+        resp.headers = CaseInsensitiveDict(entry["headers"])
+        resp.headers.pop("Content-Encoding", None)
+        resp._content = base64.b64decode(entry["body"])
+        resp.encoding = requests.utils.get_encoding_from_headers(resp.headers) or "utf-8"
+        resp.from_cache = True
+        return resp
+
+
+# resource: (limit with a token, limit without, window in seconds), used
+# until the X-RateLimit-* headers of a response give the actual values
+RATE_LIMIT_DEFAULTS = {
+    "core": (5000, 60, 3600),
+    "search": (30, 10, 60),
+    "graphql": (5000, 0, 3600),
+}
+
+
+def rate_limit_resource(url: str) -> str:
+    """Return the rate-limit resource ("core", "search" or "graphql") of a request url"""
+    path = urlparse(url).path
+    if path.endswith("/graphql"):
+        return "graphql"
+    if "/search/" in path:
+        return "search"
+    return "core"
+
+
+class RateLimitBudget:
+    """Requests left for one token and resource until its limit resets
+
+    GitHub limits are fixed windows: `remaining` requests until `reset`, then
+    the full `limit` again.  The budget is spent freely until only
+    `pace_fraction` of the limit is left, then the rest is spread evenly until
+    the reset, and when it is used up requests wait for the reset.  Until a
+    response has given the actual limits of a window, only one request is
+    sent at a time.
+
+    Args:
+        limit (int): requests per window
+        window (float): window length in seconds
+
+    Options:
+        pace_fraction (float): fraction of the limit that is paced
+    """
+
+    def __init__(self, limit: int, window: float, pace_fraction: float = 0.1):
+        self.limit = limit
+        self.window = window
+        self.pace_fraction = pace_fraction
+        self.remaining = limit
+        self.reset = time.time() + window
+        self.known = False
+        self.inflight = 0
+        self.last_sent = 0.0
+        self.hold_until = 0.0
+
+    def available(self, now: float) -> int:
+        """Return requests that can still be sent before the reset"""
+        if now >= self.reset:
+            # the next response gives the actual reset time of the new window
+            self.remaining = self.limit
+            self.reset = now + self.window
+            self.known = False
+        return self.remaining - self.inflight
+
+    def wait(self, now: float) -> float | None:
+        """Return seconds to wait before the next request, or None to wait for a response"""
+        if not self.known and self.inflight > 0:
+            return None
+        avail = self.available(now)
+        if avail <= 0:
+            # 1 second margin for clock differences
+            return self.reset - now + 1
+        wait = self.hold_until - now
+        if avail <= self.pace_fraction * self.limit:
+            wait = max(wait, self.last_sent + (self.reset - self.last_sent) / avail - now)
+        return max(0.0, wait)
+
+    def take(self, now: float) -> None:
+        """Record a request sent at `now`"""
+        self.inflight += 1
+        self.last_sent = now
+
+    def update(self, headers) -> None:
+        """Update from the X-RateLimit-* headers of a response"""
+        try:
+            limit = int(headers["X-RateLimit-Limit"])
+            remaining = int(headers["X-RateLimit-Remaining"])
+            reset = int(headers["X-RateLimit-Reset"])
+        except (KeyError, ValueError):
+            return
+        if not self.known or reset != int(self.reset):
+            # new window; responses within a window may arrive out of order
+            self.reset = reset
+            self.remaining = remaining
+        else:
+            self.remaining = min(self.remaining, remaining)
+        self.limit = limit
+        self.known = True
+
+
+class RateLimitScheduler:
+    """Pace requests of many threads within the rate limits of one or more tokens
+
+    Each (token, resource) pair has its own RateLimitBudget, updated from
+    every response, so that e.g. the search budget is spent independently of
+    the core budget.  Each request uses the token that can send it soonest.
+
+    Options:
+        tokens (list of str): GitHub tokens; default None sends requests without a token
+        pace_fraction (float): fraction of each limit that is paced, see RateLimitBudget
+    """
+
+    def __init__(self, tokens: list[str] | None = None, pace_fraction: float = 0.1):
+        self.tokens = list(tokens) if tokens else [None]
+        self.pace_fraction = pace_fraction
+        self._budgets = {}
+        self._cond = threading.Condition()
+
+    def budget(self, index: int, resource: str) -> RateLimitBudget:
+        """Return the budget of token `index` for `resource`"""
+        key = (index, resource)
+        if key not in self._budgets:
+            with_token, without_token, window = RATE_LIMIT_DEFAULTS.get(resource, RATE_LIMIT_DEFAULTS["core"])
+            limit = with_token if self.tokens[index] else without_token
+            self._budgets[key] = RateLimitBudget(limit, window, self.pace_fraction)
+        return self._budgets[key]
+
+    def token_index(self, auth: str | None) -> int | None:
+        """Return the index of the token with Authorization identity `auth` (see auth_id), or None"""
+        for i, token in enumerate(self.tokens):
+            if auth_id(f"token {token}" if token else None) == auth:
+                return i
+        return None
+
+    def acquire(self, resource: str, prefer: int | None = None) -> int:
+        """Wait until a request to `resource` can be sent, and return the index of the token to use
+
+        The token with index `prefer`, if given, is used whenever its budget
+        allows a request as soon as any other token's.
+        """
+        announced = False
+        with self._cond:
+            while True:
+                now = time.time()
+                waits = list()
+                for i in range(len(self.tokens)):
+                    budget = self.budget(i, resource)
+                    wait = budget.wait(now)
+                    if wait is not None:
+                        waits.append((wait, -budget.available(now), i))
+                if not waits:
+                    # wait for the first response to give the actual limits
+                    self._cond.wait()
+                    continue
+                wait, _, index = min(waits)
+                if prefer is not None and any(w[2] == prefer and w[0] <= max(wait, 0) for w in waits):
+                    index = prefer
+                if wait <= 0:
+                    self.budget(index, resource).take(now)
+                    return index
+                if wait > 5 and not announced:
+                    print(f"[INFO] Rate limit: waiting {wait:.0f}s for {resource} budget", file=sys.stderr)
+                    announced = True
+                self._cond.wait(timeout=wait)
+
+    def release(self, index: int, resource: str, response: requests.Response | None = None) -> None:
+        """Record the end of a request started with acquire, and its response if any"""
+        with self._cond:
+            budget = self.budget(index, resource)
+            budget.inflight -= 1
+            if response is not None:
+                budget.update(response.headers)
+                retry_after = response.headers.get("Retry-After")
+                if response.status_code in (403, 429) and retry_after:
+                    # secondary rate limit
+                    budget.hold_until = max(budget.hold_until, time.time() + int(retry_after))
+            self._cond.notify_all()
+
+
+class RateLimitedAdapter(requests.adapters.HTTPAdapter):
+    """Transport adapter that sends requests through a RateLimitScheduler
+
+    Options:
+        scheduler (RateLimitScheduler): the scheduler; default None sends
+            requests immediately
+
+    Other arguments are passed to requests.adapters.HTTPAdapter.  With a
+    scheduler, the Authorization header is set to the token it chose.
+    """
+
+    def __init__(self, *args, scheduler: RateLimitScheduler | None = None, **kwargs):
+        self.scheduler = scheduler
+        super().__init__(*args, **kwargs)
+
+    def send(self, request, **kwargs):
+        return self._send(request, None, **kwargs)
+
+    def _send(self, request, auth: str | None, **kwargs):
+        """Send `request` with the scheduler's token of identity `auth` (see auth_id), if it has one"""
+        if self.scheduler is None:
+            return super().send(request, **kwargs)
+
+        resource = rate_limit_resource(request.url)
+        index = self.scheduler.acquire(resource, prefer=self.scheduler.token_index(auth))
+        token = self.scheduler.tokens[index]
+        if token:
+            request.headers["Authorization"] = f"token {token}"
+        try:
+            resp = super().send(request, **kwargs)
+        except Exception:
+            self.scheduler.release(index, resource)
+            raise
+        self.scheduler.release(index, resource, resp)
+        return resp
+
+
+class CachingAdapter(RateLimitedAdapter):
+    """Transport adapter that serves GET requests from an HTTPCache
+
+    Args:
+        cache (HTTPCache): the cache
+
+    Other arguments are passed to RateLimitedAdapter, which paces the
+    requests that are not answered from the cache.  A conditional request
+    is sent with the token that fetched the cached entry, since GitHub
+    ETags depend on it.  Counts of
+    requests answered from the cache without a request (hits), revalidated
+    with a 304 (revalidated) and fetched (misses) are kept as attributes.
+    """
+
+    def __init__(self, cache: HTTPCache, *args, **kwargs):
+        self.cache = cache
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def send(self, request, **kwargs):
+        if request.method != "GET" or kwargs.get("stream"):
+            return super().send(request, **kwargs)
+
+        key = self.cache.key(request)
+        entry = self.cache.load(key)
+        auth = None
+        if entry is not None:
+            if self.cache.is_fresh(entry):
+                self._count("hits")
+                return self.cache.response(entry, request)
+            request.headers.update(self.cache.conditional_headers(entry))
+            auth = entry.get("auth")
+
+        resp = self._send(request, auth, **kwargs)
+        if resp.status_code == 304 and entry is not None:
+            self._count("revalidated")
+            self.cache.touch(key, entry)
+            cached = self.cache.response(entry, request)
+            #- keep the fresh rate-limit headers
+            for name, value in resp.headers.items():
+                if name.lower().startswith("x-ratelimit"):
+                    cached.headers[name] = value
+            return cached
+
+        self._count("misses")
+        if resp.status_code == 200 and (self.cache.ttl is not None or
+                                        "ETag" in resp.headers or "Last-Modified" in resp.headers):
+            self.cache.store(key, request.url, resp)
+        return resp
+
+
+def make_session(workers: int = DEFAULT_WORKERS, cache: HTTPCache | None = None,
+                 scheduler: RateLimitScheduler | None = None) -> requests.Session:
+    """Return a keep-alive session that can be shared by `workers` threads
+
+    Args:
+        workers (int): number of threads that will share the session
+
+    Options:
+        cache (HTTPCache): serve GET requests from this cache, with conditional requests
+        scheduler (RateLimitScheduler): pace requests within the rate limits
+
+    Returns requests.Session
+    """
+    session = requests.Session()
+    pool = dict(pool_connections=1, pool_maxsize=max(1, workers))
+    if cache is not None:
+        adapter = CachingAdapter(cache, scheduler=scheduler, **pool)
+    else:
+        adapter = RateLimitedAdapter(scheduler=scheduler, **pool)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _retries_exhausted(method: str, url: str, resp: requests.Response) -> RuntimeError:
+    """Return an error for the last response of a request that was retried in vain"""
+    limits = ", ".join(f"{name}={resp.headers[name]}" for name in
+                       ("Retry-After", "X-RateLimit-Resource", "X-RateLimit-Remaining", "X-RateLimit-Reset")
+                       if name in resp.headers)
+    return RuntimeError(f"Failed to {method} {url} after retries: last status {resp.status_code}"
+                        + (f" ({limits})" if limits else ""))
+
+
+def request_with_retry(url: str, headers: dict, params: dict | None = None,
+                       session: requests.Session | None = None) -> requests.Response:
     """
     Perform a GET request, handling rate‑limit (403) and transient errors.
 
     If we hit the secondary rate limit (status 403 with a `Retry-After` header),
-    we sleep and retry once.
+    we sleep and retry once.  If `session` is given, its keep-alive
+    connections are reused, and responses may come from its HTTPCache,
+    see make_session.  If the session has a RateLimitScheduler, it does the
+    waiting, both for `Retry-After` and for the primary limit to reset, or
+    switches to another token.
     """
+    get = session.get if session is not None else requests.get
+    scheduler = getattr(session.get_adapter(url), "scheduler", None) if session is not None else None
     for attempt in range(3):
-        resp = requests.get(url, headers=headers, params=params)
+        resp = get(url, headers=headers, params=params)
         if resp.status_code == 200:
             return resp
-        if resp.status_code == 403:
+        if resp.status_code in (403, 429):
             # Check for secondary rate limit
             retry_after = resp.headers.get("Retry-After")
+            remaining = resp.headers.get("X-RateLimit-Remaining")
+            if scheduler is not None and (retry_after or remaining == "0"):
+                continue
             if retry_after:
                 wait = int(retry_after)
                 print(f"Rate limited, sleeping {wait}s...", file=sys.stderr)
                 time.sleep(wait)
                 continue
             # Primary rate limit – show remaining and abort
-            remaining = resp.headers.get("X-RateLimit-Remaining")
             reset_ts = int(resp.headers.get("X-RateLimit-Reset", "0"))
             reset_in = max(reset_ts - int(time.time()), 0)
             raise RuntimeError(
@@ -142,17 +568,18 @@ def request_with_retry(url: str, headers: dict, params: dict | None = None) -> r
             continue
         # For other errors, raise an exception with details
         resp.raise_for_status()
-    raise RuntimeError(f"Failed to GET {url} after retries.")
+    raise _retries_exhausted("GET", url, resp)
 
 
-def get_latest_release(owner: str, repo: str, headers: dict) -> tuple[str, str] | None:
+def get_latest_release(owner: str, repo: str, headers: dict,
+                       session: requests.Session | None = None) -> tuple[str, str] | None:
     """
     Try to fetch the latest *release* (which includes a tag). Returns (tag, date)
     where date is ISO‑8601 string. Returns None if no release exists.
     """
     url = f"{GITHUB_API}/repos/{owner}/{repo}/releases/latest"
     try:
-        resp = request_with_retry(url, headers)
+        resp = request_with_retry(url, headers, session=session)
         data = resp.json()
         tag = data.get("tag_name")
         date = data.get("published_at") or data.get("created_at")
@@ -165,26 +592,14 @@ def get_latest_release(owner: str, repo: str, headers: dict) -> tuple[str, str]
             raise
     return None
 
-def get_most_recent_tag(owner: str, repo: str, headers: dict) -> tuple[str, str] | None:
-    """
-    Fetch tags and select the most recent [v]X.Y[.Z]
-    Then resolve its commit date.
+def best_version_tag(tags: list[dict]) -> dict | None:
+    """Return the tag with the highest [v]X.Y[.Z] version name
 
-    Returns (tag, date) or None if the repo has no tags.
-    """
-
-    # ------------------------------------------------------------------
-    # Get list of all tags
-    # ------------------------------------------------------------------
-    url = f"{GITHUB_API}/repos/{owner}/{repo}/tags"
-    resp = request_with_retry(url, headers, params={"per_page": 100})
-    tags = resp.json()
-    if not tags:
-        return None
+    Args:
+        tags (list of dict): tags with a "name" key
 
-    # ------------------------------------------------------------------
-    # 2. Parse tag names as semantic versions and keep the highest one
-    # ------------------------------------------------------------------
+    Returns the tag dict, or None if no tag name is a version
+    """
     version_pat = re.compile(r"^v?(\d+)(?:\.(\d+))?(?:\.(\d+))?$")
     best_tag = None
     best_version = None   # tuple (major, minor, patch)
@@ -205,6 +620,40 @@ def get_most_recent_tag(owner: str, repo: str, headers: dict) -> tuple[str, str]
             best_version = ver
             best_tag = tag
 
+    return best_tag
+
+
+def get_most_recent_tag(owner: str, repo: str, headers: dict,
+                        session: requests.Session | None = None) -> tuple[str, str] | None:
+    """
+    Fetch tags and select the most recent [v]X.Y[.Z]
+    Then resolve its commit date.
+
+    Returns (tag, date) or None if the repo has no tags.
+    """
+
+    # ------------------------------------------------------------------
+    # Get list of all tags, following the pages of repos with >100 tags
+    # ------------------------------------------------------------------
+    url = f"{GITHUB_API}/repos/{owner}/{repo}/tags"
+    params = {"per_page": 100}
+    tags = []
+    while url:
+        resp = request_with_retry(url, headers, params=params, session=session)
+        tags.extend(resp.json())
+        # the next link already includes the query parameters
+        url = resp.links.get("next", {}).get("url")
+        params = None
+    if not tags:
+        return None
+
+    # ------------------------------------------------------------------
+    # 2. Parse tag names as semantic versions and keep the highest one
+    # ------------------------------------------------------------------
+    best_tag = best_version_tag(tags)
+    if best_tag is None:
+        return None
+
     tag_name = best_tag.get("name")
     commit_sha = best_tag.get("commit", {}).get("sha")
     if not (tag_name and commit_sha):
@@ -212,7 +661,7 @@ def get_most_recent_tag(owner: str, repo: str, headers: dict) -> tuple[str, str]
 
     # Get commit details to extract the date
     commit_url = f"{GITHUB_API}/repos/{owner}/{repo}/git/commits/{commit_sha}"
-    commit_resp = request_with_retry(commit_url, headers)
+    commit_resp = request_with_retry(commit_url, headers, session=session)
     commit_data = commit_resp.json()
     # The date can be under 'committer' or 'author' depending on tag type
     date = (
@@ -228,7 +677,8 @@ def get_most_recent_tag(owner: str, repo: str, headers: dict) -> tuple[str, str]
     return tag_name, date
 
 
-def get_latest_tag_and_date(owner: str, repo: str, headers: dict) -> tuple[str | None, str | None]:
+def get_latest_tag_and_date(owner: str, repo: str, headers: dict,
+                            session: requests.Session | None = None) -> tuple[str | None, str | None]:
     """
     Return (tag, date) for the latest tag (or release). If none found, returns (None, None).
     """
@@ -238,14 +688,15 @@ def get_latest_tag_and_date(owner: str, repo: str, headers: dict) -> tuple[str |
     ###     return release
 
     # 2. Fallback to plain tags
-    tag, date = get_most_recent_tag(owner, repo, headers)
-    if tag:
-        return tag, date
+    result = get_most_recent_tag(owner, repo, headers, session=session)
+    if result:
+        return result
 
     return None, None
 
 
-def count_merged_prs_since(owner: str, repo: str, since_iso: str | None, headers: dict) -> int:
+def count_merged_prs_since(owner: str, repo: str, since_iso: str | None, headers: dict,
+                           session: requests.Session | None = None) -> int:
     """
     Count merged PRs after `since_iso`. If `since_iso` is None, count *all* merged PRs.
 
@@ -258,13 +709,13 @@ def count_merged_prs_since(owner: str, repo: str, since_iso: str | None, headers
         q += f" merged:>{since_iso}"
     params = {"q": q, "per_page": 1}  # we only need the total count
     url = f"{GITHUB_API}/search/issues"
-    resp = request_with_retry(url, headers, params=params)
+    resp = request_with_retry(url, headers, params=params, session=session)
     data = resp.json()
     total = data.get("total_count", 0)
     return total
 
 
-def process_repo(url: str, headers: dict) -> dict:
+def process_repo(url: str, headers: dict, session: requests.Session | None = None) -> dict:
     """
     Query GitHub for repo url and return a dict with keys:
         repo_name, tag, tag_date, merged_prs (since tag)
@@ -281,10 +732,10 @@ def process_repo(url: str, headers: dict) -> dict:
             "error": str(e),
         }
 
-    tag, tag_date = get_latest_tag_and_date(owner, repo, headers)
+    tag, tag_date = get_latest_tag_and_date(owner, repo, headers, session=session)
 
     # If we couldn't find a tag, we still want to count *all* merged PRs
-    merged_prs = count_merged_prs_since(owner, repo, tag_date, headers)
+    merged_prs = count_merged_prs_since(owner, repo, tag_date, headers, session=session)
 
     return {
         "repo_name": repo,
@@ -295,6 +746,238 @@ def process_repo(url: str, headers: dict) -> dict:
     }
 
 
+# ----------------------------------------------------------------------
+# GraphQL backend: one aliased query answers many repos at once
+# ----------------------------------------------------------------------
+
+TAGS_FRAGMENT = """
+    refs(refPrefix: "refs/tags/", first: 100, after: $after) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        name
+        target {
+          ... on Commit { committedDate }
+          ... on Tag { target { ... on Commit { committedDate } } }
+        }
+      }
+    }"""
+
+
+def graphql_query(query: str, variables: dict, headers: dict,
+                  session: requests.Session | None = None) -> tuple[dict, list[dict]]:
+    """Run a GraphQL query, handling rate limits and transient errors
+
+    Args:
+        query (str): GraphQL query
+        variables (dict): values of the query variables
+        headers (dict): request headers, which must include Authorization
+        session (requests.Session): optional keep-alive session
+
+    Returns (data, errors) where errors lists the per-field errors, e.g. for
+    a repository that does not exist, while data holds the other results
+    """
+    post = session.post if session is not None else requests.post
+    scheduler = getattr(session.get_adapter(GITHUB_GRAPHQL), "scheduler", None) if session is not None else None
+    for attempt in range(3):
+        resp = post(GITHUB_GRAPHQL, headers=headers, json={"query": query, "variables": variables})
+        if resp.status_code == 200:
+            result = resp.json()
+            if result.get("data") is None:
+                raise RuntimeError(f"GraphQL query failed: {result.get('errors')}")
+            return result["data"], result.get("errors") or []
+        retry_after = resp.headers.get("Retry-After")
+        if resp.status_code in (403, 429) and scheduler is not None and (
+                retry_after or resp.headers.get("X-RateLimit-Remaining") == "0"):
+            continue
+        if resp.status_code in (403, 429) and retry_after:
+            wait = int(retry_after)
+            print(f"Rate limited, sleeping {wait}s...", file=sys.stderr)
+            time.sleep(wait)
+            continue
+        if resp.status_code in (502, 503, 504):
+            time.sleep(2 ** attempt)
+            continue
+        resp.raise_for_status()
+    raise _retries_exhausted("POST", GITHUB_GRAPHQL, resp)
+
+
+def _alias_errors(errors: list[dict]) -> dict:
+    """Return dict of query alias -> error message from GraphQL errors"""
+    result = {}
+    for err in errors:
+        path = err.get("path") or []
+        if path:
+            result.setdefault(path[0], err.get("message", "GraphQL error"))
+    return result
+
+
+def graphql_latest_tags(repos: list[tuple[str, str]], headers: dict,
+                        session: requests.Session | None = None,
+                        batch_size: int = GRAPHQL_BATCH) -> list[tuple[str | None, str | None, str | None]]:
+    """Return the latest version tag and its commit date for many repos
+
+    Tags of up to `batch_size` repos are fetched per aliased query, and
+    repos with more than 100 tags are paged through in later queries.
+
+    Args:
+        repos (list of tuple): (owner, repo) pairs
+        headers (dict): request headers, which must include Authorization
+        session (requests.Session): optional keep-alive session
+        batch_size (int): number of repos per query
+
+    Returns list of (tag, date, error) in the same order as `repos`, with
+    tag and date None if the repo has no version tags.  If a query fails,
+    the error is recorded for each repo in its batch.
+    """
+    tags = [[] for _ in repos]
+    errors = [None] * len(repos)
+    cursors = {i: None for i in range(len(repos))}   # repos with more pages
+    while cursors:
+        pending = sorted(cursors)[:batch_size]
+        decls = []
+        fields = []
+        variables = {}
+        for i in pending:
+            decls.append(f"$o{i}: String!, $n{i}: String!, $a{i}: String")
+            refs = TAGS_FRAGMENT.replace("$after", f"$a{i}")
+            fields.append(f"  r{i}: repository(owner: $o{i}, name: $n{i}) {{{refs}\n  }}")
+            variables.update({f"o{i}": repos[i][0], f"n{i}": repos[i][1], f"a{i}": cursors[i]})
+        query = f"query({', '.join(decls)}) {{\n" + "\n".join(fields) + "\n}"
+        try:
+            data, errs = graphql_query(query, variables, headers, session=session)
+        except (RuntimeError, requests.RequestException) as exc:
+            print(f"[ERROR] GraphQL tag query failed for {len(pending)} repos: {exc}", file=sys.stderr)
+            for i in pending:
+                errors[i] = str(exc)
+                del cursors[i]
+            continue
+        alias_errors = _alias_errors(errs)
+
+        for i in pending:
+            repo = data.get(f"r{i}")
+            if repo is None:
+                errors[i] = alias_errors.get(f"r{i}", "repository not found")
+                del cursors[i]
+                continue
+            refs = repo["refs"]
+            for node in refs["nodes"]:
+                target = node.get("target") or {}
+                # annotated tags point to a Tag object that points to the commit
+                date = target.get("committedDate") or (target.get("target") or {}).get("committedDate")
+                tags[i].append({"name": node["name"], "date": date})
+            if refs["pageInfo"]["hasNextPage"]:
+                cursors[i] = refs["pageInfo"]["endCursor"]
+            else:
+                del cursors[i]
+
+    results = []
+    for i in range(len(repos)):
+        best_tag = best_version_tag(tags[i]) if errors[i] is None else None
+        if best_tag is None:
+            results.append((None, None, errors[i]))
+        else:
+            date = best_tag["date"][0:10] if best_tag["date"] else "Unknown"
+            results.append((best_tag["name"], date, None))
+    return results
+
+
+def graphql_merged_pr_counts(repos: list[tuple[str, str]], since: list[str | None], headers: dict,
+                             session: requests.Session | None = None,
+                             batch_size: int = GRAPHQL_BATCH) -> list[tuple[int | None, str | None]]:
+    """Count PRs merged after a date for many repos, in batched search queries
+
+    Args:
+        repos (list of tuple): (owner, repo) pairs
+        since (list of str): YEAR-MM-DD for each repo, or None to count all merged PRs
+        headers (dict): request headers, which must include Authorization
+        session (requests.Session): optional keep-alive session
+        batch_size (int): number of repos per query
+
+    Returns list of (count, error) in the same order as `repos`, with count
+    None if the search failed
+    """
+    counts = [(None, "merged PR search failed")] * len(repos)
+    for start in range(0, len(repos), batch_size):
+        batch = range(start, min(start + batch_size, len(repos)))
+        decls = []
+        fields = []
+        variables = {}
+        for i in batch:
+            owner, repo = repos[i]
+            q = f"repo:{owner}/{repo} is:pr is:merged"
+            if since[i]:
+                q += f" merged:>{since[i]}"
+            decls.append(f"$q{i}: String!")
+            fields.append(f"  p{i}: search(query: $q{i}, type: ISSUE, first: 0) {{ issueCount }}")
+            variables[f"q{i}"] = q
+        query = f"query({', '.join(decls)}) {{\n" + "\n".join(fields) + "\n}"
+        try:
+            data, errs = graphql_query(query, variables, headers, session=session)
+        except (RuntimeError, requests.RequestException) as exc:
+            print(f"[ERROR] GraphQL PR search failed for {len(batch)} repos: {exc}", file=sys.stderr)
+            for i in batch:
+                counts[i] = (None, str(exc))
+            continue
+        alias_errors = _alias_errors(errs)
+        for i in batch:
+            result = data.get(f"p{i}")
+            if result is not None:
+                counts[i] = (result["issueCount"], None)
+            elif f"p{i}" in alias_errors:
+                counts[i] = (None, alias_errors[f"p{i}"])
+    return counts
+
+
+def graphql_repo_tags(repo_urls: list[str], headers: dict,
+                      session: requests.Session | None = None,
+                      batch_size: int = GRAPHQL_BATCH) -> list[dict]:
+    """Query GitHub GraphQL for info about tags per repo
+
+    Same results as process_repo for each of `repo_urls`, but with all repos
+    answered by a few batched queries.
+
+    Args:
+        repo_urls (list of str): list of GitHub repository URLs
+        headers (dict): request headers, which must include Authorization
+
+    Options:
+        session (requests.Session): keep-alive session
+        batch_size (int): number of repos per query
+
+    Returns list of dict(repo_name, tag, tag_date, merged_prs, error)
+    """
+    results = [None] * len(repo_urls)
+    repos = []
+    index = []
+    for i, url in enumerate(repo_urls):
+        try:
+            repos.append(extract_owner_repo(url))
+            index.append(i)
+        except ValueError as e:
+            print(f"[WARN] Skipping invalid URL: {url} ({e})", file=sys.stderr)
+            results[i] = {"repo_name": None, "tag": None, "tag_date": None,
+                          "merged_prs": None, "error": str(e)}
+
+    tags = graphql_latest_tags(repos, headers, session=session, batch_size=batch_size)
+    found = [j for j, (tag, date, err) in enumerate(tags) if err is None]
+    counts = graphql_merged_pr_counts([repos[j] for j in found], [tags[j][1] for j in found],
+                                      headers, session=session, batch_size=batch_size)
+    merged = dict(zip(found, counts))
+
+    for j, (owner, repo) in enumerate(repos):
+        tag, tag_date, err = tags[j]
+        if err is None:
+            count, err = merged[j]
+        if err is not None:
+            print(f"[ERROR] Failed to process {repo_urls[index[j]]}: {err}", file=sys.stderr)
+            results[index[j]] = {"repo_name": repo, "tag": "ERROR", "tag_date": "ERROR",
+                                 "merged_prs": "ERROR", "error": err}
+        else:
+            results[index[j]] = {"repo_name": repo, "tag": tag or "N/A", "tag_date": tag_date or "N/A",
+                                 "merged_prs": count, "error": None}
+    return results
+
+
 def output_csv(rows: list[dict], out_fh):
     writer = csv.writer(out_fh)
     writer.writerow(["Repository", "LatestTag", "TagDate", "PRsSinceTag"])
@@ -317,53 +1000,87 @@ def output_markdown(rows: list[dict], out_fh):
     out_fh.write(md + "\n")
 
 
-def get_repo_tags(repo_urls: list[str], github_token=None):
+def _process_repo_safe(url: str, headers: dict, session: requests.Session) -> dict:
+    """
+    Call process_repo, returning any error in the result instead of raising it
+    """
+    print(f"[INFO] Processing {url} ...", file=sys.stderr)
+    try:
+        info = process_repo(url, headers, session=session)
+        if info["error"]:
+            print(f"[WARN] {info['error']}", file=sys.stderr)
+        return info
+    except Exception as exc:
+        print(f"[ERROR] Failed to process {url}: {exc}", file=sys.stderr)
+        return {
+            "repo_name": url.rstrip("/").split("/")[-1],
+            "tag": "ERROR",
+            "tag_date": "ERROR",
+            "merged_prs": "ERROR",
+            "error": str(exc),
+        }
+
+
+def get_repo_tags(repo_urls: list[str], github_token=None, workers=DEFAULT_WORKERS,
+                  cache: HTTPCache | None = None, graphql: bool = False):
     """Query GitHub for info about tags per repo
 
+    Repos are processed concurrently, sharing one keep-alive session, and
+    results are returned in the same order as `repo_urls`.  A failure for
+    one repo is recorded in its "error" entry without stopping the others.
+    Requests are paced within the rate limits by a RateLimitScheduler, which
+    rotates across tokens if more than one is given.
+
     Args:
         repo_urls (list of str): list of GitHub repository URLs
 
     Options:
-        github_token (str): GitHub access token (minimal scope ok)
+        github_token (str): GitHub access token (minimal scope ok), or
+            comma separated list of tokens
+        workers (int): number of repos to process concurrently
+        cache (HTTPCache): cache of responses, revalidated with conditional requests
+        graphql (bool): use batched GraphQL queries instead of REST; requires a token
 
     Return list of dict(repo_name, tag, tag_date, merged_prs, error)
     """
-    token = github_token or os.getenv("GITHUB_TOKEN")
-    if token:
+    tokens = [t.strip() for t in (github_token or os.getenv("GITHUB_TOKEN") or "").split(",") if t.strip()]
+    token = tokens[0] if tokens else None
+    if len(tokens) > 1:
+        print(f"[INFO] Rotating across {len(tokens)} GitHub tokens for authenticated requests.", file=sys.stderr)
+    elif token:
         print("[INFO] Using provided GitHub token for authenticated requests.", file=sys.stderr)
     else:
         print("[INFO] No GitHub token supplied – you are limited to 60 requests/hour.", file=sys.stderr)
 
-    # Default GitHub API query header plus optional token
+    # Default GitHub API query header plus optional token; the scheduler
+    # replaces the token with the one it picks for each request
     headers = get_auth_headers(token)
+    scheduler = RateLimitScheduler(tokens)
 
     if not repo_urls:
         print("[ERROR] Input file contains no repository URLs.", file=sys.stderr)
         sys.exit(1)
 
-    results = []
-    for url in repo_urls:
-        print(f"[INFO] Processing {url} ...", file=sys.stderr)
-        try:
-            info = process_repo(url, headers)
-            if info["error"]:
-                print(f"[WARN] {info['error']}", file=sys.stderr)
-            results.append(info)
-        except Exception as exc:
-            print(f"[ERROR] Failed to process {url}: {exc}", file=sys.stderr)
-            results.append(
-                {
-                    "repo_name": None,
-                    "tag": "ERROR",
-                    "tag_date": "ERROR",
-                    "merged_prs": "ERROR",
-                    "error": str(exc),
-                }
-            )
-            raise exc
+    if graphql and not token:
+        print("[WARN] GraphQL requires a GitHub token; using REST instead.", file=sys.stderr)
+        graphql = False
+
+    workers = max(1, min(workers, len(repo_urls)))
+    with make_session(workers, cache=cache, scheduler=scheduler) as session:
+        if graphql:
+            print(f"[INFO] Querying {len(repo_urls)} repos with GraphQL ...", file=sys.stderr)
+            results = graphql_repo_tags(repo_urls, headers, session=session)
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(lambda url: _process_repo_safe(url, headers, session), repo_urls))
+        if cache is not None and not graphql:
+            adapter = session.get_adapter(GITHUB_API)
+            print(f"[INFO] HTTP cache: {adapter.hits} fresh, {adapter.revalidated} not modified, "
+                  f"{adapter.misses} fetched", file=sys.stderr)
 
-        # Small pause to be nice to the API (especially without a token)
-        time.sleep(0.1)
+    nerr = sum(1 for r in results if r["error"])
+    if nerr > 0:
+        print(f"[WARN] {nerr} of {len(results)} repositories had errors.", file=sys.stderr)
 
     return results
 
@@ -397,9 +1114,32 @@ Generate a classic token at https://github.com/settings/tokens with no additiona
     )
     parser.add_argument(
         "-t", "--token",
-        help="GitHub personal access token (or set GITHUB_TOKEN env var)",
+        help="GitHub personal access token (or set GITHUB_TOKEN env var); "
+             "a comma separated list of tokens is used in rotation",
         default=None,
     )
+    parser.add_argument(
+        "-w", "--workers",
+        type=int,
+        help=f"Number of repos to query concurrently (default {DEFAULT_WORKERS})",
+        default=DEFAULT_WORKERS,
+    )
+    parser.add_argument(
+        "--cache-dir",
+        help="Cache responses in this directory and revalidate them with conditional requests",
+        default=None,
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        help="Reuse cached responses younger than this many seconds without any request",
+        default=None,
+    )
+    parser.add_argument(
+        "--graphql",
+        action="store_true",
+        help="Use a few batched GraphQL queries instead of ~3 REST requests per repo (requires a token)",
+    )
     return parser.parse_args(opts)
 
 def main(opts=None): 
@@ -416,14 +1156,16 @@ def main(opts=None):
             if repo.startswith('https://github.com'):
                 urls.append(repo)
             elif repo.startswith('github.com'):
-                urls.append('https://'+args.repo)
+                urls.append('https://'+repo)
             else:
                 urls.append('https://github.com/desihub/'+repo)
     else:
         urls = default_repo_urls
 
     # Get info about latest tags per repo
-    results = get_repo_tags(urls, github_token=args.token)
+    cache = HTTPCache(args.cache_dir, ttl=args.cache_ttl) if args.cache_dir else None
+    results = get_repo_tags(urls, github_token=args.token, workers=args.workers, cache=cache,
+                            graphql=args.graphql)
 
     # Choose output destination
     out_fh = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
@@ -438,6 +1180,8 @@ def main(opts=None):
         if args.output:
             out_fh.close()
 
+    return 1 if any(r["error"] for r in results) else 0
+
 # Enable this file to be run as a standalone script, even if desida
 # isn't installed or even in $PYTHONPATH
 if __name__ == "__main__":
@@ -0,0 +1,230 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst.
+"""
+============
+desida.index
+============
+
+Persistent, incrementally refreshed index of a data assembly tree.
+
+The index is an SQLite database that records, for every directory, its
+modification time and listing, and for every checksum file, its size,
+modification time and parsed contents.  Creating, removing or renaming an
+entry changes the modification time of its parent directory, so on a rescan
+only directories whose modification time has changed need to be listed
+again, and only checksum files that have changed need to be parsed again.
+"""
+import os
+import json
+import sqlite3
+from desiutil.log import log
+from .walker import walk, _scan, DirectoryListing
+from .inventory import checksum_contents
+
+
+_schema = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    dirnames TEXT NOT NULL,
+    subdirs TEXT NOT NULL,
+    filenames TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS manifests (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS manifests_directory ON manifests (directory);
+CREATE TABLE IF NOT EXISTS entries (
+    manifest TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    digest TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_manifest ON entries (manifest);
+"""
+
+
+class InventoryIndex(object):
+    """On-disk index of the files and checksum files in a directory tree.
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        Path to the SQLite database.  It will be created if necessary.
+    cext : :class:`str`, optional
+        Use this filename extension to identify checksum files.
+    """
+
+    #: Commit to the database after this many changed directories.
+    commit_interval = 10000
+
+    def __init__(self, filename, cext='.sha256sum'):
+        self.filename = filename
+        self.cext = cext
+        self.conn = sqlite3.connect(filename)
+        self.conn.executescript(_schema)
+        self.conn.commit()
+
+    def close(self):
+        """Close the database connection.
+        """
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def root(self):
+        """The root of the indexed directory tree, or ``None`` if the index is empty.
+        """
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'root'").fetchone()
+        return None if row is None else row[0]
+
+    def refresh(self, root, workers=None):
+        """Bring the index up to date with the directory tree at `root`.
+
+        Parameters
+        ----------
+        root : :class:`str`
+            The root of the directory tree.
+        workers : :class:`int`, optional
+            Number of threads used to list directories.
+
+        Returns
+        -------
+        :class:`tuple`
+            The number of directories that were listed again and the
+            number of checksum files that were parsed again.
+
+        Raises
+        ------
+        ValueError
+            If the index was built for a different `root`.
+        """
+        root = os.path.normpath(root)
+        indexed_root = self.root
+        if indexed_root is None:
+            self.conn.execute("INSERT INTO meta (key, value) VALUES ('root', ?)", (root,))
+        elif indexed_root != root:
+            raise ValueError(f"Index {self.filename} was built for {indexed_root}, not {root}!")
+        #
+        # Snapshot of the stored listings, read-only in the worker threads.
+        #
+        cached = dict()
+        for path, mtime_ns, dirnames, subdirs, filenames in self.conn.execute("SELECT * FROM directories"):
+            cached[path] = (mtime_ns, dirnames, subdirs, filenames)
+        manifests = dict()
+        for path, size, mtime_ns in self.conn.execute("SELECT path, size, mtime_ns FROM manifests"):
+            manifests[path] = (size, mtime_ns)
+        changed = dict()
+
+        def scanner(dirpath, stat, followlinks):
+            mtime_ns = os.stat(dirpath).st_mtime_ns
+            if dirpath in cached and cached[dirpath][0] == mtime_ns:
+                dirnames, subdirs, filenames = (json.loads(c) for c in cached[dirpath][1:])
+                return (DirectoryListing(dirpath, dirnames, filenames, None),
+                        [os.path.join(dirpath, d) for d in subdirs])
+            listing, descend = _scan(dirpath, stat, followlinks)
+            changed[dirpath] = (mtime_ns, [os.path.basename(d) for d in descend])
+            return listing, descend
+
+        seen = set()
+        n_dirs = n_manifests = 0
+        for listing in walk(root, workers=workers, scanner=scanner):
+            dirpath = listing.dirpath
+            seen.add(dirpath)
+            if dirpath in changed:
+                n_dirs += 1
+                mtime_ns, subdirs = changed.pop(dirpath)
+                self.conn.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?)",
+                                  (dirpath, mtime_ns, json.dumps(listing.dirnames),
+                                   json.dumps(subdirs), json.dumps(listing.filenames)))
+                for d in listing.dirnames:
+                    if d.startswith('.'):
+                        log.warning('Hidden directory detected: %s!', os.path.join(dirpath, d))
+                for f in listing.filenames:
+                    if f.startswith('.'):
+                        log.warning('Hidden file detected: %s!', os.path.join(dirpath, f))
+                current = {os.path.join(dirpath, f) for f in listing.filenames
+                           if os.path.splitext(f)[1] == self.cext}
+                for c in self._manifests_in(dirpath) - current:
+                    self._forget_manifest(c)
+                if n_dirs % self.commit_interval == 0:
+                    self.conn.commit()
+            for f in listing.filenames:
+                if os.path.splitext(f)[1] == self.cext:
+                    c = os.path.join(dirpath, f)
+                    st = os.stat(c)
+                    if manifests.get(c) != (st.st_size, st.st_mtime_ns):
+                        n_manifests += 1
+                        self._store_manifest(c, dirpath, st)
+        #
+        # Forget directories that have disappeared.
+        #
+        for dirpath in set(cached) - seen:
+            self.conn.execute("DELETE FROM directories WHERE path = ?", (dirpath,))
+            for c in self._manifests_in(dirpath):
+                self._forget_manifest(c)
+        self.conn.commit()
+        log.debug("Refreshed %d directories and %d checksum files in %s.", n_dirs, n_manifests, root)
+        return n_dirs, n_manifests
+
+    def _manifests_in(self, dirpath):
+        """Return the set of indexed checksum files in `dirpath`.
+        """
+        return {row[0] for row in self.conn.execute("SELECT path FROM manifests WHERE directory = ?", (dirpath,))}
+
+    def _forget_manifest(self, path):
+        """Remove checksum file `path` from the index.
+        """
+        self.conn.execute("DELETE FROM entries WHERE manifest = ?", (path,))
+        self.conn.execute("DELETE FROM manifests WHERE path = ?", (path,))
+
+    def _store_manifest(self, path, dirpath, st):
+        """Parse checksum file `path` and store its contents in the index.
+        """
+        log.debug("checksums['%s'] = checksum_contents('%s')", path, path)
+        contents = checksum_contents(path)
+        self.conn.execute("DELETE FROM entries WHERE manifest = ?", (path,))
+        self.conn.execute("INSERT OR REPLACE INTO manifests VALUES (?, ?, ?, ?)",
+                          (path, dirpath, st.st_size, st.st_mtime_ns))
+        self.conn.executemany("INSERT INTO entries VALUES (?, ?, ?)",
+                              ((path, f, d) for f, d in contents.items()))
+
+    def directories(self):
+        """Mapping of directory to files in that directory.
+
+        Returns
+        -------
+        :class:`dict`
+            The same structure as the first value returned by
+            :func:`~desida.inventory.find_all_files`.
+        """
+        directories = dict()
+        for path, filenames in self.conn.execute("SELECT path, filenames FROM directories"):
+            f = json.loads(filenames)
+            if f:
+                directories[path] = f
+        return directories
+
+    def checksums(self):
+        """Mapping of checksum files to the contents of those checksum files.
+
+        Returns
+        -------
+        :class:`dict`
+            The same structure as the second value returned by
+            :func:`~desida.inventory.find_all_files`.
+        """
+        checksums = {row[0]: dict() for row in self.conn.execute("SELECT path FROM manifests")}
+        for manifest, filename, digest in self.conn.execute("SELECT manifest, filename, digest FROM entries"):
+            checksums[manifest][filename] = digest
+        return checksums
@@ -7,34 +7,198 @@ desida.inventory
 Tools for complete listings of data assembly files.
 """
 import os
-import sys
+import re
+import struct
+import hashlib
+from argparse import ArgumentParser
 from desiutil.log import log
+from .walker import walk
 
 
-def checksum_contents(checksum_file):
+_bsd_line = re.compile(r'^[A-Z0-9-]+ \((.*)\) = ([0-9A-Fa-f]+)$')
+
+
+def _unescape(name):
+    """Undo the escaping applied by GNU coreutils to unusual filenames.
+    """
+    out = list()
+    i = 0
+    while i < len(name):
+        c = name[i]
+        if c == '\\' and i + 1 < len(name):
+            i += 1
+            c = {'n': '\n', 'r': '\r', '\\': '\\'}.get(name[i], '\\' + name[i])
+        out.append(c)
+        i += 1
+    return ''.join(out)
+
+
+def iter_checksum_contents(checksum_file):
+    """Lazily parse the contents of `checksum_file`.
+
+    Lines in the format written by :command:`sha256sum`, in either text or
+    binary (``*``) mode, are supported, including filenames that contain
+    spaces and escaped filenames, as are BSD-style ``SHA256 (name) = digest``
+    lines.
+
+    Parameters
+    ----------
+    checksum_file : :class:`str`
+        The checksum file to parse.
+
+    Yields
+    ------
+    :class:`tuple`
+        A filename and its checksum value.
+    """
+    with open(checksum_file, errors='surrogateescape') as c:
+        for n, l in enumerate(c, 1):
+            l = l.rstrip('\r\n')
+            if not l.strip():
+                continue
+            escaped = l.startswith('\\')
+            if escaped:
+                l = l[1:]
+            m = _bsd_line.match(l)
+            if m is not None:
+                name, digest = m.groups()
+            else:
+                digest, sep, name = l.partition(' ')
+                if name[:1] in (' ', '*'):
+                    name = name[1:]
+            if not digest or not name:
+                log.warning("Could not parse line %d of %s.", n, checksum_file)
+                continue
+            if escaped:
+                name = _unescape(name)
+            yield name, digest
+
+
+def checksum_contents(checksum_file, cache=None):
     """Parse the contents of `checksum_file`.
 
     Parameters
     ----------
     checksum_file : :class:`str`
         The checksum file to parse.
+    cache : :class:`ChecksumCache`, optional
+        Use and update this cache of parsed checksum files.
 
     Returns
     -------
     :class:`dict`
         A dictionary mapping filename to checksum value.
     """
-    d = os.path.dirname(checksum_file)
-    r = dict()
-    with open(checksum_file) as c:
-        lines = c.readlines()
-    for l in lines:
-        foo = l.strip().split()
-        r[foo[1]] = foo[0]
+    if cache is not None:
+        r = cache.get(checksum_file)
+        if r is not None:
+            return r
+    r = dict(iter_checksum_contents(checksum_file))
+    if cache is not None:
+        cache.put(checksum_file, r)
     return r
 
 
-def find_all_files(root, cext='.sha256sum'):
+class ChecksumCache(object):
+    """Cache of parsed checksum files in a compact binary form.
+
+    Each checksum file is cached in its own file in `directory`, and an
+    entry is only used if the size and modification time of the checksum
+    file are unchanged.  Filenames are stored as a single NUL-separated
+    block and checksums as raw bytes, with a flag for upper-case hexadecimal,
+    so that cached checksums are exactly as written in the checksum file.
+    Checksum files that cannot be stored this way, *e.g.* with mixed case,
+    are not cached.
+
+    Parameters
+    ----------
+    directory : :class:`str`
+        Directory to hold the cache.  It will be created if necessary.
+    """
+
+    _magic = b'DCS2'
+    _header = struct.Struct('<4sQqIII')
+    _upper = 0x1
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _cache_file(self, checksum_file):
+        key = hashlib.sha1(os.path.abspath(checksum_file).encode('utf-8', 'surrogateescape')).hexdigest()
+        return os.path.join(self.directory, key[:2], key + '.bin')
+
+    def get(self, checksum_file):
+        """Return the cached contents of `checksum_file`.
+
+        Parameters
+        ----------
+        checksum_file : :class:`str`
+            The checksum file.
+
+        Returns
+        -------
+        :class:`dict` or ``None``
+            A dictionary mapping filename to checksum value, or ``None``
+            if there is no valid cache entry.
+        """
+        try:
+            st = os.stat(checksum_file)
+            with open(self._cache_file(checksum_file), 'rb') as c:
+                data = c.read()
+        except OSError:
+            return None
+        if len(data) < self._header.size:
+            return None
+        magic, size, mtime_ns, n, digest_size, flags = self._header.unpack_from(data)
+        if magic != self._magic or size != st.st_size or mtime_ns != st.st_mtime_ns:
+            return None
+        start = self._header.size
+        end = len(data) - n*digest_size
+        digests = data[end:]
+        if n == 0:
+            return dict()
+        names = data[start:end].decode('utf-8', 'surrogateescape').split('\0')
+        if len(names) != n:
+            return None
+        hexdigests = [digests[k*digest_size:(k+1)*digest_size].hex() for k in range(n)]
+        if flags & self._upper:
+            hexdigests = [d.upper() for d in hexdigests]
+        return dict(zip(names, hexdigests))
+
+    def put(self, checksum_file, contents):
+        """Store the parsed contents of `checksum_file`.
+
+        Parameters
+        ----------
+        checksum_file : :class:`str`
+            The checksum file.
+        contents : :class:`dict`
+            A dictionary mapping filename to checksum value.
+        """
+        values = list(contents.values())
+        try:
+            digests = [bytes.fromhex(d) for d in values]
+        except ValueError:
+            return
+        digest_size = len(digests[0]) if digests else 0
+        if any(len(d) != digest_size for d in digests):
+            return
+        flags = self._upper if values and values[0] != values[0].lower() else 0
+        if any((d.hex().upper() if flags else d.hex()) != v for d, v in zip(digests, values)):
+            return
+        st = os.stat(checksum_file)
+        cache_file = self._cache_file(checksum_file)
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp = cache_file + f'.{os.getpid()}'
+        with open(tmp, 'wb') as c:
+            c.write(self._header.pack(self._magic, st.st_size, st.st_mtime_ns, len(digests), digest_size, flags))
+            c.write('\0'.join(contents).encode('utf-8', 'surrogateescape'))
+            c.write(b''.join(digests))
+        os.replace(tmp, cache_file)
+
+
+def find_all_files(root, cext='.sha256sum', workers=None, cache=None):
     """Build up a catalog of all files in a directory tree.
 
     Parameters
@@ -43,6 +207,10 @@ def find_all_files(root, cext='.sha256sum'):
         The root of the directory tree to explore.
     cext : :class:`str`, optional
         Use this filename extension to identify checksum files.
+    workers : :class:`int`, optional
+        Number of threads used to list directories.
+    cache : :class:`ChecksumCache`, optional
+        Use and update this cache of parsed checksum files.
 
     Returns
     -------
@@ -53,7 +221,8 @@ def find_all_files(root, cext='.sha256sum'):
     """
     directories = dict()
     checksums = dict()
-    for dirpath, dirnames, filenames in os.walk(root):
+    for listing in walk(root, workers=workers):
+        dirpath, dirnames, filenames = listing.dirpath, listing.dirnames, listing.filenames
         if filenames:
             directories[dirpath] = filenames.copy()
         for d in dirnames:
@@ -67,10 +236,71 @@ def find_all_files(root, cext='.sha256sum'):
             if os.path.splitext(f)[1] == cext:
                 log.debug("Checksum file detected: %s.", ff)
                 log.debug("checksums['%s'] = checksum_contents('%s')", ff, ff)
-                checksums[ff] = checksum_contents(ff)
+                checksums[ff] = checksum_contents(ff, cache=cache)
     return directories, checksums
 
 
+class _PathTable(object):
+    """Intern directory paths as small integers.
+
+    Files are then represented as ``(directory id, name)`` pairs, so that
+    the directory prefix is stored once instead of once per file.
+    """
+
+    def __init__(self):
+        self.ids = dict()
+        self.paths = list()
+
+    def __getitem__(self, path):
+        try:
+            return self.ids[path]
+        except KeyError:
+            i = self.ids[path] = len(self.paths)
+            self.paths.append(path)
+            return i
+
+
+def _merge_difference(a, b):
+    """Compare two sorted lists of unique names.
+
+    Parameters
+    ----------
+    a, b : :class:`list`
+        Sorted lists without duplicates.
+
+    Returns
+    -------
+    :class:`tuple`
+        The names only in `a` and the names only in `b`.
+    """
+    only_a, only_b = list(), list()
+    i = j = 0
+    na, nb = len(a), len(b)
+    while i < na and j < nb:
+        if a[i] == b[j]:
+            i += 1
+            j += 1
+        elif a[i] < b[j]:
+            only_a.append(a[i])
+            i += 1
+        else:
+            only_b.append(b[j])
+            j += 1
+    only_a.extend(a[i:])
+    only_b.extend(b[j:])
+    return only_a, only_b
+
+
+def _split(path):
+    """Split normalized `path` into directory and filename, like the directories of :func:`os.walk`.
+
+    The directory of a path without one is :data:`os.curdir`, which is also
+    what :func:`os.path.normpath` returns for the directory itself.
+    """
+    d, f = os.path.split(os.path.normpath(path))
+    return d or os.curdir, f
+
+
 def checksum_accounting(directories, checksums):
     """Compare the files in `directories` to the files in `checksums`.
 
@@ -86,15 +316,71 @@ def checksum_accounting(directories, checksums):
     :class:`tuple`
         A :class:`set` of files that do not appear in any checksum file and a :class:`set`
         of files that appear in a checksum file but not on disk.
+
+    Notes
+    -----
+    Full paths are only constructed for files in the returned sets.  Otherwise
+    files are grouped by interned directory and compared one directory at a
+    time with a sorted merge, which keeps the memory used to audit trees with
+    very many files close to the size of the inputs.  The per-directory lists
+    only hold references to the filenames of the inputs; storing the names in
+    NumPy byte arrays instead would copy every name, and was both larger and
+    slower.
     """
+    table = _PathTable()
+    #
+    # Checksum files themselves are not expected to appear in checksum files.
+    #
+    skip = dict()
+    for c in checksums:
+        cd, cf = _split(c)
+        skip.setdefault(table[cd], set()).add(cf)
+    on_disk = dict()
+    for d, filenames in directories.items():
+        i = table[os.path.normpath(d)]
+        s = skip.get(i, ())
+        on_disk.setdefault(i, []).extend(f for f in filenames if f not in s)
+    listed = dict()
+    for c, contents in checksums.items():
+        cd = _split(c)[0]
+        i = table[cd]
+        for f in contents:
+            if '/' in f or f in ('.', '..'):
+                fd, f = _split(os.path.join(cd, f))
+                listed.setdefault(table[fd], []).append(f)
+            else:
+                listed.setdefault(i, []).append(f)
     directory_files = set()
     checksum_files = set()
-    for d in directories:
-        directory_files |= {os.path.join(d, f) for f in directories[d]
-                            if os.path.join(d, f) not in checksums}
-    for c in checksums:
-        checksum_files |= {os.path.normpath(os.path.join(os.path.dirname(c), f)) for f in checksums[c]}
-    return directory_files - checksum_files, checksum_files - directory_files
+    for i in on_disk.keys() | listed.keys():
+        only_disk, only_listed = _merge_difference(sorted(set(on_disk.get(i, ()))),
+                                                   sorted(set(listed.get(i, ()))))
+        d = table.paths[i]
+        directory_files.update(os.path.join(d, f) for f in only_disk)
+        checksum_files.update(os.path.join(d, f) for f in only_listed)
+    return directory_files, checksum_files
+
+
+def _options():
+    """Parse command-line options.
+
+    Returns
+    -------
+    :class:`argparse.Namespace`
+        The parsed options.
+    """
+    prsr = ArgumentParser(description='Compare files on disk to the contents of checksum files.')
+    prsr.add_argument('-w', '--workers', type=int, metavar='N',
+                      help='Use N threads to list directories.')
+    prsr.add_argument('-c', '--cache', metavar='DIR',
+                      help='Cache parsed checksum files in DIR.')
+    prsr.add_argument('-i', '--index', metavar='FILE',
+                      help='Keep a persistent index of the directory tree in FILE, and only rescan directories that have changed.')
+    prsr.add_argument('root', metavar='DIR', help='Root of the directory tree to explore.')
+    options = prsr.parse_args()
+    if options.index and options.cache:
+        prsr.error('--cache has no effect with --index, which only parses checksum files that have changed.')
+    return options
 
 
 def main():
@@ -105,7 +391,15 @@ def main():
     :class:`int`
         An integer suitable for passing to :func:`sys.exit`.
     """
-    directories, checksums = find_all_files(sys.argv[1])
+    options = _options()
+    if options.index:
+        from .index import InventoryIndex
+        with InventoryIndex(options.index) as index:
+            index.refresh(options.root, workers=options.workers)
+            directories, checksums = index.directories(), index.checksums()
+    else:
+        cache = ChecksumCache(options.cache) if options.cache else None
+        directories, checksums = find_all_files(options.root, workers=options.workers, cache=cache)
     status = 0
     on_disk, in_checksum = checksum_accounting(directories, checksums)
     if on_disk:
@@ -0,0 +1,281 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst.
+"""
+=====================
+desida.inventory_file
+=====================
+
+Write and read sorted inventory files, *e.g.* ``inventory-iron.txt``.
+
+The plain inventory file is a sorted list of paths relative to the top of
+the tree, one per line, each starting with ``./``, as consumed by
+``desi_globus_coadd.sh``.  Optionally, a detailed inventory is written as
+well: tab-separated path, size, modification time and checksum (taken from
+existing checksum files, ``-`` if there is none), compressed in independent
+gzip blocks, with a ``.idx`` file recording the first path and byte offset
+of each block.  Any gzip reader can read the whole detailed inventory, but
+:class:`InventoryReader` can also seek directly to a path prefix.
+
+Sorting uses an external merge sort, so memory use is bounded regardless
+of the number of files.
+"""
+import os
+import sys
+import gzip
+import zlib
+import heapq
+import bisect
+import tempfile
+from argparse import ArgumentParser
+from desiutil.log import log
+from .walker import walk
+from .inventory import checksum_contents, ChecksumCache
+
+
+#: Number of records to sort in memory before spilling to a temporary file.
+DEFAULT_CHUNK_SIZE = 1000000
+
+#: Number of lines in each independently compressed block.
+DEFAULT_BLOCK_LINES = 10000
+
+
+def _key(line):
+    """Sort key of a temporary record: the path, then the record type.
+    """
+    path, kind, rest = line.split('\t', 2)
+    return path, kind
+
+
+def _spill(records, tmpdir, runs):
+    """Sort `records` and write them to a new temporary file in `tmpdir`.
+    """
+    records.sort()
+    fd, name = tempfile.mkstemp(dir=tmpdir, suffix='.tsv')
+    with os.fdopen(fd, 'w', errors='surrogateescape') as t:
+        t.writelines('\t'.join(r) + '\n' for r in records)
+    runs.append(name)
+    records.clear()
+
+
+def _records(root, workers=None, cache=None, cext='.sha256sum'):
+    """Generate file and checksum records for the tree at `root`.
+
+    File records have type ``'0'`` and carry the size and modification time;
+    checksum records have type ``'1'`` and carry the checksum.
+    """
+    for listing in walk(root, workers=workers, stat=True):
+        rel = os.path.relpath(listing.dirpath, root)
+        prefix = '.' if rel == '.' else './' + rel
+        for f in listing.filenames:
+            st = listing.stats[f]
+            yield (f'{prefix}/{f}', '0', f'{st.st_size}\t{int(st.st_mtime)}')
+            if os.path.splitext(f)[1] == cext:
+                for ff, digest in checksum_contents(os.path.join(listing.dirpath, f), cache=cache).items():
+                    p = os.path.normpath(os.path.join(rel, ff))
+                    yield ('./' + p, '1', digest)
+
+
+def sorted_inventory(root, workers=None, cache=None, chunk_size=DEFAULT_CHUNK_SIZE, tmpdir=None):
+    """Generate a sorted inventory of the tree at `root`.
+
+    Parameters
+    ----------
+    root : :class:`str`
+        The root of the directory tree.
+    workers : :class:`int`, optional
+        Number of threads used to list directories.
+    cache : :class:`~desida.inventory.ChecksumCache`, optional
+        Use and update this cache of parsed checksum files.
+    chunk_size : :class:`int`, optional
+        Number of records to sort in memory at once.
+    tmpdir : :class:`str`, optional
+        Directory for temporary files.
+
+    Yields
+    ------
+    :class:`tuple`
+        Path relative to `root`, starting with ``./``; size; modification
+        time; and checksum, or ``-`` if the file is not in a checksum file.
+    """
+    with tempfile.TemporaryDirectory(dir=tmpdir) as t:
+        runs = list()
+        records = list()
+        for r in _records(root, workers=workers, cache=cache):
+            records.append(r)
+            if len(records) >= chunk_size:
+                _spill(records, t, runs)
+        _spill(records, t, runs)
+        log.debug("Merging %d sorted runs.", len(runs))
+        files = [open(r, errors='surrogateescape') for r in runs]
+        try:
+            current = None
+            for line in heapq.merge(*files, key=_key):
+                path, kind, rest = line.rstrip('\n').split('\t', 2)
+                if current is not None and current[0] != path:
+                    yield tuple(current)
+                    current = None
+                if kind == '0':
+                    size, mtime = rest.split('\t')
+                    current = [path, size, mtime, '-']
+                elif current is not None:
+                    current[3] = rest
+            if current is not None:
+                yield tuple(current)
+        finally:
+            for f in files:
+                f.close()
+
+
+def write_inventory(root, output=None, detail=None, workers=None, cache=None,
+                    chunk_size=DEFAULT_CHUNK_SIZE, block_lines=DEFAULT_BLOCK_LINES, tmpdir=None):
+    """Write inventory files for the tree at `root`.
+
+    Parameters
+    ----------
+    root : :class:`str`
+        The root of the directory tree.
+    output : :class:`str`, optional
+        Write a plain, sorted list of paths to this file.
+    detail : :class:`str`, optional
+        Write a block-compressed, detailed inventory to this file, and its
+        index to `detail` + ``.idx``.
+    workers : :class:`int`, optional
+        Number of threads used to list directories.
+    cache : :class:`~desida.inventory.ChecksumCache`, optional
+        Use and update this cache of parsed checksum files.
+    chunk_size : :class:`int`, optional
+        Number of records to sort in memory at once.
+    block_lines : :class:`int`, optional
+        Number of lines in each compressed block of `detail`.
+    tmpdir : :class:`str`, optional
+        Directory for temporary files.
+
+    Returns
+    -------
+    :class:`int`
+        The number of files in the inventory.
+    """
+    o = open(output, 'w', errors='surrogateescape') if output else None
+    d = open(detail, 'wb') if detail else None
+    x = open(detail + '.idx', 'w', errors='surrogateescape') if detail else None
+    n = 0
+    block = list()
+
+    def flush():
+        x.write(f"{block[0].split(chr(9), 1)[0]}\t{d.tell()}\n")
+        d.write(gzip.compress(''.join(block).encode('utf-8', 'surrogateescape'), mtime=0))
+        block.clear()
+
+    try:
+        for path, size, mtime, digest in sorted_inventory(root, workers=workers, cache=cache,
+                                                          chunk_size=chunk_size, tmpdir=tmpdir):
+            n += 1
+            if o is not None:
+                o.write(path + '\n')
+            if d is not None:
+                block.append(f'{path}\t{size}\t{mtime}\t{digest}\n')
+                if len(block) >= block_lines:
+                    flush()
+        if d is not None and block:
+            flush()
+    finally:
+        for f in (o, d, x):
+            if f is not None:
+                f.close()
+    log.info("Wrote %d files to inventory.", n)
+    return n
+
+
+class InventoryReader(object):
+    """Read a detailed inventory written by :func:`write_inventory`.
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        The detailed inventory file.  The index file, `filename` + ``.idx``,
+        must also exist.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.paths = list()
+        self.offsets = list()
+        with open(filename + '.idx', errors='surrogateescape') as x:
+            for line in x:
+                path, offset = line.rstrip('\n').rsplit('\t', 1)
+                self.paths.append(path)
+                self.offsets.append(int(offset))
+
+    def _blocks(self, start):
+        """Yield the decompressed lines of each block, starting with block `start`.
+        """
+        with open(self.filename, 'rb') as f:
+            for b in range(start, len(self.offsets)):
+                f.seek(self.offsets[b])
+                end = self.offsets[b + 1] if b + 1 < len(self.offsets) else None
+                data = f.read() if end is None else f.read(end - self.offsets[b])
+                text = zlib.decompress(data, wbits=31).decode('utf-8', 'surrogateescape')
+                yield text.splitlines()
+
+    def iter_prefix(self, prefix=''):
+        """Iterate over inventory entries whose path starts with `prefix`.
+
+        Parameters
+        ----------
+        prefix : :class:`str`, optional
+            Path prefix, *e.g.* ``./tiles/cumulative/1000/``.
+
+        Yields
+        ------
+        :class:`tuple`
+            Path, size, modification time and checksum.
+        """
+        start = max(0, bisect.bisect_right(self.paths, prefix) - 1)
+        for lines in self._blocks(start):
+            for line in lines:
+                path, size, mtime, digest = line.split('\t')
+                if path.startswith(prefix):
+                    yield path, int(size), int(mtime), digest
+                elif path > prefix:
+                    return
+
+
+def _options():
+    """Parse command-line options.
+
+    Returns
+    -------
+    :class:`argparse.Namespace`
+        The parsed options.
+    """
+    prsr = ArgumentParser(prog=os.path.basename(sys.argv[0]),
+                          description='Write sorted inventory files for a directory tree.')
+    prsr.add_argument('-c', '--cache', metavar='DIR',
+                      help='Cache parsed checksum files in DIR.')
+    prsr.add_argument('-d', '--detail', metavar='FILE',
+                      help='Write a compressed, seekable inventory with sizes, modification times and checksums to FILE.')
+    prsr.add_argument('-o', '--output', metavar='FILE',
+                      help='Write a plain, sorted list of files to FILE.')
+    prsr.add_argument('-t', '--tmpdir', metavar='DIR',
+                      help='Use DIR for temporary files.')
+    prsr.add_argument('-w', '--workers', type=int, metavar='N',
+                      help='Use N threads to list directories.')
+    prsr.add_argument('root', metavar='DIR', help='Root of the directory tree, e.g. ${DESI_SPECTRO_REDUX}/${SPECPROD}.')
+    options = prsr.parse_args()
+    if options.output is None and options.detail is None:
+        prsr.error('At least one of --output or --detail is required.')
+    return options
+
+
+def main():
+    """Entry-point for command-line scripts.
+
+    Returns
+    -------
+    :class:`int`
+        An integer suitable for passing to :func:`sys.exit`.
+    """
+    options = _options()
+    cache = ChecksumCache(options.cache) if options.cache else None
+    write_inventory(options.root, output=options.output, detail=options.detail,
+                    workers=options.workers, cache=cache, tmpdir=options.tmpdir)
+    return 0
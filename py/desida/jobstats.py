@@ -0,0 +1,241 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst.
+"""
+===============
+desida.jobstats
+===============
+
+Cluster utilization and queue-wait analytics from production queue info.
+
+These work on the qinfo Table returned by :func:`desida.prodjobs.load_qinfo`,
+using its SUBMIT, ELIGIBLE, START, END, NNODES and GPU columns.
+"""
+
+import os
+import numpy as np
+from astropy.table import Table
+
+from desiutil.log import get_logger
+
+from desida.prodjobs import group_codes
+
+def _as_str(values):
+    """
+    Return an array of str, decoding bytes such as FITS string columns
+    """
+    values = np.asarray(values)
+    if values.dtype.kind == 'S':
+        values = np.char.decode(values)
+    return values.astype(str)
+
+def sacct_times(times):
+    """
+    Convert an array of sacct timestamps into seconds since the epoch
+
+    Args:
+        times: array of strings like '2023-01-01T12:34:56'; sacct uses
+            'Unknown' or 'None' for times that have not happened yet
+
+    Returns (seconds, valid) int64 array and boolean array of whether
+    each timestamp was valid
+    """
+    times = _as_str(times)
+    valid = (np.char.str_len(times) >= 19) & np.char.isdigit(times.astype('U1'))
+    seconds = np.zeros(len(times), dtype=np.int64)
+    if np.any(valid):
+        seconds[valid] = times[valid].astype('datetime64[s]').astype(np.int64)
+    return seconds, valid
+
+def _iso(seconds):
+    """
+    Convert an array of seconds since the epoch into ISO timestamp strings
+    """
+    return np.asarray(seconds, dtype=np.int64).astype('datetime64[s]').astype(str)
+
+def node_timeline(qinfo):
+    """
+    Return the number of CPU and GPU nodes in use over time
+
+    Args:
+        qinfo: Table of job queue info
+
+    Returns Table with columns TIME,CPU_NODES,GPU_NODES with one row per
+    time that a job started or ended, giving the nodes in use from that
+    time until the next row.  Jobs without both START and END are skipped.
+    """
+    log = get_logger()
+    start, start_ok = sacct_times(qinfo['START'])
+    end, end_ok = sacct_times(qinfo['END'])
+    ok = start_ok & end_ok
+    if np.count_nonzero(~ok) > 0:
+        log.info(f'Skipping {np.count_nonzero(~ok)} jobs without START and END in timeline')
+
+    nnodes = np.asarray(qinfo['NNODES'], dtype=np.int64)[ok]
+    gpu = np.asarray(qinfo['GPU'], dtype=bool)[ok]
+
+    #- sweep line: +NNODES at START, -NNODES at END
+    times = np.concatenate([start[ok], end[ok]])
+    delta = np.concatenate([nnodes, -nnodes])
+    isgpu = np.concatenate([gpu, gpu])
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    cpu_nodes = np.cumsum(np.where(isgpu[order], 0, delta[order]))
+    gpu_nodes = np.cumsum(np.where(isgpu[order], delta[order], 0))
+
+    #- keep the state after the last event at each time
+    last = np.flatnonzero(np.append(times[1:] != times[:-1], len(times) > 0))
+
+    t = Table()
+    t['TIME'] = _iso(times[last])
+    t['CPU_NODES'] = cpu_nodes[last]
+    t['GPU_NODES'] = gpu_nodes[last]
+    return t
+
+def _group_percentiles(codes, values, ngroups, percentiles):
+    """
+    Return per-group percentiles of `values`
+
+    Args:
+        codes: int array of group of each value
+        values: float array
+        ngroups (int): number of groups
+        percentiles: list of percentiles in 0-100
+
+    Returns dict of percentile -> float array of length ngroups, NaN for empty groups
+    """
+    order = np.lexsort((values, codes))
+    values = values[order]
+    counts = np.bincount(codes, minlength=ngroups)
+    starts = np.concatenate([[0,], np.cumsum(counts)[:-1]])
+    nonempty = counts > 0
+
+    result = dict()
+    for p in percentiles:
+        pos = (p / 100.) * np.maximum(counts - 1, 0)
+        lo = np.floor(pos).astype(np.int64)
+        hi = np.ceil(pos).astype(np.int64)
+        x = np.full(ngroups, np.nan)
+        i = starts[nonempty]
+        x[nonempty] = values[i + lo[nonempty]] + (pos - lo)[nonempty] * (
+            values[i + hi[nonempty]] - values[i + lo[nonempty]])
+        result[p] = x
+    return result
+
+def queue_wait(qinfo, groupby=('JOBDESC',), percentiles=(50, 90, 99)):
+    """
+    Return the distribution of queue wait times (ELIGIBLE to START)
+
+    Args:
+        qinfo: Table of job queue info
+
+    Options:
+        groupby: list of columns to group by
+        percentiles: percentiles of the wait time to report
+
+    Returns Table with columns groupby,NJOBS,WAIT_HOURS,MEAN,P50,...,MAX with
+    one row per group; WAIT_HOURS is the total and the other columns are hours.
+    """
+    eligible, eligible_ok = sacct_times(qinfo['ELIGIBLE'])
+    start, start_ok = sacct_times(qinfo['START'])
+    ok = eligible_ok & start_ok
+    qinfo = qinfo[ok]
+    wait = np.maximum(start[ok] - eligible[ok], 0) / 3600.
+
+    groupby = list(groupby)
+    codes, first = group_codes(qinfo, groupby)
+    ngroups = len(first)
+
+    t = Table()
+    for key in groupby:
+        t[key] = np.asarray(qinfo[key])[first]
+
+    njobs = np.bincount(codes, minlength=ngroups)
+    total = np.bincount(codes, weights=wait, minlength=ngroups)
+    t['NJOBS'] = njobs
+    t['WAIT_HOURS'] = total.round(2)
+    t['MEAN'] = (total / np.maximum(njobs, 1)).round(3)
+    for p, x in _group_percentiles(codes, wait, ngroups, percentiles).items():
+        t[f'P{p}'] = x.round(3)
+
+    maxwait = np.zeros(ngroups)
+    np.maximum.at(maxwait, codes, wait)
+    t['MAX'] = maxwait.round(3)
+    return t
+
+def night_throughput(qinfo):
+    """
+    Return jobs and node-hours per night
+
+    Args:
+        qinfo: Table of job queue info, with a NIGHT column
+
+    Returns Table with columns NIGHT,NJOBS,COMPLETED,NODE_HOURS,GPU_NODE_HOURS,
+    WAIT_HOURS,FIRST_START,LAST_END,WALLCLOCK_HOURS with one row per night.
+    NIGHT is 0 for jobs that are not in any proctable, e.g. zpix.
+    """
+    codes, first = group_codes(qinfo, ['NIGHT',])
+    ngroups = len(first)
+
+    node_hours = np.asarray(qinfo['NODE_HOURS'], dtype=float)
+    gpu = np.asarray(qinfo['GPU'], dtype=bool)
+    eligible, eligible_ok = sacct_times(qinfo['ELIGIBLE'])
+    start, start_ok = sacct_times(qinfo['START'])
+    end, end_ok = sacct_times(qinfo['END'])
+    waited = eligible_ok & start_ok
+    wait = np.where(waited, np.maximum(start - eligible, 0), 0) / 3600.
+
+    first_start = np.full(ngroups, np.iinfo(np.int64).max)
+    np.minimum.at(first_start, codes[start_ok], start[start_ok])
+    last_end = np.full(ngroups, np.iinfo(np.int64).min)
+    np.maximum.at(last_end, codes[end_ok], end[end_ok])
+    known = (first_start <= last_end)
+
+    t = Table()
+    t['NIGHT'] = np.asarray(qinfo['NIGHT'])[first]
+    t['NJOBS'] = np.bincount(codes, minlength=ngroups)
+    t['COMPLETED'] = np.bincount(codes[_as_str(qinfo['STATE']) == 'COMPLETED'], minlength=ngroups)
+    t['NODE_HOURS'] = np.bincount(codes, weights=node_hours, minlength=ngroups).round(1)
+    t['GPU_NODE_HOURS'] = np.bincount(codes[gpu], weights=node_hours[gpu], minlength=ngroups).round(1)
+    t['WAIT_HOURS'] = np.bincount(codes, weights=wait, minlength=ngroups).round(1)
+    t['FIRST_START'] = np.where(known, _iso(np.where(known, first_start, 0)), '')
+    t['LAST_END'] = np.where(known, _iso(np.where(known, last_end, 0)), '')
+    t['WALLCLOCK_HOURS'] = np.where(known, (last_end - first_start) / 3600., 0).round(2)
+    return t
+
+def analysis_filenames(summaryfile):
+    """
+    Return dict of analysis name -> filename next to `summaryfile`
+
+    e.g. summary.csv -> summary-timeline.csv, summary-queuewait.csv, summary-nights.csv
+    """
+    base, ext = os.path.splitext(summaryfile)
+    return {name: f'{base}-{name}{ext}' for name in ('timeline', 'queuewait', 'nights')}
+
+def write_analysis(qinfo, summaryfile, overwrite=False):
+    """
+    Write utilization timeline, queue wait and per-night tables next to `summaryfile`
+
+    Args:
+        qinfo: Table of job queue info
+        summaryfile (str): summary filename; see analysis_filenames
+
+    Options:
+        overwrite (bool): overwrite pre-existing files
+
+    Returns dict of analysis name -> Table.  The per-night table is skipped
+    if qinfo has no NIGHT column, e.g. a table written by an older version.
+    """
+    log = get_logger()
+    tables = dict(
+        timeline=node_timeline(qinfo),
+        queuewait=queue_wait(qinfo),
+        )
+    if 'NIGHT' in qinfo.colnames:
+        tables['nights'] = night_throughput(qinfo)
+    else:
+        log.warning('No NIGHT column in qinfo; skipping per-night throughput')
+    for name, filename in analysis_filenames(summaryfile).items():
+        if name not in tables:
+            continue
+        tables[name].write(filename, overwrite=overwrite)
+        log.info(f'Wrote {filename}')
+    return tables
@@ -7,105 +7,435 @@ desida.prodjobs
 Tools for querying and saving queue info for production jobs.
 """
 
-import os, sys, glob, argparse
+import os, sys, re, glob, argparse
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
+from astropy.io import fits
 from astropy.table import Table, vstack
 
 from desiutil.log import get_logger
 
 import desispec.io
 from desispec.workflow.tableio import load_table
-from desispec.workflow.queue import queue_info_from_qids
 
-def load_proctables(specprod=None):
+from desida.queue import query_queue, FixtureBackend, default_columns
+from desida.zpixlogs import find_zpix_logs, zpix_log_tails
+
+def _proctable_files(specprod=None):
     """
-    Return list of processing tables, loaded from a production
+    Return sorted list of processing table filenames for a production
 
     Options:
         specprod (str): override $SPECPROD, production name
 
-    Returns: list of proctables
+    Returns: list of filenames
     """
-
     procfiletemplate = desispec.io.findfile('proctable', night='99999999', specprod=specprod, readonly=True)
     procfiles = sorted(glob.glob(procfiletemplate.replace('99999999', '202?????')))
+    return procfiles
+
+def _proctable_night(filename):
+    """
+    Return integer night parsed from a processing table filename
+    """
+    return int(re.findall(r'20\d{6}', os.path.basename(filename))[-1])
+
+def _load_proctable(filename):
+    """
+    Load a single processing table
+    """
+    return load_table(filename, tabletype='proctable', suppress_logging=True)
+
+def load_proctables(specprod=None, nproc=8):
+    """
+    Return list of processing tables, loaded from a production
+
+    Options:
+        specprod (str): override $SPECPROD, production name
+        nproc (int): number of threads used to read the tables
+
+    Returns: list of proctables
+    """
+    procfiles = _proctable_files(specprod)
+    with ThreadPoolExecutor(max_workers=nproc) as pool:
+        proctables = list(pool.map(_load_proctable, procfiles))
 
-    proctables = [load_table(fn, tabletype='proctable', suppress_logging=True) for fn in procfiles]
     return proctables
 
+def _join_ids(ids):
+    """
+    Convert an array of integer IDs into a '|'-separated string
+    """
+    return '|'.join(str(i) for i in np.atleast_1d(ids))
+
+def split_ids(joined):
+    """
+    Convert a '|'-separated string of integer IDs into a list of int
+    """
+    return [int(i) for i in joined.split('|') if i]
+
+def _consolidate(night, ptab):
+    """
+    Convert a single proctable into a Table of the columns used by desida
+
+    Args:
+        night (int): night of the proctable
+        ptab: processing Table
+
+    Returns Table with columns NIGHT,INTID,JOBDESC,LATEST_QID,ALL_QIDS,INT_DEP_IDS,
+    with ALL_QIDS and INT_DEP_IDS stored as '|'-separated strings.
+    """
+    n = len(ptab)
+    t = Table()
+    t['NIGHT'] = np.full(n, night, dtype=np.int32)
+    t['INTID'] = np.asarray(ptab['INTID'], dtype=np.int64)
+    t['JOBDESC'] = np.asarray(ptab['JOBDESC'], dtype=str)
+    t['LATEST_QID'] = np.asarray(ptab['LATEST_QID'], dtype=np.int64)
+    t['ALL_QIDS'] = np.array([_join_ids(q) for q in ptab['ALL_QIDS']], dtype=str)
+    t['INT_DEP_IDS'] = np.array([_join_ids(d) for d in ptab['INT_DEP_IDS']], dtype=str)
+    return t
+
+def load_proctable_jobs(specprod=None, cachefile=None, nproc=8):
+    """
+    Return a single consolidated table of the jobs in all processing tables
+
+    Only the columns needed by desida are kept.  If `cachefile` is given, the
+    consolidated table is cached there, together with the modification time
+    of each night's processing table, and later calls re-read only the nights
+    whose processing tables have changed.
+
+    Options:
+        specprod (str): override $SPECPROD, production name
+        cachefile (str): FITS file to cache consolidated proctables
+        nproc (int): number of threads used to read the tables
+
+    Returns: Table with columns NIGHT,INTID,JOBDESC,LATEST_QID,ALL_QIDS,INT_DEP_IDS
+    """
+    log = get_logger()
+    procfiles = _proctable_files(specprod)
+    nights = [_proctable_night(fn) for fn in procfiles]
+    with ThreadPoolExecutor(max_workers=nproc) as pool:
+        mtimes = list(pool.map(lambda fn: os.stat(fn).st_mtime_ns, procfiles))
+
+    cached = dict()
+    cached_mtimes = dict()
+    if cachefile is not None and os.path.exists(cachefile):
+        jobs = Table.read(cachefile, hdu='PROCTABLES', mask_invalid=False)
+        #- read strings as str like freshly loaded proctables
+        jobs.convert_bytestring_to_unicode()
+        cache_nights = Table.read(cachefile, hdu='NIGHTS', mask_invalid=False)
+        cached_mtimes = dict(zip(cache_nights['NIGHT'].tolist(), cache_nights['MTIME'].tolist()))
+        if len(jobs) > 0:
+            jobs = jobs.group_by('NIGHT')
+            for key, group in zip(jobs.groups.keys['NIGHT'], jobs.groups):
+                cached[int(key)] = group
+
+    stale = [(night, fn) for night, fn, mtime in zip(nights, procfiles, mtimes)
+             if cached_mtimes.get(night) != mtime]
+    log.info(f'Reading {len(stale)} of {len(procfiles)} processing tables')
+    with ThreadPoolExecutor(max_workers=nproc) as pool:
+        loaded = pool.map(lambda nf: _consolidate(nf[0], _load_proctable(nf[1])), stale)
+        for (night, fn), t in zip(stale, loaded):
+            cached[night] = t
+
+    tables = [cached[night] for night in nights if night in cached]
+    if len(tables) > 0:
+        jobs = vstack(tables)
+    else:
+        jobs = _consolidate(0, Table(names=['INTID', 'JOBDESC', 'LATEST_QID', 'ALL_QIDS', 'INT_DEP_IDS']))
+
+    if cachefile is not None and (stale or set(cached_mtimes) != set(nights)):
+        night_table = Table()
+        night_table['NIGHT'] = np.array(nights, dtype=np.int32)
+        night_table['MTIME'] = np.array(mtimes, dtype=np.int64)
+        hdus = fits.HDUList([fits.PrimaryHDU(),
+                             fits.table_to_hdu(jobs),
+                             fits.table_to_hdu(night_table)])
+        hdus[1].name = 'PROCTABLES'
+        hdus[2].name = 'NIGHTS'
+        tmpfile = cachefile + '.tmp'
+        hdus.writeto(tmpfile, overwrite=True)
+        os.replace(tmpfile, cachefile)
+        log.info(f'Updated proctable cache {cachefile}')
+
+    return jobs
+
+def _asfloat(a):
+    """
+    Convert array of numeric strings to float, treating '' as 0
+    """
+    return np.where(a == '', '0', a).astype(float)
+
+def elapsed2hours(elapsed):
+    """
+    Convert an array of Slurm elapsed times into floating point hours
+
+    Args:
+        elapsed: array of strings in Slurm [D-][HH:]MM:SS[.sss] format
+
+    Returns float array of hours
+    """
+    elapsed = np.asarray(elapsed)
+    if elapsed.dtype.kind == 'S':
+        elapsed = np.char.decode(elapsed)
+    elapsed = np.char.strip(elapsed.astype(str))
+
+    #- D-HH:MM:SS -> days, HH:MM:SS
+    parts = np.char.partition(elapsed, '-')
+    hasdays = parts[..., 1] == '-'
+    days = _asfloat(np.where(hasdays, parts[..., 0], ''))
+    hhmmss = np.where(hasdays, parts[..., 2], elapsed)
+
+    #- MM:SS -> 00:MM:SS
+    hhmmss = np.where(np.char.count(hhmmss, ':') < 2, np.char.add('00:', hhmmss), hhmmss)
+
+    hhmm = np.char.rpartition(hhmmss, ':')
+    ss = _asfloat(hhmm[..., 2])
+    hh = np.char.rpartition(hhmm[..., 0], ':')
+    mm = _asfloat(hh[..., 2])
+    hh = _asfloat(hh[..., 0])
+
+    return 24*days + hh + mm/60. + ss/3600.
+
 def hhmmss2hours(hhmmss):
     """
-    Convert an hh:mm:ss string into floating point hours
+    Convert an [D-]hh:mm:ss string into floating point hours
+    """
+    return float(elapsed2hours([hhmmss,])[0])
+
+def get_zpix_logs(specprod=None, cachefile=None, nproc=8, tails=False):
+    """
+    Return Table of zpix logs and their jobids, parsed from log filenames
+
+    Options:
+        specprod (str): override $SPECPROD, production name
+        cachefile (str): FITS file to cache the healpix directory listings
+        nproc (int): number of threads used to list directories
+        tails (bool): also parse the job state and elapsed time from each log
+
+    Returns: Table with columns PATH,QID (+STATE,EXITCODE,ELAPSED if tails);
+        see desida.zpixlogs.find_zpix_logs
     """
-    hh, mm, ss = hhmmss.split(':')
-    hours = int(hh) + int(mm)/60. + int(ss)/3600.
-    return hours
+    proddir = desispec.io.specprod_root(specprod)
+    return find_zpix_logs(f'{proddir}/run/scripts/healpix', cachefile=cachefile,
+                          workers=nproc, tails=tails)
 
-def get_zpix_qids(specprod=None):
+def get_zpix_qids(specprod=None, cachefile=None, nproc=8):
     """
     Return list of zpix jobids, parsed from log filenames
 
     Options:
         specprod (str): override $SPECPROD, production name
+        cachefile (str): FITS file to cache the healpix directory listings
+        nproc (int): number of threads used to list directories
 
     Returns: list of jobids
     """
+    return get_zpix_logs(specprod, cachefile=cachefile, nproc=nproc)['QID'].tolist()
+
+def _add_zpix_log_info(qinfo, zpixlogs, cachefile=None, nproc=8):
+    """
+    Add rows to qinfo for zpix jobs that sacct no longer remembers
+
+    Args:
+        qinfo: Table of job queue info
+        zpixlogs: Table from get_zpix_logs
+
+    Options:
+        cachefile (str): FITS file to cache the parsed logs
+        nproc (int): number of threads used to parse logs
+
+    Returns qinfo with extra JOBDESC=zpix rows whose STATE, EXITCODE and ELAPSED
+    are parsed from the logs; NNODES and CONSTRAINTS are copied from a zpix job
+    that sacct does know, if any, otherwise 1 and ''.  Only the logs of these
+    jobs are parsed.
+    """
     log = get_logger()
-    proddir = desispec.io.specprod_root(specprod)
-    zpixlogs = sorted(glob.glob(f'{proddir}/run/scripts/healpix/*/*/*/zpix-*.log'))
-    zpix_qids = list()
-    for filename in zpixlogs:
-        try:
-            qid = os.path.splitext(os.path.basename(filename))[0].split('-')[-1]
-            qid = int(qid)
-        except ValueError:
-            log.error(f'Unable to parse integer qid from {filename}; skipping')
-            continue
+    known = np.asarray(qinfo['JOBDESC']) == 'zpix'
+    missing = ~np.isin(zpixlogs['QID'], np.asarray(qinfo['JOBID'])[known])
+    n = np.count_nonzero(missing)
+    if n == 0:
+        return qinfo
+
+    log.info(f'Adding {n} zpix jobs from their logs')
+    logs = zpix_log_tails(zpixlogs, zpixlogs['QID'][missing], cachefile=cachefile, workers=nproc)
+    extra = Table()
+    for col in qinfo.colnames:
+        dtype = qinfo[col].dtype
+        if dtype.kind in 'US':
+            extra[col] = np.full(n, '')
+        else:
+            extra[col] = np.zeros(n, dtype=dtype)
+    extra['JOBID'] = logs['QID']
+    extra['JOBNAME'] = [os.path.splitext(os.path.basename(p))[0] for p in logs['PATH']]
+    extra['JOBDESC'] = np.full(n, 'zpix')
+    extra['NNODES'] = np.full(n, qinfo['NNODES'][known][0] if np.any(known) else 1)
+    extra['CONSTRAINTS'] = np.full(n, qinfo['CONSTRAINTS'][known][0] if np.any(known) else '')
+    for col in ('STATE', 'EXITCODE', 'ELAPSED'):
+        extra[col] = logs[col]
+
+    return vstack([qinfo, extra])
+
+#- Slurm job states that will not change again
+terminal_states = ('COMPLETED', 'FAILED', 'TIMEOUT', 'CANCELLED', 'NODE_FAIL',
+                   'OUT_OF_MEMORY', 'BOOT_FAIL', 'DEADLINE')
+
+def is_terminal(states):
+    """
+    Return boolean array of whether each Slurm job state is final
+
+    Args:
+        states: array of Slurm job states, e.g. 'COMPLETED' or 'CANCELLED by 12345'
+
+    Returns boolean array
+    """
+    base = np.array([str(s).split(' ')[0] for s in states], dtype=str)
+    return np.isin(base, terminal_states)
+
+def query_qinfo(jobdesc_qids, storefile=None, backend=None, chunksize=1000, nthreads=4):
+    """
+    Query queue info for jobs, re-using previously stored records
+
+    If `storefile` exists, jobs recorded there in a terminal state are not
+    queried again; only new jobs and jobs that were still pending or running
+    are.  The results are merged back into `storefile`.
+
+    Args:
+        jobdesc_qids: dict of JOBDESC -> list of QIDs
+
+    Options:
+        storefile (str): FITS file of job records to use and update
+        backend: queue query backend, see desida.queue; default sacct
+        chunksize (int): maximum number of QIDs per sacct query
+        nthreads (int): number of concurrent sacct queries
+
+    Returns: qinfo Table with the queue columns plus JOBDESC, for only the
+        requested jobs
+    """
+    log = get_logger()
+
+    stored = None
+    done = set()
+    if storefile is not None and os.path.exists(storefile):
+        #- keep empty strings, and read strings as str like freshly queried records
+        stored = Table.read(storefile, mask_invalid=False)
+        stored.convert_bytestring_to_unicode()
+        ii = is_terminal(stored['STATE'])
+        done = set(zip(stored['JOBDESC'][ii].tolist(), stored['JOBID'][ii].tolist()))
+
+    qinfo_tables = list()
+    requeried = set()
+    todo = dict()
+    nqids = 0
+    for jobdesc, qids in jobdesc_qids.items():
+        nqids += len(qids)
+        todo[jobdesc] = [q for q in qids if (jobdesc, q) not in done]
+        requeried.update((jobdesc, q) for q in todo[jobdesc])
+
+    if len(requeried) > 0:
+        qinfo_tables.append(query_queue(todo, backend=backend, columns=default_columns,
+                                        chunksize=chunksize, nthreads=nthreads))
+
+    log.info(f'Queried {len(requeried)} of {nqids} jobs')
+
+    if stored is not None:
+        keep = np.array([key not in requeried for key in zip(stored['JOBDESC'].tolist(), stored['JOBID'].tolist())], dtype=bool)
+        qinfo_tables.insert(0, stored[keep])
+
+    qinfo = vstack(qinfo_tables)
+
+    if storefile is not None and len(requeried) > 0:
+        tmpfile = storefile + '.tmp.fits'
+        qinfo.write(tmpfile, overwrite=True)
+        os.replace(tmpfile, storefile)
+        log.info(f'Updated job records {storefile}')
+
+    #- Only return the jobs that were requested
+    wanted = set((jobdesc, q) for jobdesc, qids in jobdesc_qids.items() for q in qids)
+    keep = np.array([key in wanted for key in zip(qinfo['JOBDESC'].tolist(), qinfo['JOBID'].tolist())], dtype=bool)
 
-        zpix_qids.append(qid)
+    return qinfo[keep]
 
-    return zpix_qids
+def qid_nights(jobs, qids):
+    """
+    Return the night of each QID, looked up in the consolidated proctables
+
+    Args:
+        jobs: Table from load_proctable_jobs
+        qids: array of QIDs
 
-def load_qinfo(specprod=None):
+    Returns int32 array of nights, 0 for QIDs not in any proctable
+    """
+    nqids = [len(split_ids(q)) for q in jobs['ALL_QIDS']]
+    allqids = np.array([q for joined in jobs['ALL_QIDS'] for q in split_ids(joined)], dtype=np.int64)
+    allnights = np.repeat(np.asarray(jobs['NIGHT'], dtype=np.int32), nqids)
+
+    qids = np.asarray(qids, dtype=np.int64)
+    nights = np.zeros(len(qids), dtype=np.int32)
+    if len(allqids) == 0 or len(qids) == 0:
+        return nights
+
+    order = np.argsort(allqids, kind='stable')
+    allqids = allqids[order]
+    allnights = allnights[order]
+    i = np.searchsorted(allqids, qids).clip(max=len(allqids)-1)
+    found = allqids[i] == qids
+    nights[found] = allnights[i[found]]
+    return nights
+
+def load_qinfo(specprod=None, cachedir=None, nproc=8, backend=None, chunksize=1000, nthreads=4,
+               zpix_tails=False):
     """
     Load queue job info for a spectroscopic production
 
     Options:
         specprod (str): override $SPECPROD, production name
-
-    Returns: qinfo Table with columns JOBID,JOBNAME,PARTITION,CONSTRAINTS,NNODES,SUBMIT,ELIGIBLE,START,END,ELAPSED,STATE,EXITCODE
+        cachedir (str): directory for cached proctables and job records
+        nproc (int): number of threads used to read proctables
+        backend: queue query backend, see desida.queue; default sacct
+        chunksize (int): maximum number of QIDs per sacct query
+        nthreads (int): number of concurrent sacct queries
+        zpix_tails (bool): add zpix jobs unknown to sacct, parsed from their logs
+
+    Returns: qinfo Table with columns JOBID,JOBNAME,PARTITION,CONSTRAINTS,NNODES,SUBMIT,ELIGIBLE,START,END,ELAPSED,STATE,EXITCODE,
+        JOBDESC,NODE_HOURS,GPU,NIGHT
     """
+    if specprod is None:
+        specprod = os.environ['SPECPROD']
+
+    cachefile = None
+    zpixcache = None
+    if cachedir is not None:
+        os.makedirs(cachedir, exist_ok=True)
+        cachefile = os.path.join(cachedir, f'proctables-{specprod}.fits')
+        zpixcache = os.path.join(cachedir, f'zpixlogs-{specprod}.fits')
 
-    ptables = load_proctables(specprod)
+    jobs = load_proctable_jobs(specprod, cachefile=cachefile, nproc=nproc)
 
-    #- ptab['ALL_QIDS'] is a column of arrays of QIDs per task;
+    #- jobs['ALL_QIDS'] is a column of '|'-separated QIDs per task;
     #- concatenate and group by JOBDESC
     jobdesc_qids = dict()
-    for ptab in ptables:
-        for jobdesc in np.unique(ptab['JOBDESC']):
-            ii = (ptab['JOBDESC'] == jobdesc)
-            qids = list(np.concatenate(ptab['ALL_QIDS'][ii]))
-            if jobdesc not in jobdesc_qids:
-                jobdesc_qids[jobdesc] = qids
-            else:
-                jobdesc_qids[jobdesc].extend(qids)
+    for jobdesc, all_qids in zip(jobs['JOBDESC'], jobs['ALL_QIDS']):
+        jobdesc_qids.setdefault(str(jobdesc), list()).extend(split_ids(all_qids))
 
     #- Get healpix quids from job log filenames since they aren't tracked in proctables
-    jobdesc_qids['zpix'] = get_zpix_qids(specprod)
+    zpixlogs = get_zpix_logs(specprod, cachefile=zpixcache, nproc=nproc)
+    jobdesc_qids['zpix'] = zpixlogs['QID'].tolist()
 
     #- Cache all the qinfo before printing summaries do to intermediate logging
-    qinfo_tables = list()
-    columns='jobid,jobname,partition,constraints,nnodes,submit,eligible,start,end,elapsed,state,exitcode'
-    for jobdesc, qids in jobdesc_qids.items():
-        jobdesc_qinfo = queue_info_from_qids(qids, columns=columns)
-        jobdesc_qinfo['JOBDESC'] = jobdesc
-        qinfo_tables.append(jobdesc_qinfo)
+    storefile = None
+    if cachedir is not None:
+        storefile = os.path.join(cachedir, f'qinfo-{specprod}.fits')
 
-    qinfo = vstack(qinfo_tables)
+    qinfo = query_qinfo(jobdesc_qids, storefile=storefile, backend=backend,
+                        chunksize=chunksize, nthreads=nthreads)
+
+    if zpix_tails:
+        qinfo = _add_zpix_log_info(qinfo, zpixlogs, cachefile=zpixcache, nproc=nproc)
 
-    #- Parse HH:MM:SS strings into hours
+    #- Parse [D-]HH:MM:SS strings into hours
     #- round to 4 digits (sub-second) to avoid clutter in output files
-    hours = np.array([hhmmss2hours(hhmmss) for hhmmss in qinfo['ELAPSED']])
+    hours = elapsed2hours(qinfo['ELAPSED'])
     hours *= qinfo['NNODES']
     qinfo['NODE_HOURS'] = hours.round(4)
 
@@ -117,62 +447,136 @@ def load_qinfo(specprod=None):
     if np.any(ii):
         qinfo['STATE'][ii] = 'CANCELLED'
 
-    if specprod is None:
-        qinfo.meta['SPECPROD'] = os.environ['SPECPROD']
-    else:
-        qinfo.meta['SPECPROD'] = specprod
+    #- Night of each job from the proctables; 0 for zpix jobs
+    qinfo['NIGHT'] = qid_nights(jobs, qinfo['JOBID'])
+
+    qinfo.meta['SPECPROD'] = specprod
 
     return qinfo
 
-def summarize_qinfo(qinfo):
+#- Default ordering of JOBDESC in summaries; others are sorted after these
+jobdesc_order = ['linkcal', 'nightlybias', 'ccdcalib', 'arc', 'psfnight', 'flat', 'nightlyflat',
+                 'tilenight', 'cumulative', 'zpix']
+
+#- Job states counted in summaries
+summary_jobstates = ['COMPLETED', 'TIMEOUT', 'FAILED', 'CANCELLED', 'NODE_FAIL']
+
+def _factorize(values, order=None):
     """
-    Convert qinfo table into summary table
+    Return unique values and integer codes of `values`
 
     Args:
-        qinfo: Table of job queue info
+        values: array of values
+
+    Options:
+        order: list of values to put first, in this order
 
-    Returns summary Table with columns JOBDESC,CPUGPU,NODE_HOURS,PERCENT,+jobstates
-    with one row per jobdesc.
+    Returns (uniq, codes) such that uniq[codes] == values
+    """
+    uniq, codes = np.unique(np.asarray(values), return_inverse=True)
+    codes = codes.ravel()
+    if order is not None:
+        rank = {v:i for i,v in enumerate(order)}
+        keyrank = [rank.get(u, len(order)) for u in uniq.tolist()]
+        perm = np.lexsort((np.arange(len(uniq)), keyrank))
+        newcodes = np.empty(len(uniq), dtype=codes.dtype)
+        newcodes[perm] = np.arange(len(uniq))
+        uniq = uniq[perm]
+        codes = newcodes[codes]
+    return uniq, codes
+
+def group_codes(qinfo, groupby):
     """
-    jobstates = ['COMPLETED', 'TIMEOUT', 'FAILED', 'CANCELLED', 'NODE_FAIL']
+    Return integer group codes for the rows of `qinfo` grouped by `groupby`
 
-    #- Total node hours across all jobdesc
-    tot_hours = np.sum(qinfo['NODE_HOURS'])
+    Args:
+        qinfo: Table of job queue info
+        groupby: list of column names
 
-    rows = list()
-    for jobdesc in ['linkcal', 'nightlybias', 'ccdcalib', 'arc', 'psfnight', 'flat', 'nightlyflat',
-                    'tilenight', 'cumulative', 'zpix']:
-        ii = qinfo['JOBDESC'] == jobdesc
-        jobdesc_qinfo = qinfo[ii]
+    Returns (codes, first) where codes[i] is the group of row i and
+    first[g] is the index of the first row of group g.  Groups are ordered
+    by key, with JOBDESC in jobdesc_order.
+    """
+    missing = [key for key in groupby if key not in qinfo.colnames]
+    if len(missing) > 0:
+        raise ValueError(f'group by columns {missing} not in qinfo')
 
-        row = [jobdesc,]
+    codes = np.zeros(len(qinfo), dtype=np.int64)
+    for key in groupby:
+        order = jobdesc_order if key == 'JOBDESC' else None
+        uniq, keycodes = _factorize(qinfo[key], order=order)
+        codes = codes * len(uniq) + keycodes
 
-        if jobdesc_qinfo['GPU'][0]:
-            row.append('gpu')
-        else:
-            row.append('cpu')
+    _, first, codes = np.unique(codes, return_index=True, return_inverse=True)
+    return codes.ravel(), first
 
-        node_hours = round(np.sum(jobdesc_qinfo['NODE_HOURS']), 1)
-        percent_time = round(100 * node_hours/tot_hours, 1)
+def summarize_qinfo(qinfo, groupby=('JOBDESC',), jobstates=None):
+    """
+    Convert qinfo table into summary table
+
+    Args:
+        qinfo: Table of job queue info
 
-        row.append(node_hours)
-        row.append(percent_time)
+    Options:
+        groupby: list of columns to group by, e.g. JOBDESC,NIGHT,PARTITION,GPU,STATE
+        jobstates: list of job states to count; default summary_jobstates
 
-        for state in jobstates:
-            n = np.count_nonzero(jobdesc_qinfo['STATE'] == state)
-            row.append(n)
+    Returns summary Table with columns groupby,CPUGPU,NODE_HOURS,PERCENT,+jobstates
+    with one row per group.  CPUGPU is 'mixed' for groups with both CPU and GPU
+    jobs, and is left out when grouping by GPU.
+    """
+    groupby = list(groupby)
+    if jobstates is None:
+        jobstates = summary_jobstates
+
+    codes, first = group_codes(qinfo, groupby)
+    ngroups = len(first)
+
+    t = Table()
+    for key in groupby:
+        t[key] = np.asarray(qinfo[key])[first]
+
+    if 'GPU' not in groupby:
+        njobs = np.bincount(codes, minlength=ngroups)
+        ngpu = np.bincount(codes, weights=np.asarray(qinfo['GPU']), minlength=ngroups)
+        cpugpu = np.full(ngroups, 'mixed')
+        cpugpu[ngpu == 0] = 'cpu'
+        cpugpu[ngpu == njobs] = 'gpu'
+        t['CPUGPU'] = cpugpu
+
+    #- Total node hours across all groups
+    node_hours = np.bincount(codes, weights=np.asarray(qinfo['NODE_HOURS']), minlength=ngroups)
+    tot_hours = np.sum(node_hours)
+    t['NODE_HOURS'] = node_hours.round(1)
+    if tot_hours > 0:
+        t['PERCENT'] = (100 * node_hours / tot_hours).round(1)
+    else:
+        t['PERCENT'] = np.zeros(ngroups)
 
-        rows.append(row)
+    states = np.asarray(qinfo['STATE'])
+    for state in jobstates:
+        t[state] = np.bincount(codes[states == state], minlength=ngroups)
 
-    t = Table(rows=rows, names=['JOBDESC', 'CPUGPU', 'NODE_HOURS', 'PERCENT'] + jobstates)
     return t
 
 def parse(options=None):
     p = argparse.ArgumentParser()
     p.add_argument('-i', '--input',    help="input table of jobs (from a prior run of this script)")
     p.add_argument('-o', '--output',   help="output table of jobs")
-    p.add_argument('--summary',   help="save summary table to this file")
+    p.add_argument('--summary',   help="save summary table to this file, with node timeline, "
+                   "queue wait and per-night tables next to it")
+    p.add_argument('--groupby', default='JOBDESC',
+                   help="comma separated columns to summarize by, e.g. JOBDESC,NIGHT,PARTITION,GPU,STATE "
+                   "(default %(default)s)")
     p.add_argument('-s', '--specprod', help="override $SPECPROD")
+    p.add_argument('--cache-dir', help="cache consolidated proctables and job records in this directory; "
+                   "jobs already in a terminal state are not queried again")
+    p.add_argument('--nproc', type=int, default=8, help="number of threads for reading proctables")
+    p.add_argument('--chunksize', type=int, default=1000, help="maximum number of QIDs per sacct query")
+    p.add_argument('--nthreads', type=int, default=4, help="number of concurrent sacct queries")
+    p.add_argument('--zpix-log-tails', action="store_true",
+                   help="parse state and elapsed time of zpix jobs unknown to sacct from their logs")
+    p.add_argument('--sacct-fixture', help="use rows from this table instead of calling sacct, for testing")
     p.add_argument('--overwrite', action="store_true", help="Overwrite pre-existing --output and --summary files")
     p.add_argument('--debug', action="store_true", help="Start IPython at end instead of exiting")
     args = p.parse_args(options)
@@ -184,16 +588,25 @@ def main(args=None):
 
     if args.input is not None:
         qinfo = Table.read(args.input)
+        #- FITS string columns are read as bytes
+        qinfo.convert_bytestring_to_unicode()
     else:
-        qinfo = load_qinfo(args.specprod)
+        backend = None
+        if args.sacct_fixture is not None:
+            backend = FixtureBackend(args.sacct_fixture)
+        qinfo = load_qinfo(args.specprod, cachedir=args.cache_dir, nproc=args.nproc,
+                           backend=backend, chunksize=args.chunksize, nthreads=args.nthreads,
+                           zpix_tails=args.zpix_log_tails)
 
     if args.output is not None:
         qinfo.write(args.output, overwrite=args.overwrite)
 
-    summary = summarize_qinfo(qinfo)
+    summary = summarize_qinfo(qinfo, groupby=args.groupby.split(','))
 
     if args.summary is not None:
         summary.write(args.summary, overwrite=args.overwrite)
+        from desida.jobstats import write_analysis
+        write_analysis(qinfo, args.summary, overwrite=args.overwrite)
 
     print(summary)
 
@@ -0,0 +1,133 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst.
+"""
+============
+desida.queue
+============
+
+Chunked, concurrent, deduplicated queue info queries.
+
+QIDs from all job descriptions are deduplicated, split into chunks of
+bounded size and queried concurrently, with retries and exponential backoff.
+The results are then mapped back to each JOBDESC.  The backend that actually
+runs ``sacct`` is pluggable, so that :class:`FixtureBackend` can stand in for
+it to test and benchmark offline.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from astropy.table import Table, vstack
+
+from desiutil.log import get_logger
+
+#- Columns requested from sacct
+default_columns = 'jobid,jobname,partition,constraints,nnodes,submit,eligible,start,end,elapsed,state,exitcode'
+
+#- sacct columns that are read as integers; all others are read as strings
+int_columns = ('JOBID', 'NNODES', 'NCPUS', 'NTASKS', 'ALLOCCPUS', 'ALLOCNODES', 'REQCPUS', 'REQNODES')
+
+class SacctBackend(object):
+    """
+    Query Slurm with desispec.workflow.queue.queue_info_from_qids
+    """
+    def query(self, qids, columns=default_columns):
+        """
+        Return Table of queue info for `qids`
+        """
+        from desispec.workflow.queue import queue_info_from_qids
+        return queue_info_from_qids(qids, columns=columns)
+
+class FixtureBackend(object):
+    """
+    Stand-in for sacct that returns rows from a table file
+
+    Args:
+        filename (str): any table readable by astropy, e.g. the --output of
+            desi_eval_prod_jobs, with at least a JOBID column
+
+    Options:
+        delay (float): seconds to sleep per query, to mimic sacct latency
+    """
+    def __init__(self, filename, delay=0.0):
+        self.table = Table.read(filename)
+        self.delay = delay
+        self.index = dict()
+        for i, jobid in enumerate(self.table['JOBID'].tolist()):
+            self.index.setdefault(jobid, i)
+
+    def query(self, qids, columns=default_columns):
+        """
+        Return Table of queue info for `qids`
+        """
+        if self.delay > 0:
+            time.sleep(self.delay)
+        names = [c.upper() for c in columns.split(',') if c.upper() in self.table.colnames]
+        rows = [self.index[q] for q in qids if q in self.index]
+        return self.table[names][rows]
+
+def _query_with_retry(backend, qids, columns, retries=3, backoff=2.0):
+    """
+    Query `backend`, retrying with exponential backoff on failure
+    """
+    log = get_logger()
+    for attempt in range(retries + 1):
+        try:
+            return backend.query(qids, columns=columns)
+        except Exception as err:
+            if attempt == retries:
+                raise
+            wait = backoff ** attempt
+            log.warning(f'Queue query for {len(qids)} QIDs failed ({err}); retrying in {wait:.1f} s')
+            time.sleep(wait)
+
+def query_queue(jobdesc_qids, backend=None, columns=default_columns,
+                chunksize=1000, nthreads=4, retries=3, backoff=2.0):
+    """
+    Query queue info for jobs grouped by JOBDESC
+
+    Args:
+        jobdesc_qids: dict of JOBDESC -> list of QIDs
+
+    Options:
+        backend: object with a query(qids, columns) method; default SacctBackend
+        columns (str): comma separated columns to request
+        chunksize (int): maximum number of QIDs per query
+        nthreads (int): number of concurrent queries
+        retries (int): number of retries per chunk
+        backoff (float): base of exponential backoff in seconds
+
+    Returns: Table with the requested columns plus JOBDESC; a QID listed
+        under several JOBDESC appears once per JOBDESC but is queried once
+    """
+    log = get_logger()
+    if backend is None:
+        backend = SacctBackend()
+
+    allqids = np.unique(np.concatenate([np.asarray(q, dtype=np.int64) for q in jobdesc_qids.values()] +
+                                       [np.zeros(0, dtype=np.int64)]))
+    chunks = [allqids[i:i+chunksize].tolist() for i in range(0, len(allqids), chunksize)]
+    log.info(f'Querying {len(allqids)} unique QIDs in {len(chunks)} chunks')
+
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        results = list(pool.map(lambda qids: _query_with_retry(backend, qids, columns, retries, backoff), chunks))
+
+    results = [r for r in results if len(r) > 0]
+    if len(results) == 0:
+        #- same dtypes as real sacct results, so string operations still work
+        names = [c.upper() for c in columns.split(',')] + ['JOBDESC']
+        dtype = [np.int64 if name in int_columns else str for name in names]
+        return Table(names=names, dtype=dtype)
+
+    allinfo = vstack(results)
+    index = dict()
+    for i, jobid in enumerate(allinfo['JOBID'].tolist()):
+        index.setdefault(jobid, i)
+
+    tables = list()
+    for jobdesc, qids in jobdesc_qids.items():
+        rows = [index[q] for q in dict.fromkeys(qids) if q in index]
+        t = allinfo[rows]
+        t['JOBDESC'] = np.full(len(t), jobdesc)
+        tables.append(t)
+
+    return vstack(tables)
@@ -0,0 +1,477 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst.
+"""
+==================
+desida.transaction
+==================
+
+Journaled, resumable move-and-link transactions.
+
+Promoting data into a release moves a file or directory into the release
+tree and replaces the original path with a symlink to its new location.
+If that is interrupted between the two steps, the original path is simply
+missing.  Here each transaction is recorded in an SQLite journal as
+``planned``, ``moved`` and finally ``linked``, so an interrupted run can be
+resumed from the journal without rescanning anything.  Moves across
+filesystems pass through ``copied``, with the checksum of the copy, before
+the original is removed.  The filesystem is checked before each step, so a
+step that completed just before an interruption, but was not yet journaled,
+is not repeated.  A transaction that raises an error is recorded as
+``failed`` and is not attempted again until :meth:`MoveJournal.retry` is
+called.
+
+Moves within a filesystem are a single :func:`os.rename`.  Moves across
+filesystems copy the data to a temporary name while computing its SHA-256
+checksum, re-read the copy to verify it, and only then rename the copy into
+place and remove the original.
+"""
+import os
+import sys
+import stat
+import time
+import threading
+import shutil
+import sqlite3
+import hashlib
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from desiutil.log import log
+from .verify import hash_file, DEFAULT_BUFFER_SIZE
+
+
+#: Transaction states, in order.
+PLANNED, COPIED, MOVED, LINKED = 'planned', 'copied', 'moved', 'linked'
+
+
+#: State of a transaction that could not be completed.
+FAILED = 'failed'
+
+
+def _copy_file(src, dst, buffer_size=DEFAULT_BUFFER_SIZE):
+    """Copy a single file, returning the SHA-256 checksum of the data read.
+    """
+    h = hashlib.sha256()
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    with open(src, 'rb', buffering=0) as s, open(dst, 'wb') as d:
+        while True:
+            n = s.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+            d.write(view[:n])
+        d.flush()
+        os.fsync(d.fileno())
+    shutil.copystat(src, dst)
+    digest = h.hexdigest()
+    if hash_file(dst, buffer_size)[0] != digest:
+        raise OSError(f"Checksum of {dst} does not match {src}!")
+    return digest
+
+
+def _copy_tree(src, dst, buffer_size=DEFAULT_BUFFER_SIZE):
+    """Copy a directory tree, returning a SHA-256 checksum of all file checksums.
+    """
+    digests = list()
+    for dirpath, dirnames, filenames in os.walk(src):
+        rel = os.path.relpath(dirpath, src)
+        d = os.path.normpath(os.path.join(dst, rel))
+        os.makedirs(d, exist_ok=True)
+        for name in dirnames + filenames:
+            s = os.path.join(dirpath, name)
+            if os.path.islink(s):
+                os.symlink(os.readlink(s), os.path.join(d, name))
+                if name in dirnames:
+                    dirnames.remove(name)
+            elif name in filenames:
+                digests.append(f"{_copy_file(s, os.path.join(d, name), buffer_size)}  {os.path.join(rel, name)}\n")
+    #
+    # Copy directory permissions last, in case they remove write permission.
+    #
+    for dirpath, dirnames, filenames in os.walk(src, topdown=False):
+        shutil.copystat(dirpath, os.path.normpath(os.path.join(dst, os.path.relpath(dirpath, src))))
+    return hashlib.sha256(''.join(sorted(digests)).encode('utf-8', 'surrogateescape')).hexdigest()
+
+
+def _digest(path, buffer_size=DEFAULT_BUFFER_SIZE):
+    """Checksum of a file or directory tree, as returned by :func:`_copy_file` or :func:`_copy_tree`.
+    """
+    if not os.path.isdir(path) or os.path.islink(path):
+        return hash_file(path, buffer_size)[0]
+    digests = list()
+    for dirpath, dirnames, filenames in os.walk(path):
+        rel = os.path.relpath(dirpath, path)
+        for name in dirnames + filenames:
+            p = os.path.join(dirpath, name)
+            if os.path.islink(p):
+                if name in dirnames:
+                    dirnames.remove(name)
+            elif name in filenames:
+                digests.append(f"{hash_file(p, buffer_size)[0]}  {os.path.join(rel, name)}\n")
+    return hashlib.sha256(''.join(sorted(digests)).encode('utf-8', 'surrogateescape')).hexdigest()
+
+
+def _make_writable(path):
+    """Add owner write permission to `path` and every directory below it, so it can be removed.
+    """
+    for dirpath, dirnames, filenames in os.walk(path):
+        mode = os.stat(dirpath).st_mode
+        if not mode & stat.S_IWUSR:
+            os.chmod(dirpath, mode | stat.S_IWUSR)
+
+
+def _copy(src, dst, buffer_size=DEFAULT_BUFFER_SIZE):
+    """Copy `src` to `dst` across filesystems, via a temporary name, returning the checksum of the copy.
+    """
+    partial = dst + '.partial'
+    if os.path.lexists(partial):
+        log.warning("Removing incomplete copy %s.", partial)
+        _remove(partial)
+    log.debug("Copying '%s' to '%s' across filesystems.", src, dst)
+    if os.path.isdir(src) and not os.path.islink(src):
+        digest = _copy_tree(src, partial, buffer_size)
+    else:
+        digest = _copy_file(src, partial, buffer_size)
+    os.rename(partial, dst)
+    return digest
+
+
+def _remove(path):
+    """Remove a file or directory tree.
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        _make_writable(path)
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def move(src, dst, buffer_size=DEFAULT_BUFFER_SIZE):
+    """Move file or directory `src` to `dst`, verifying the copy if it crosses filesystems.
+
+    Parameters
+    ----------
+    src : :class:`str`
+        File or directory to move.
+    dst : :class:`str`
+        New path of `src`, which must not exist.  Its parent directory must exist.
+    buffer_size : :class:`int`, optional
+        Copy files in chunks of this many bytes.
+
+    Returns
+    -------
+    :class:`str`
+        SHA-256 checksum of the copied data, or ``None`` if `src` was renamed.
+
+    Raises
+    ------
+    FileExistsError
+        If `dst` already exists.
+    OSError
+        If the copy does not match the original.
+    """
+    if os.path.lexists(dst):
+        raise FileExistsError(f"{dst} already exists!")
+    if os.lstat(src).st_dev == os.stat(os.path.dirname(dst)).st_dev:
+        log.debug("os.rename('%s', '%s')", src, dst)
+        os.rename(src, dst)
+        return None
+    digest = _copy(src, dst, buffer_size)
+    _remove(src)
+    return digest
+
+
+def _advance(src, dst, link, state, digest, report, buffer_size=DEFAULT_BUFFER_SIZE):
+    """Carry a single transaction from `state` to :data:`LINKED`.
+
+    `report` is called with the source path, each new state and the
+    checksum of any copy.  The filesystem is inspected before each step,
+    so steps that were completed, but not journaled, are not repeated.
+    A copy that is found in place of `dst` on resuming is compared with
+    the journaled checksum `digest`, or if the copy was not yet journaled,
+    with `src`, before `src` is removed.
+    """
+    verified = False
+    if state == PLANNED:
+        if not os.path.lexists(src) and os.path.lexists(dst):
+            log.info("%s was already moved to %s.", src, dst)
+            report(src, MOVED, None)
+            state = MOVED
+        elif os.path.islink(src) and os.readlink(src) == link and os.path.lexists(dst):
+            log.info("%s was already moved and linked.", src)
+            report(src, MOVED, None)
+            state = MOVED
+        elif os.path.lexists(dst):
+            log.info("%s was already copied to %s.", src, dst)
+            digest = _digest(src, buffer_size)
+            state = COPIED
+        elif os.lstat(src).st_dev == os.stat(os.path.dirname(dst)).st_dev:
+            report(src, MOVED, move(src, dst, buffer_size))
+            state = MOVED
+        else:
+            digest = _copy(src, dst, buffer_size)
+            report(src, COPIED, digest)
+            state = COPIED
+            verified = True
+    if state == COPIED:
+        if os.path.lexists(src) and not (os.path.islink(src) and os.readlink(src) == link):
+            if not verified and _digest(dst, buffer_size) != digest:
+                raise OSError(f"{dst} does not match {src}!")
+            _remove(src)
+        report(src, MOVED, digest)
+    if os.path.islink(src):
+        if os.readlink(src) != link:
+            raise OSError(f"{src} is a symlink to {os.readlink(src)}, not {link}!")
+    elif os.path.lexists(src):
+        raise FileExistsError(f"{src} exists after being moved to {dst}!")
+    else:
+        log.debug("os.symlink('%s', '%s')", link, src)
+        os.symlink(link, src)
+    report(src, LINKED, None)
+
+
+class MoveJournal(object):
+    """Journal of move-and-link transactions.
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        Path to the SQLite database.  It will be created if necessary.
+    commit_interval : :class:`int`, optional
+        Commit after this many planned transactions or finished units of
+        work.  Changes of state are always committed immediately, and
+        :meth:`run` commits any planned transactions before it starts.
+    """
+
+    def __init__(self, filename, commit_interval=100):
+        self.filename = filename
+        self.commit_interval = commit_interval
+        #- states are recorded by the threads of run()
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS transactions (
+                             src TEXT PRIMARY KEY,
+                             dst TEXT NOT NULL,
+                             link TEXT NOT NULL,
+                             state TEXT NOT NULL,
+                             digest TEXT,
+                             updated REAL NOT NULL)""")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS units (
+                             name TEXT PRIMARY KEY,
+                             completed REAL NOT NULL)""")
+        self.conn.commit()
+        self._changes = 0
+
+    def close(self):
+        """Commit any changes and close the database connection.
+        """
+        self.conn.commit()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def plan(self, src, dst, link):
+        """Add a transaction, unless `src` is already in the journal.
+
+        Parameters
+        ----------
+        src : :class:`str`
+            File or directory to move.
+        dst : :class:`str`
+            New path of `src`.
+        link : :class:`str`
+            Target of the symlink that replaces `src`, typically a relative path to `dst`.
+
+        Returns
+        -------
+        :class:`bool`
+            ``True`` if the transaction was added.
+        """
+        cursor = self.conn.execute("INSERT OR IGNORE INTO transactions VALUES (?, ?, ?, ?, NULL, ?)",
+                                   (src, dst, link, PLANNED, time.time()))
+        self._record_change()
+        return cursor.rowcount > 0
+
+    def record(self, src, state, digest=None):
+        """Record and commit the new `state` of the transaction of `src`.
+
+        This may be called from any thread.
+        """
+        with self._lock:
+            if digest is None:
+                self.conn.execute("UPDATE transactions SET state = ?, updated = ? WHERE src = ?",
+                                  (state, time.time(), src))
+            else:
+                self.conn.execute("UPDATE transactions SET state = ?, digest = ?, updated = ? WHERE src = ?",
+                                  (state, digest, time.time(), src))
+            self.conn.commit()
+
+    def _record_change(self):
+        self._changes += 1
+        if self._changes % self.commit_interval == 0:
+            self.conn.commit()
+
+    def complete(self, name):
+        """Record that a named unit of work, such as a tile, is finished.
+
+        Parameters
+        ----------
+        name : :class:`str`
+            Name of the unit of work, *e.g.* ``'fiberassign/main/001234'``.
+        """
+        self.conn.execute("INSERT OR REPLACE INTO units VALUES (?, ?)", (name, time.time()))
+        self._record_change()
+
+    def completed(self):
+        """Names of finished units of work.
+
+        Returns
+        -------
+        :class:`set`
+            Each name passed to :meth:`complete`.
+        """
+        return {row[0] for row in self.conn.execute("SELECT name FROM units")}
+
+    def pending(self):
+        """Transactions that have neither reached :data:`LINKED` nor :data:`FAILED`.
+
+        Returns
+        -------
+        :class:`list`
+            (src, dst, link, state, digest) tuples, in the order they were planned.
+        """
+        return self.conn.execute("SELECT src, dst, link, state, digest FROM transactions "
+                                 "WHERE state NOT IN (?, ?) ORDER BY rowid", (LINKED, FAILED)).fetchall()
+
+    def linked(self):
+        """Sources of completed transactions.
+
+        Returns
+        -------
+        :class:`set`
+            The `src` of each transaction that has reached :data:`LINKED`.
+        """
+        return {row[0] for row in self.conn.execute("SELECT src FROM transactions WHERE state = ?", (LINKED,))}
+
+    def retry(self):
+        """Return :data:`FAILED` transactions to :data:`PLANNED`, so they are attempted again.
+
+        Returns
+        -------
+        :class:`int`
+            The number of failed transactions.
+        """
+        cursor = self.conn.execute("UPDATE transactions SET state = ?, updated = ? WHERE state = ?",
+                                   (PLANNED, time.time(), FAILED))
+        self.conn.commit()
+        return cursor.rowcount
+
+    def run(self, workers=1, buffer_size=DEFAULT_BUFFER_SIZE, sources=None):
+        """Complete pending transactions.
+
+        Transactions that fail are recorded as :data:`FAILED`.
+
+        Parameters
+        ----------
+        workers : :class:`int`, optional
+            Number of threads carrying out transactions.
+        buffer_size : :class:`int`, optional
+            Copy files in chunks of this many bytes.
+        sources : iterable, optional
+            Only complete the transactions of these `src` paths.
+            By default, complete all pending transactions.
+
+        Returns
+        -------
+        :class:`dict`
+            Numbers of transactions ``linked`` and ``failed``.
+        """
+        self.conn.commit()
+        counts = {'linked': 0, 'failed': 0}
+        todo = self.pending()
+        if sources is not None:
+            sources = set(sources)
+            todo = [t for t in todo if t[0] in sources]
+        max_pending = 2 * max(1, workers)
+
+        def report(src, state, digest):
+            #- committed before the next step of the transaction
+            self.record(src, state, digest)
+            if state == LINKED:
+                with self._lock:
+                    counts['linked'] += 1
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            pending = dict()
+            k = 0
+            while k < len(todo) or pending:
+                while k < len(todo) and len(pending) < max_pending:
+                    src, dst, link, state, digest = todo[k]
+                    pending[executor.submit(_advance, src, dst, link, state, digest, report, buffer_size)] = src
+                    k += 1
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    src = pending.pop(future)
+                    try:
+                        future.result()
+                    except OSError as err:
+                        log.error("%s: %s", src, err)
+                        self.record(src, FAILED)
+                        counts['failed'] += 1
+        return counts
+
+
+def _options():
+    """Parse command-line options.
+
+    Returns
+    -------
+    :class:`argparse.Namespace`
+        The parsed options.
+    """
+    prsr = ArgumentParser(prog=os.path.basename(sys.argv[0]),
+                          description='Move files or directories and replace them with symlinks, with a resumable journal.')
+    prsr.add_argument('-j', '--journal', metavar='FILE', required=True,
+                      help='Record transactions in FILE.  Pending and failed transactions in FILE are always completed first.')
+    prsr.add_argument('-f', '--finish', action='store_true',
+                      help='Record all linked transactions as finished, once any work that follows them is done.')
+    prsr.add_argument('-u', '--unfinished', metavar='FILE',
+                      help='Write the SRC of each linked transaction not yet recorded as finished to FILE, one per line.')
+    prsr.add_argument('-w', '--workers', type=int, default=1, metavar='N',
+                      help='Use N threads to move files (default %(default)s).')
+    prsr.add_argument('moves', metavar='SRC DSTDIR LINK', nargs='*',
+                      help='Move SRC into directory DSTDIR, then replace SRC with a symlink to LINK.')
+    options = prsr.parse_args()
+    if len(options.moves) % 3 != 0:
+        prsr.error('Moves must be given as SRC DSTDIR LINK triples.')
+    return options
+
+
+def main():
+    """Entry-point for command-line scripts.
+
+    Returns
+    -------
+    :class:`int`
+        An integer suitable for passing to :func:`sys.exit`.
+    """
+    options = _options()
+    with MoveJournal(options.journal) as journal:
+        journal.retry()
+        for i in range(0, len(options.moves), 3):
+            src, dstdir, link = options.moves[i:i+3]
+            src = os.path.abspath(src)
+            journal.plan(src, os.path.join(os.path.abspath(dstdir), os.path.basename(src)), link)
+        counts = journal.run(workers=options.workers)
+        unfinished = sorted(journal.linked() - journal.completed())
+        if options.unfinished:
+            with open(options.unfinished, 'w') as u:
+                u.writelines(f"{src}\n" for src in unfinished)
+        if options.finish:
+            for src in unfinished:
+                journal.complete(src)
+    log.info("%d linked, %d failed.", counts['linked'], counts['failed'])
+    return min(counts['failed'], 255)
@@ -0,0 +1,422 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst.
+"""
+=============
+desida.verify
+=============
+
+Verify files against checksum files, in parallel.
+
+This replaces ``sha256sum --check`` as used by the ``validate`` function
+in ``desida_library.sh``.  Files are hashed across a pool of processes,
+read with large buffers, and every problem is reported, rather than just
+the first one.
+
+Optionally, a :class:`VerificationState` records the fingerprint (size,
+modification time, inode and change time) of every file that has been
+verified, and when.  Later runs can then skip files whose fingerprint has
+not changed, or spread a complete re-hash of a large tree over many runs.
+"""
+import os
+import sys
+import time
+import json
+import sqlite3
+import hashlib
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from desiutil.log import log
+from .inventory import checksum_contents
+from .walker import walk, _scan
+
+
+#: Exit status when files are missing from, or not listed in, a checksum
+#: file, as returned by the original ``validate`` function.
+MISMATCHED_FILE_COUNT = 17
+
+
+#: Default size of the read buffer, in bytes.
+DEFAULT_BUFFER_SIZE = 16*1024*1024
+
+
+def hash_file(filename, buffer_size=DEFAULT_BUFFER_SIZE):
+    """Compute the SHA-256 checksum of `filename`.
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        Name of the file.
+    buffer_size : :class:`int`, optional
+        Read the file in chunks of this many bytes.
+
+    Returns
+    -------
+    :class:`tuple`
+        The hexadecimal digest and the number of bytes read.
+    """
+    h = hashlib.sha256()
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    nbytes = 0
+    with open(filename, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+            nbytes += n
+    return h.hexdigest(), nbytes
+
+
+def _hash_task(task):
+    """Worker function that hashes a single file.
+
+    Parameters
+    ----------
+    task : :class:`tuple`
+        Filename, expected digest and buffer size.
+
+    Returns
+    -------
+    :class:`tuple`
+        Filename, expected digest, actual digest (or ``None``), number
+        of bytes read and error message (or ``None``).
+    """
+    filename, expected, buffer_size = task
+    try:
+        digest, nbytes = hash_file(filename, buffer_size)
+    except FileNotFoundError:
+        return filename, expected, None, 0, None
+    except OSError as err:
+        return filename, expected, None, 0, str(err)
+    return filename, expected, digest, nbytes, None
+
+
+def fingerprint(st):
+    """Summarize the :class:`os.stat_result` `st` of a file.
+
+    Parameters
+    ----------
+    st : :class:`os.stat_result`
+        Result of :func:`os.stat`.
+
+    Returns
+    -------
+    :class:`tuple`
+        Size, modification time, inode and change time.
+    """
+    return (st.st_size, st.st_mtime_ns, st.st_ino, st.st_ctime_ns)
+
+
+def _verify_task(task):
+    """Worker function for :func:`verify_manifests`.
+
+    Parameters
+    ----------
+    task : :class:`tuple`
+        Filename, expected digest, buffer size and a fingerprint.  If the
+        fingerprint is not ``None`` and matches the file on disk, the file
+        is not read again.
+
+    Returns
+    -------
+    :class:`tuple`
+        Filename, expected digest, actual digest (or ``None``), number of
+        bytes read, error message (or ``None``), fingerprint of the file
+        (or ``None``) and whether reading the file was skipped.
+    """
+    filename, expected, buffer_size, unchanged = task
+    try:
+        fp = fingerprint(os.stat(filename))
+    except FileNotFoundError:
+        return filename, expected, None, 0, None, None, False
+    except OSError as err:
+        return filename, expected, None, 0, str(err), None, False
+    if unchanged is not None and fp == unchanged:
+        return filename, expected, expected, 0, None, fp, True
+    filename, expected, digest, nbytes, error = _hash_task((filename, expected, buffer_size))
+    return filename, expected, digest, nbytes, error, fp, False
+
+
+class VerificationState(object):
+    """Persistent record of when each file was last verified.
+
+    Parameters
+    ----------
+    filename : :class:`str`
+        Path to the SQLite database.  It will be created if necessary.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS files (
+                             path TEXT PRIMARY KEY,
+                             size INTEGER NOT NULL,
+                             mtime_ns INTEGER NOT NULL,
+                             ino INTEGER NOT NULL,
+                             ctime_ns INTEGER NOT NULL,
+                             digest TEXT NOT NULL,
+                             verified REAL NOT NULL)""")
+        self.conn.commit()
+
+    def close(self):
+        """Commit any changes and close the database connection.
+        """
+        self.conn.commit()
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def records(self, directory):
+        """Return the records of all files in or below `directory`.
+
+        Parameters
+        ----------
+        directory : :class:`str`
+            An absolute path.
+
+        Returns
+        -------
+        :class:`dict`
+            A mapping of path to a tuple of fingerprint, digest and the
+            time it was last verified.
+        """
+        lo = directory.rstrip('/') + '/'
+        hi = lo[:-1] + chr(ord('/') + 1)
+        r = dict()
+        for row in self.conn.execute("SELECT * FROM files WHERE path >= ? AND path < ?", (lo, hi)):
+            r[row[0]] = (tuple(row[1:5]), row[5], row[6])
+        return r
+
+    def update(self, path, fp, digest, verified):
+        """Record that `path` was verified.
+
+        Parameters
+        ----------
+        path : :class:`str`
+            Path to the file.
+        fp : :class:`tuple`
+            Fingerprint of the file, see :func:`fingerprint`.
+        digest : :class:`str`
+            Checksum of the file.
+        verified : :class:`float`
+            Time of verification.
+        """
+        self.conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                          (path,) + tuple(fp) + (digest, verified))
+
+    def forget(self, path):
+        """Remove any record of `path`.
+
+        Parameters
+        ----------
+        path : :class:`str`
+            Path to the file.
+        """
+        self.conn.execute("DELETE FROM files WHERE path = ?", (path,))
+
+
+def manifest_files(manifest, recursive=False):
+    """Find the files on disk that `manifest` should describe.
+
+    Parameters
+    ----------
+    manifest : :class:`str`
+        Path to a checksum file.
+    recursive : :class:`bool`, optional
+        If ``True``, include files in subdirectories of the directory
+        containing `manifest`.
+
+    Returns
+    -------
+    :class:`set`
+        Normalized paths to the files, excluding `manifest` itself.
+        Symlinks to directories are directories, as in :func:`~desida.walker.walk`.
+    """
+    d = os.path.dirname(os.path.abspath(manifest))
+    if recursive:
+        listings = walk(d)
+    else:
+        listings = [_scan(d)[0]]
+    found = {os.path.join(listing.dirpath, f) for listing in listings
+             for f in listing.filenames}
+    found.discard(os.path.abspath(manifest))
+    return found
+
+
+def verify_manifests(manifests, processes=None, buffer_size=DEFAULT_BUFFER_SIZE, recursive=False,
+                     state=None, fast=False, max_age=None):
+    """Verify the files listed in one or more checksum files.
+
+    Parameters
+    ----------
+    manifests : :class:`list`
+        Paths to checksum files.
+    processes : :class:`int`, optional
+        Number of processes used to compute checksums.  By default, the
+        number of CPUs.
+    buffer_size : :class:`int`, optional
+        Read files in chunks of this many bytes.
+    recursive : :class:`bool` or :class:`set`, optional
+        If ``True``, look for extra files in subdirectories as well.
+        If a set, only do so for the checksum files in the set.
+    state : :class:`VerificationState`, optional
+        Record verified files here, and use it to decide which files to skip.
+    fast : :class:`bool`, optional
+        If ``True``, only read files whose fingerprint has changed since
+        they were last verified.  Requires `state`.
+    max_age : :class:`float`, optional
+        Only read files whose fingerprint has changed or that were last
+        verified more than `max_age` days ago.  Requires `state`.
+
+    Returns
+    -------
+    :class:`dict`
+        A report with the lists of ``mismatched``, ``missing`` and ``extra``
+        files, files that could not be read (``errors``), the checksum
+        files with any of these problems (``failed``), and the number
+        of files verified and skipped, bytes read and throughput.
+    """
+    report = {'manifests': list(manifests), 'verified': 0, 'skipped': 0, 'mismatched': [],
+              'missing': [], 'extra': [], 'errors': [], 'failed': [],
+              'bytes': 0, 'seconds': 0.0, 'bytes_per_second': 0.0}
+    now = time.time()
+    if state is not None and max_age is not None:
+        oldest = now - max_age*86400
+    elif state is not None and fast:
+        oldest = float('-inf')
+    else:
+        oldest = None
+    tasks = list()
+    listed_by = dict()
+    failed = set()
+    for manifest in manifests:
+        d = os.path.dirname(os.path.abspath(manifest))
+        records = state.records(d) if oldest is not None else dict()
+        listed = set()
+        for f, digest in checksum_contents(manifest).items():
+            ff = os.path.normpath(os.path.join(d, f))
+            listed.add(ff)
+            listed_by.setdefault(ff, list()).append(manifest)
+            unchanged = None
+            if ff in records:
+                fp, recorded_digest, verified = records[ff]
+                if recorded_digest == digest and verified >= oldest:
+                    unchanged = fp
+            tasks.append((ff, digest, buffer_size, unchanged))
+        extra = sorted(manifest_files(manifest, recursive if isinstance(recursive, bool) else manifest in recursive) - listed)
+        if extra:
+            failed.add(manifest)
+        report['extra'] += extra
+    log.info("Verifying %d files listed in %d checksum files.", len(tasks), len(manifests))
+    t0 = time.time()
+    next_report = t0 + 60
+    chunksize = max(1, min(64, len(tasks) // (8 * (processes or os.cpu_count() or 1))))
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        for filename, expected, digest, nbytes, error, fp, skipped in executor.map(_verify_task, tasks,
+                                                                                 chunksize=chunksize):
+            report['bytes'] += nbytes
+            if state is not None and not skipped:
+                if digest is not None and digest == expected:
+                    state.update(filename, fp, digest, now)
+                else:
+                    state.forget(filename)
+            if not skipped and (error is not None or digest != expected):
+                failed.update(listed_by[filename])
+            if skipped:
+                report['skipped'] += 1
+            elif error is not None:
+                log.error("Could not read %s: %s", filename, error)
+                report['errors'].append({'path': filename, 'error': error})
+            elif digest is None:
+                log.error("%s is missing!", filename)
+                report['missing'].append(filename)
+            elif digest != expected:
+                log.error("%s has checksum %s, expected %s!", filename, digest, expected)
+                report['mismatched'].append({'path': filename, 'expected': expected, 'actual': digest})
+            else:
+                report['verified'] += 1
+            t = time.time()
+            if t > next_report:
+                log.info("Read %d bytes at %.1f MB/s.", report['bytes'], report['bytes'] / (t - t0) / 1e6)
+                next_report = t + 60
+                if state is not None:
+                    state.conn.commit()
+    report['failed'] = [m for m in manifests if m in failed]
+    report['seconds'] = time.time() - t0
+    if report['seconds'] > 0:
+        report['bytes_per_second'] = report['bytes'] / report['seconds']
+    log.info("Read %d bytes in %.1f s (%.1f MB/s); skipped %d unchanged files.", report['bytes'],
+             report['seconds'], report['bytes_per_second'] / 1e6, report['skipped'])
+    for f in report['extra']:
+        log.error("%s is not listed in any checksum file!", f)
+    return report
+
+
+def _options():
+    """Parse command-line options.
+
+    Returns
+    -------
+    :class:`argparse.Namespace`
+        The parsed options.
+    """
+    prsr = ArgumentParser(prog=os.path.basename(sys.argv[0]),
+                          description='Verify files against one or more checksum files.')
+    mode = prsr.add_mutually_exclusive_group()
+    mode.add_argument('--fast', action='store_true',
+                      help='Only read files whose size, modification time, inode or change time has changed since they were last verified. Requires --state.')
+    mode.add_argument('--full', action='store_true',
+                      help='Read all files (the default), or, with --max-age, all files not verified recently.')
+    prsr.add_argument('-a', '--max-age', type=float, metavar='DAYS',
+                      help='With --full, also skip unchanged files verified less than DAYS days ago. Requires --state.')
+    prsr.add_argument('-b', '--buffer-size', type=int, default=DEFAULT_BUFFER_SIZE//(1024*1024), metavar='MB',
+                      help='Read files in chunks of MB megabytes (default %(default)s).')
+    prsr.add_argument('-o', '--output', metavar='FILE',
+                      help='Write a JSON report to FILE.')
+    prsr.add_argument('-p', '--processes', type=int, metavar='N',
+                      help='Use N processes to compute checksums (default is the number of CPUs).')
+    prsr.add_argument('-r', '--recursive', action='store_true',
+                      help='Look for extra files in subdirectories as well.')
+    prsr.add_argument('-s', '--state', metavar='FILE',
+                      help='Record verified files in the database FILE.')
+    prsr.add_argument('manifests', metavar='CHECKSUM', nargs='+',
+                      help='Checksum file(s) to verify.')
+    options = prsr.parse_args()
+    if (options.fast or options.max_age is not None) and options.state is None:
+        prsr.error('--fast and --max-age require --state.')
+    return options
+
+
+def main():
+    """Entry-point for command-line scripts.
+
+    Returns
+    -------
+    :class:`int`
+        An integer suitable for passing to :func:`sys.exit`: :data:`MISMATCHED_FILE_COUNT`
+        if any files are missing or extra, otherwise 1 if any files do not match
+        or could not be read.
+    """
+    options = _options()
+    state = VerificationState(options.state) if options.state else None
+    try:
+        report = verify_manifests(options.manifests, processes=options.processes,
+                                  buffer_size=options.buffer_size*1024*1024,
+                                  recursive=options.recursive, state=state,
+                                  fast=options.fast, max_age=options.max_age)
+    finally:
+        if state is not None:
+            state.close()
+    if options.output:
+        with open(options.output, 'w') as o:
+            json.dump(report, o, indent=1)
+    if report['missing'] or report['extra']:
+        return MISMATCHED_FILE_COUNT
+    if report['mismatched'] or report['errors']:
+        return 1
+    return 0
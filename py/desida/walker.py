@@ -0,0 +1,162 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst.
+"""
+=============
+desida.walker
+=============
+
+Parallel, :func:`os.scandir`-based directory tree walker.
+
+On network filesystems such as CFS, walking a large tree with :func:`os.walk`
+is dominated by the latency of serial metadata requests.  The walker in this
+module issues directory listings from a bounded pool of threads, classifies
+entries with the type information cached by :class:`os.DirEntry`, and yields
+each directory as soon as it has been listed.
+"""
+import os
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+#: Default number of threads used to list directories.
+DEFAULT_WORKERS = 8
+
+
+DirectoryListing = namedtuple('DirectoryListing', ['dirpath', 'dirnames', 'filenames', 'stats'])
+DirectoryListing.__doc__ = """The contents of a single directory.
+
+Attributes
+----------
+dirpath : :class:`str`
+    Path to the directory.
+dirnames : :class:`list`
+    Names of subdirectories, including symlinks to directories,
+    as in :func:`os.walk`.
+filenames : :class:`list`
+    Names of everything else in the directory.
+stats : :class:`dict` or ``None``
+    If requested, a mapping of each name in `filenames` to its
+    :class:`os.stat_result`.
+"""
+
+
+def _scan(dirpath, stat=False, followlinks=False):
+    """List `dirpath`, returning the listing and the subdirectories to descend into.
+
+    Parameters
+    ----------
+    dirpath : :class:`str`
+        Directory to list.
+    stat : :class:`bool`, optional
+        If ``True``, also :func:`~os.stat` every file.
+    followlinks : :class:`bool`, optional
+        If ``True``, descend into symlinks to directories.
+
+    Returns
+    -------
+    :class:`tuple`
+        A :class:`DirectoryListing` and a :class:`list` of subdirectory paths.
+    """
+    dirnames = list()
+    filenames = list()
+    stats = dict() if stat else None
+    descend = list()
+    with os.scandir(dirpath) as it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if is_dir:
+                dirnames.append(entry.name)
+                if followlinks or not entry.is_symlink():
+                    descend.append(entry.path)
+            else:
+                filenames.append(entry.name)
+                if stat:
+                    try:
+                        stats[entry.name] = entry.stat()
+                    except OSError:
+                        stats[entry.name] = entry.stat(follow_symlinks=False)
+    return DirectoryListing(dirpath, dirnames, filenames, stats), descend
+
+
+def scan_directory(dirpath, stat=False):
+    """List a single directory.
+
+    Parameters
+    ----------
+    dirpath : :class:`str`
+        Directory to list.
+    stat : :class:`bool`, optional
+        If ``True``, also :func:`~os.stat` every file.
+
+    Returns
+    -------
+    :class:`DirectoryListing`
+        The contents of `dirpath`.
+    """
+    return _scan(dirpath, stat=stat)[0]
+
+
+def walk(top, workers=None, prune=None, stat=False, followlinks=False, onerror=None, scanner=None):
+    """Walk the directory tree rooted at `top`, listing directories in parallel.
+
+    Unlike :func:`os.walk`, directories are yielded in the order that their
+    listings complete, not in a top-down order.  Parents are always
+    yielded before their children.
+
+    Parameters
+    ----------
+    top : :class:`str`
+        Root of the directory tree.
+    workers : :class:`int`, optional
+        Number of threads used to list directories, default :data:`DEFAULT_WORKERS`.
+    prune : callable, optional
+        Called with each :class:`DirectoryListing` as it is yielded.  If it
+        returns ``True``, the subdirectories of that directory are not visited.
+    stat : :class:`bool`, optional
+        If ``True``, :func:`~os.stat` every file, in the worker threads.
+    followlinks : :class:`bool`, optional
+        If ``True``, descend into symlinks to directories.
+    onerror : callable, optional
+        Called with the :class:`OSError` raised when a directory cannot be
+        listed.  By default, such errors are ignored, as in :func:`os.walk`.
+    scanner : callable, optional
+        Replaces the function that lists a single directory.  It is called
+        in a worker thread as ``scanner(dirpath, stat, followlinks)`` and must
+        return a :class:`DirectoryListing` and a :class:`list` of
+        subdirectory paths to visit.  This allows, for example, listings to
+        be served from a cache.
+
+    Yields
+    ------
+    :class:`DirectoryListing`
+        The contents of each directory in the tree.
+    """
+    if workers is None:
+        workers = DEFAULT_WORKERS
+    workers = max(1, workers)
+    if scanner is None:
+        scanner = _scan
+    #
+    # Keep the number of outstanding listings bounded, so that very wide
+    # trees do not flood the pool with queued work.
+    #
+    max_pending = 2 * workers
+    todo = deque([top])
+    pending = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while todo or pending:
+            while todo and len(pending) < max_pending:
+                pending.add(executor.submit(scanner, todo.popleft(), stat, followlinks))
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    listing, descend = future.result()
+                except OSError as err:
+                    if onerror is not None:
+                        onerror(err)
+                    continue
+                yield listing
+                if prune is None or not prune(listing):
+                    todo.extend(descend)
@@ -0,0 +1,273 @@
+# Licensed under a 3-clause BSD style license - see LICENSE.rst.
+"""
+===============
+desida.zpixlogs
+===============
+
+Cached index of zpix job logs.
+
+zpix jobs are not tracked in the proctables, so their QIDs are parsed from
+the names of their logs, ``run/scripts/healpix/*/*/*/zpix-*-{QID}.log``.
+The healpix tree is listed in parallel, and the listings are cached
+together with the modification time of each directory, so later calls only
+list directories that have changed.  Optionally the heads and tails of the
+logs are parsed for the state and elapsed time of jobs that sacct no longer
+remembers; these are cached too, with the modification time of each log.
+The cache is only rewritten when something has changed.
+"""
+
+import os, re, time
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from astropy.io import fits
+from astropy.table import Table
+
+from desiutil.log import get_logger
+
+from desida.walker import walk, _scan, DirectoryListing
+
+#- Depth of the zpix log directories below run/scripts/healpix
+log_depth = 3
+
+#- Number of bytes read from each end of a log to parse it
+tail_bytes = 65536
+
+#- Timestamps from `date` and time.asctime(), e.g. 'Tue Jan 10 12:34:56 PST 2023'
+_timestamp = re.compile(r'\b[A-Z][a-z]{2} [A-Z][a-z]{2} +\d{1,2} \d\d:\d\d:\d\d(?: [A-Z]{3,4})? \d{4}\b')
+
+#- Patterns in log tails and the Slurm state they imply, checked in order
+_state_patterns = (
+    (re.compile(r'CANCELLED AT .* DUE TO TIME LIMIT'), 'TIMEOUT'),
+    (re.compile(r'CANCELLED AT'), 'CANCELLED'),
+    (re.compile(r'oom-kill|Out Of Memory', re.IGNORECASE), 'OUT_OF_MEMORY'),
+    (re.compile(r'Traceback \(most recent call last\)|srun: error|CRITICAL:'), 'FAILED'),
+    (re.compile(r'All done|SUCCESS', re.IGNORECASE), 'COMPLETED'),
+    )
+
+def zpix_qid(filename):
+    """
+    Return the QID of a zpix log, parsed from its filename, or None
+    """
+    try:
+        return int(os.path.splitext(os.path.basename(filename))[0].split('-')[-1])
+    except ValueError:
+        return None
+
+def _parse_timestamp(text):
+    """
+    Return seconds since the epoch of a `date` timestamp, ignoring the time zone
+    """
+    words = text.split()
+    if len(words) == 6:
+        del words[4]
+    return time.mktime(time.strptime(' '.join(words), '%a %b %d %H:%M:%S %Y'))
+
+def parse_log(filename, nbytes=tail_bytes):
+    """
+    Parse the state and elapsed time of a job from its log
+
+    Args:
+        filename (str): path to log
+
+    Options:
+        nbytes (int): number of bytes to read from each end of the log
+
+    Returns dict with keys STATE (e.g. COMPLETED, or UNKNOWN), EXITCODE ('0:0'
+    if completed, otherwise '') and ELAPSED ('HH:MM:SS' between the first and
+    last timestamps in the log, or '' if there are fewer than two).
+    """
+    with open(filename, 'rb') as fx:
+        head = fx.read(nbytes)
+        size = fx.seek(0, os.SEEK_END)
+        fx.seek(max(len(head), size - nbytes))
+        tail = head + fx.read()
+
+    text = tail.decode('utf-8', errors='replace')
+    state = 'UNKNOWN'
+    #- the last part of the log decides the state
+    end = text[-nbytes:]
+    for pattern, pattern_state in _state_patterns:
+        if pattern.search(end):
+            state = pattern_state
+            break
+
+    elapsed = ''
+    stamps = _timestamp.findall(text)
+    if len(stamps) >= 2:
+        try:
+            seconds = int(_parse_timestamp(stamps[-1]) - _parse_timestamp(stamps[0]))
+        except ValueError:
+            seconds = -1
+        if seconds >= 0:
+            elapsed = f'{seconds//3600:02d}:{(seconds//60)%60:02d}:{seconds%60:02d}'
+
+    return dict(STATE=state, EXITCODE='0:0' if state == 'COMPLETED' else '', ELAPSED=elapsed)
+
+def _read_cache(cachefile):
+    """
+    Return (dirs, tails) cached in `cachefile`
+
+    dirs is dict of dirpath -> (mtime_ns, subdirs, logs) and tails is
+    dict of log path -> (mtime_ns, parsed log dict)
+    """
+    dirs = dict()
+    tails = dict()
+    if cachefile is None or not os.path.exists(cachefile):
+        return dirs, tails
+
+    d = Table.read(cachefile, hdu='DIRS', mask_invalid=False)
+    for path, mtime, subdirs, logs in zip(d['PATH'], d['MTIME'], d['SUBDIRS'], d['LOGS']):
+        dirs[str(path)] = (int(mtime), [s for s in str(subdirs).split('|') if s],
+                           [f for f in str(logs).split('|') if f])
+    t = Table.read(cachefile, hdu='TAILS', mask_invalid=False)
+    for row in t:
+        tails[str(row['PATH'])] = (int(row['MTIME']), dict(STATE=str(row['STATE']),
+                                   EXITCODE=str(row['EXITCODE']), ELAPSED=str(row['ELAPSED'])))
+    return dirs, tails
+
+def _write_cache(cachefile, dirs, tails):
+    """
+    Write `dirs` and `tails`, as returned by _read_cache, to `cachefile`
+    """
+    d = Table()
+    paths = sorted(dirs)
+    d['PATH'] = np.array(paths, dtype=str)
+    d['MTIME'] = np.array([dirs[p][0] for p in paths], dtype=np.int64)
+    d['SUBDIRS'] = np.array(['|'.join(dirs[p][1]) for p in paths], dtype=str)
+    d['LOGS'] = np.array(['|'.join(dirs[p][2]) for p in paths], dtype=str)
+
+    t = Table()
+    paths = sorted(tails)
+    t['PATH'] = np.array(paths, dtype=str)
+    t['MTIME'] = np.array([tails[p][0] for p in paths], dtype=np.int64)
+    for col in ('STATE', 'EXITCODE', 'ELAPSED'):
+        t[col] = np.array([tails[p][1][col] for p in paths], dtype=str)
+
+    hdus = fits.HDUList([fits.PrimaryHDU(), fits.table_to_hdu(d), fits.table_to_hdu(t)])
+    hdus[1].name = 'DIRS'
+    hdus[2].name = 'TAILS'
+    tmpfile = cachefile + '.tmp'
+    hdus.writeto(tmpfile, overwrite=True)
+    os.replace(tmpfile, cachefile)
+
+def _parse_tails(paths, cached_tails, workers=None):
+    """
+    Return dict of log path -> (mtime_ns, parsed log dict) for `paths`
+
+    Logs are stat'ed and parsed by `workers` threads; logs that have not
+    changed since they were cached in `cached_tails` are not parsed again.
+    """
+    def parse(p):
+        mtime_ns = os.stat(p).st_mtime_ns
+        if p in cached_tails and cached_tails[p][0] == mtime_ns:
+            return cached_tails[p]
+        return (mtime_ns, parse_log(p))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(zip(paths, pool.map(parse, paths)))
+
+def find_zpix_logs(healpixdir, cachefile=None, workers=None, tails=False):
+    """
+    Return a Table of zpix logs below `healpixdir`
+
+    Args:
+        healpixdir (str): the run/scripts/healpix directory of a production
+
+    Options:
+        cachefile (str): FITS file to cache directory listings and parsed logs
+        workers (int): number of threads used to list directories and parse logs
+        tails (bool): also parse the state and elapsed time from each log;
+            see also zpix_log_tails
+
+    Returns Table with columns PATH, QID, and if `tails`, STATE, EXITCODE, ELAPSED
+    """
+    log = get_logger()
+    cached_dirs, cached_tails = _read_cache(cachefile)
+    dirs = dict()
+    mtimes = dict()
+    nscanned = [0,]
+
+    def depth(dirpath):
+        rel = os.path.relpath(dirpath, healpixdir)
+        return 0 if rel == '.' else rel.count(os.sep) + 1
+
+    def scanner(dirpath, stat, followlinks):
+        mtime_ns = os.stat(dirpath).st_mtime_ns
+        mtimes[dirpath] = mtime_ns
+        if dirpath in cached_dirs and cached_dirs[dirpath][0] == mtime_ns:
+            subdirs, logs = cached_dirs[dirpath][1:]
+            listing = DirectoryListing(dirpath, subdirs, logs, None)
+            return listing, [os.path.join(dirpath, d) for d in subdirs]
+        listing, descend = _scan(dirpath, stat, followlinks)
+        nscanned[0] += 1
+        logs = sorted(f for f in listing.filenames if f.startswith('zpix-') and f.endswith('.log'))
+        listing = DirectoryListing(dirpath, listing.dirnames, logs, None)
+        return listing, descend
+
+    if os.path.isdir(healpixdir):
+        for listing in walk(healpixdir, workers=workers, scanner=scanner,
+                            prune=lambda listing: depth(listing.dirpath) >= log_depth):
+            d = depth(listing.dirpath)
+            logs = listing.filenames if d == log_depth else []
+            subdirs = sorted(listing.dirnames) if d < log_depth else []
+            dirs[listing.dirpath] = (mtimes[listing.dirpath], subdirs, logs)
+
+    log.info(f'Listed {nscanned[0]} of {len(dirs)} healpix directories')
+
+    paths = sorted(os.path.join(dirpath, f) for dirpath, (m, s, logs) in dirs.items() for f in logs)
+    qids = list()
+    keep = list()
+    for p in paths:
+        qid = zpix_qid(p)
+        if qid is None:
+            log.error(f'Unable to parse integer qid from {p}; skipping')
+            continue
+        keep.append(p)
+        qids.append(qid)
+
+    t = Table()
+    t['PATH'] = np.array(keep, dtype=str)
+    t['QID'] = np.array(qids, dtype=np.int64)
+
+    #- forget logs that no longer exist
+    found = set(keep)
+    newtails = {p: v for p, v in cached_tails.items() if p in found}
+    if tails:
+        newtails.update(_parse_tails(keep, cached_tails, workers))
+        for col in ('STATE', 'EXITCODE', 'ELAPSED'):
+            t[col] = np.array([newtails[p][1][col] for p in keep], dtype=str)
+
+    if cachefile is not None and (dirs != cached_dirs or newtails != cached_tails):
+        _write_cache(cachefile, dirs, newtails)
+
+    return t
+
+def zpix_log_tails(zpixlogs, qids, cachefile=None, workers=None):
+    """
+    Return the rows of `zpixlogs` for `qids`, with the state and elapsed time parsed from each log
+
+    Args:
+        zpixlogs (Table): zpix logs, as returned by find_zpix_logs
+        qids (array): QIDs of the jobs whose logs should be parsed
+
+    Options:
+        cachefile (str): FITS file to cache parsed logs, shared with find_zpix_logs
+        workers (int): number of threads used to parse logs
+
+    Returns Table with columns PATH, QID, STATE, EXITCODE, ELAPSED
+    """
+    log = get_logger()
+    cached_dirs, cached_tails = _read_cache(cachefile)
+    t = zpixlogs[np.isin(zpixlogs['QID'], qids)]['PATH', 'QID']
+    paths = [str(p) for p in t['PATH']]
+    newtails = _parse_tails(paths, cached_tails, workers)
+    nparsed = sum(1 for p in paths if newtails[p] is not cached_tails.get(p))
+    log.info(f'Parsed {nparsed} of {len(paths)} zpix logs')
+    for col in ('STATE', 'EXITCODE', 'ELAPSED'):
+        t[col] = np.array([newtails[p][1][col] for p in paths], dtype=str)
+
+    if cachefile is not None and nparsed > 0:
+        cached_tails.update(newtails)
+        _write_cache(cachefile, cached_dirs, cached_tails)
+
+    return t